@@ -0,0 +1,263 @@
+// Copyright (c) 2009, Google Inc.
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//      http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+
+package net.tawacentral.roger.secrets;
+
+import java.io.File;
+import java.io.FileInputStream;
+import java.io.FileOutputStream;
+import java.io.IOException;
+import java.io.InputStream;
+import java.io.OutputStream;
+import java.util.ArrayList;
+import java.util.Random;
+
+import org.json.JSONArray;
+import org.json.JSONException;
+import org.json.JSONObject;
+import org.junit.Test;
+import org.junit.runner.RunWith;
+import org.mindrot.jbcrypt.BCrypt;
+
+import android.support.test.InstrumentationRegistry;
+import android.support.test.runner.AndroidJUnit4;
+import android.util.Log;
+
+import net.tawacentral.roger.secrets.SecurityUtils.CipherInfo;
+
+/**
+ * Benchmarks of the vault file formats, run on synthetic vaults, and of the
+ * key derivation.
+ *
+ * These are meant for developers, and run on a device as instrumented tests:
+ *
+ *   ./gradlew connectedAndroidTest \
+ *       -Pandroid.testInstrumentationRunnerArguments.class=\
+ *       net.tawacentral.roger.secrets.Benchmarks
+ *
+ * The results are written to the log with the tag "Benchmarks".
+ */
+@RunWith(AndroidJUnit4.class)
+public class Benchmarks {
+  /** Tag for logging purposes. */
+  public static final String LOG_TAG = "Benchmarks";
+
+  // Number of secrets in each synthetic vault.
+  private static final int[] VAULT_SIZES = {1000, 10000, 50000};
+
+  // Number of times each operation is repeated.  The best time is reported.
+  private static final int REPEAT = 3;
+
+  // The key derivation is timed with these numbers of rounds, as passed to
+  // BCrypt.crypt_raw().  The difference between the two gives the time per
+  // round without the fixed cost of setting up the key schedule.
+  private static final int BCRYPT_LOW_ROUNDS = 4;
+  private static final int BCRYPT_HIGH_ROUNDS = 8;
+
+  /** Interface implemented by each file format being measured. */
+  private interface Format {
+    String getName();
+    void write(OutputStream output, CipherInfo info, ArrayList<Secret> secrets)
+        throws IOException;
+    ArrayList<Secret> read(File file, CipherInfo info) throws IOException;
+  }
+
+  /** Reads a file through a stream. */
+  private static ArrayList<Secret> readStream(File file, CipherInfo info)
+      throws IOException {
+    InputStream input = new FileInputStream(file);
+    try {
+      return FileUtils.readSecrets(input, info);
+    } finally {
+      input.close();
+    }
+  }
+
+  private static final Format V4 = new Format() {
+    @Override
+    public String getName() {
+      return "V4";
+    }
+
+    @Override
+    public void write(OutputStream output, CipherInfo info,
+                      ArrayList<Secret> secrets) throws IOException {
+      FileUtils.writeSecretsV4(output, info.createEncryptCipher(), info.salt,
+                               info.rounds, secrets);
+    }
+
+    @Override
+    public ArrayList<Secret> read(File file, CipherInfo info)
+        throws IOException {
+      return readStream(file, info);
+    }
+  };
+
+  private static final Format V5 = new Format() {
+    @Override
+    public String getName() {
+      return "V5";
+    }
+
+    @Override
+    public void write(OutputStream output, CipherInfo info,
+                      ArrayList<Secret> secrets) throws IOException {
+      FileUtils.writeSecrets(output, info, secrets);
+    }
+
+    @Override
+    public ArrayList<Secret> read(File file, CipherInfo info)
+        throws IOException {
+      return readStream(file, info);
+    }
+  };
+
+  /** Same file as V5, read by mapping it in memory. */
+  private static final Format V5_MAPPED = new Format() {
+    @Override
+    public String getName() {
+      return "V5-mapped";
+    }
+
+    @Override
+    public void write(OutputStream output, CipherInfo info,
+                      ArrayList<Secret> secrets) throws IOException {
+      FileUtils.writeSecrets(output, info, secrets);
+    }
+
+    @Override
+    public ArrayList<Secret> read(File file, CipherInfo info)
+        throws IOException {
+      return FileUtils.readMappedSecrets(file, info);
+    }
+  };
+
+  /**
+   * Reports the time per round of the key derivation.  Its results are
+   * checked by BCryptTest.
+   */
+  @Test
+  public void runBcrypt() {
+    long low = timeBcrypt(BCRYPT_LOW_ROUNDS);
+    long high = timeBcrypt(BCRYPT_HIGH_ROUNDS);
+    Log.i(LOG_TAG, "bcrypt ns_per_round=" + (high - low) /
+          ((1 << BCRYPT_HIGH_ROUNDS) - (1 << BCRYPT_LOW_ROUNDS)));
+  }
+
+  /** Returns the best time in nanosecs to derive a key. */
+  private static long timeBcrypt(int rounds) {
+    byte[] password = "benchmark\000".getBytes();
+    byte[] salt = new byte[BCrypt.BCRYPT_SALT_LEN];
+    long best = Long.MAX_VALUE;
+    for (int i = 0; i < REPEAT; ++i) {
+      int[] plaintext = new int[6];
+      long start = System.nanoTime();
+      new BCrypt().crypt_raw(password, salt, rounds, plaintext);
+      best = Math.min(best, System.nanoTime() - start);
+    }
+    return best;
+  }
+
+  /** Compares the size, write and read times of the file formats. */
+  @Test
+  public void runFormats() throws Exception {
+    File dir = InstrumentationRegistry.getTargetContext().getCacheDir();
+    // Use the minimum number of rounds, key derivation is not measured here.
+    CipherInfo info = SecurityUtils.createCiphers("benchmark",
+        new byte[BCrypt.BCRYPT_SALT_LEN], 4);
+    File file = new File(dir, "benchmark");
+
+    try {
+      for (int size : VAULT_SIZES) {
+        ArrayList<Secret> secrets = createVault(size);
+        for (Format format : new Format[] {V4, V5, V5_MAPPED}) {
+          long writeTime = Long.MAX_VALUE;
+          long readTime = Long.MAX_VALUE;
+          for (int i = 0; i < REPEAT; ++i) {
+            long start = System.nanoTime();
+            OutputStream output = new FileOutputStream(file);
+            try {
+              format.write(output, info, secrets);
+            } finally {
+              output.close();
+            }
+            writeTime = Math.min(writeTime, System.nanoTime() - start);
+
+            start = System.nanoTime();
+            ArrayList<Secret> loaded = format.read(file, info);
+            if (null == loaded || loaded.size() != size)
+              throw new IOException(format.getName() + " round trip failed");
+            readTime = Math.min(readTime, System.nanoTime() - start);
+          }
+
+          Log.i(LOG_TAG, format.getName() + " secrets=" + size +
+                " bytes=" + file.length() +
+                " write_ms=" + writeTime / 1000000 +
+                " read_ms=" + readTime / 1000000);
+        }
+      }
+    } finally {
+      file.delete();
+    }
+  }
+
+  /**
+   * Creates a synthetic vault with the given number of secrets.  Each secret
+   * has a short note and an access log of up to 50 entries spread over the
+   * last year, which is typical of a vault that has been in use for a while.
+   * The content is generated from a fixed seed so that runs are comparable.
+   */
+  static ArrayList<Secret> createVault(int size) throws JSONException {
+    Random random = new Random(size);
+    long now = System.currentTimeMillis();
+    final long year = 365L * 24 * 60 * 60 * 1000;
+    ArrayList<Secret> secrets = new ArrayList<Secret>(size);
+
+    for (int i = 0; i < size; ++i) {
+      JSONObject json = new JSONObject();
+      json.put("description", "Account " + i + " at example" + i % 50 + ".com");
+      json.put("username", "user" + random.nextInt(1000));
+      json.put("password", Long.toString(random.nextLong(), 36));
+      json.put("email", "user" + random.nextInt(1000) + "@example.com");
+      json.put("note", "Security question: first pet? Answer: " +
+               Long.toString(random.nextLong(), 36) + "\nPIN " +
+               random.nextInt(10000));
+
+      // Log entries are in reverse chronological order, with the CREATED
+      // entry last.
+      int entries = 1 + random.nextInt(50);
+      long time = now - (long) (random.nextDouble() * year);
+      long[] times = new long[entries];
+      for (int j = entries - 1; j >= 0; --j) {
+        times[j] = time;
+        time += (long) (random.nextDouble() * (now - time) / (j + 1));
+      }
+      JSONArray log = new JSONArray();
+      for (int j = 0; j < entries; ++j) {
+        JSONObject entry = new JSONObject();
+        int type = j == entries - 1 ? Secret.LogEntry.CREATED
+            : (random.nextInt(4) == 0 ? Secret.LogEntry.CHANGED
+                                      : Secret.LogEntry.VIEWED);
+        entry.put("type", type);
+        entry.put("time", times[j]);
+        log.put(entry);
+      }
+      json.put("log", log);
+
+      secrets.add(Secret.fromJSON(json));
+    }
+
+    return secrets;
+  }
+}
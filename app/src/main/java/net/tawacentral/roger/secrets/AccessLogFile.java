@@ -0,0 +1,140 @@
+// Copyright (c) 2009, Google Inc.
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//      http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+
+package net.tawacentral.roger.secrets;
+
+import java.io.File;
+import java.util.ArrayList;
+import java.util.HashMap;
+import java.util.List;
+
+import net.tawacentral.roger.secrets.SecurityUtils.CipherInfo;
+
+/**
+ * In memory state of the access log file that sits next to the secrets file.
+ *
+ * The access log file holds the access logs of all secrets, as a sequence of
+ * encrypted frames that are only ever appended to, until the file is
+ * compacted.  Reading it is only needed to show or export a log, so its
+ * entries are read the first time a log is needed and cached here, keyed by
+ * secret id, in chronological order.
+ *
+ * Like Journal, this is only valid as long as nobody else touches the file,
+ * so its expected length is checked before appending to it.
+ */
+class AccessLogFile {
+  private final File file;
+  private final CipherInfo info;
+  private long length = -1;
+  private long baseline;
+  private int flags;
+  private HashMap<Long, ArrayList<Secret.LogEntry>> entries;
+
+  /**
+   * Creates the state of an access log file whose contents are not known
+   * yet.
+   *
+   * @param file The access log file.
+   * @param info The key, salt and rounds the file is encrypted with.
+   */
+  AccessLogFile(File file, CipherInfo info) {
+    this.file = file;
+    this.info = info;
+  }
+
+  /** Returns the access log file. */
+  File getFile() {
+    return file;
+  }
+
+  /** Returns the key, salt and rounds the file is encrypted with. */
+  CipherInfo getCipherInfo() {
+    return info;
+  }
+
+  /**
+   * Returns the length of the valid part of the file, zero if it does not
+   * exist, or -1 if it was not checked yet.
+   */
+  long getLength() {
+    return length;
+  }
+
+  /** Sets the length of the file after it was checked or appended to. */
+  void setLength(long length) {
+    this.length = length;
+  }
+
+  /** Returns the length of the file when it was last compacted. */
+  long getBaseline() {
+    return baseline;
+  }
+
+  /** Sets the length of the file after it was compacted. */
+  void setBaseline(long baseline) {
+    this.baseline = baseline;
+  }
+
+  /** Returns the flags of the file header. */
+  int getFlags() {
+    return flags;
+  }
+
+  /** Sets the flags of the file header. */
+  void setFlags(int flags) {
+    this.flags = flags;
+  }
+
+  /** Have the entries of the file been read? */
+  boolean isLoaded() {
+    return null != entries;
+  }
+
+  /**
+   * Sets the entries read from the file.
+   *
+   * @param entries The entries of each secret, oldest first.
+   */
+  void setEntries(HashMap<Long, ArrayList<Secret.LogEntry>> entries) {
+    this.entries = entries;
+  }
+
+  /**
+   * Returns the entries of the given secret, oldest first, or null if the
+   * file has none or was not read.
+   */
+  List<Secret.LogEntry> getEntries(long id) {
+    return null == entries ? null : entries.get(id);
+  }
+
+  /**
+   * Records entries appended to the file for the given secret.  Does nothing
+   * if the file was not read, since the entries will be read with the rest.
+   *
+   * @param id The id of the secret.
+   * @param appended The entries appended, oldest first.
+   * @param reset True if the entries replace those of the secret.
+   */
+  void append(long id, List<Secret.LogEntry> appended, boolean reset) {
+    if (null == entries)
+      return;
+
+    ArrayList<Secret.LogEntry> list = entries.get(id);
+    if (null == list || reset) {
+      list = new ArrayList<Secret.LogEntry>();
+      entries.put(id, list);
+    }
+    list.addAll(appended);
+  }
+}
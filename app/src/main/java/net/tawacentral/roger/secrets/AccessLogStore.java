@@ -0,0 +1,523 @@
+// Copyright (c) 2009, Google Inc.
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//      http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+
+package net.tawacentral.roger.secrets;
+
+import android.content.Context;
+import android.util.Log;
+
+import net.tawacentral.roger.secrets.SecurityUtils.CipherInfo;
+
+import java.io.BufferedInputStream;
+import java.io.BufferedOutputStream;
+import java.io.ByteArrayOutputStream;
+import java.io.DataInputStream;
+import java.io.EOFException;
+import java.io.File;
+import java.io.FileInputStream;
+import java.io.FileOutputStream;
+import java.io.IOException;
+import java.io.OutputStream;
+import java.io.RandomAccessFile;
+import java.util.ArrayList;
+import java.util.Arrays;
+import java.util.Collections;
+import java.util.HashMap;
+import java.util.List;
+import java.util.zip.Deflater;
+
+/**
+ * The access log file, which holds the access logs of the secrets of the
+ * main secrets file, see flush().  The file is a header followed by encrypted
+ * frames of operations.  The in memory state of the file is an AccessLogFile.
+ */
+class AccessLogStore {
+  /** Tag for logging purposes. */
+  public static final String LOG_TAG = "AccessLogStore";
+
+  /**
+   * Lock for accessing the access log file.  Showing the access log of a
+   * secret only needs this one, so that it does not wait for the rewrite of
+   * the secrets file.  It is taken after FileUtils.lock and JournalStore.lock
+   * when they are needed too.
+   */
+  static final Object lock = new Object();
+
+  // Header and records of the access log file.  Like the journal, it is a
+  // sequence of frames, each holding a sequence of operations.
+  private static final byte[] SIGNATURE_ACCESS_LOG = {0x22, 0x34, 0x56, 0x7C};
+  private static final int ACCESS_LOG_VERSION = 1;
+  private static final int FRAME_ACCESS_LOG = 4;
+  private static final int OP_LOG_ENTRY = 1;
+  private static final int OP_LOG_RESET = 2;
+
+  // The access log file is compacted once it is larger than both this size
+  // and twice its size after the last compaction.  The entries of a
+  // compacted file are split into frames of about this many bytes.
+  private static final long ACCESS_LOG_COMPACT_SIZE = 64 * 1024;
+  private static final int ACCESS_LOG_FRAME_SIZE = 64 * 1024;
+
+  /**
+   * State of the access log file, or null if it was not opened yet.  Guarded
+   * by lock.
+   */
+  private static AccessLogFile accessLog;
+
+  /**
+   * Loads the access log of a secret from the access log file.  The whole
+   * file is read the first time a log is needed, and its entries kept for
+   * the other secrets.  If there is no access log file for the secrets that
+   * were loaded, the secret keeps the entries it knows about.
+   *
+   * This only waits for a save that is writing the access log file, not for
+   * the rewrite of the secrets file.
+   *
+   * @param secret The secret whose access log is needed.
+   */
+  static void load(Secret secret) {
+    synchronized (lock) {
+      if (null == accessLog)
+        return;
+
+      if (!accessLog.isLoaded())
+        read(accessLog);
+      secret.attachAccessLog(accessLog.getEntries(secret.getId()));
+    }
+  }
+
+  /**
+   * Appends the access log entries made since the last save to the access
+   * log file.  This is how views and exports of secrets are saved, since
+   * they change neither the secrets file nor the journal.
+   *
+   * @param context Activity context in which the save is called.
+   * @param info The key, salt and rounds of the secrets file.
+   * @param secrets The secrets of the secrets file.
+   */
+  public static void save(Context context,
+                          CipherInfo info,
+                          ArrayList<Secret> secrets) {
+    flush(context, info, secrets, false);
+  }
+
+  /**
+   * Starts using the access log file for the secrets just loaded.  The file
+   * is only read when one of the logs is needed.
+   *
+   * @param context Activity context in which the load is called.
+   * @param info The key, salt and rounds of the secrets file.
+   */
+  static void open(Context context, CipherInfo info) {
+    synchronized (lock) {
+      accessLog = new AccessLogFile(
+          context.getFileStreamPath(FileUtils.ACCESS_LOG_FILE_NAME), info);
+    }
+  }
+
+  /** Forgets the state of the access log file. */
+  static void reset() {
+    synchronized (lock) {
+      accessLog = null;
+    }
+  }
+
+  /**
+   * Appends the access log entries that the secrets made since the last
+   * flush to the access log file.  Entries are written as OP_LOG_ENTRY
+   * operations holding the secret id, entry type and time.  A secret whose
+   * whole log replaces the one in the file, for example because it was
+   * restored from a backup, is first written as an OP_LOG_RESET operation.
+   * All the operations go into one encrypted frame, so recording that a
+   * secret was viewed does not rewrite any log.
+   *
+   * The file is compacted, keeping only the pruned logs of the given
+   * secrets, when it has grown too much, when it must be encrypted with a
+   * new key, or when it could not be appended to.
+   *
+   * Failing to write the access log does not fail the save: the entries are
+   * kept in the secrets and written by the next flush.
+   *
+   * @param context Activity context in which the save is called.
+   * @param info The key, salt and rounds to use with the file.
+   * @param secrets The secrets being saved.
+   * @param allowCompact Compact the file if it has grown too much.
+   */
+  static void flush(Context context,
+                    CipherInfo info,
+                    ArrayList<Secret> secrets,
+                    boolean allowCompact) {
+    synchronized (lock) {
+      File file = context.getFileStreamPath(FileUtils.ACCESS_LOG_FILE_NAME);
+      if (null == accessLog || !accessLog.getFile().equals(file))
+        accessLog = new AccessLogFile(file, info);
+
+      AccessLogFile state = accessLog;
+      if (state.getLength() < 0 || file.length() != state.getLength()) {
+        if (state.isLoaded())
+          read(state);
+        else
+          check(state, null);
+      }
+
+      boolean compact = state.getLength() < 0 ||
+          !state.getCipherInfo().key.equals(info.key) ||
+          (allowCompact && state.getLength() >
+              Math.max(ACCESS_LOG_COMPACT_SIZE, 2 * state.getBaseline()));
+      if (compact) {
+        compact(state, info, secrets);
+        return;
+      }
+
+      RecordWriter plain = new RecordWriter();
+      plain.writeRawBytes(FrameCodec.PAYLOAD_MAGIC, 0,
+                          FrameCodec.PAYLOAD_MAGIC.length);
+      ArrayList<Secret> flushed = new ArrayList<Secret>();
+      ArrayList<List<Secret.LogEntry>> flushedEntries =
+          new ArrayList<List<Secret.LogEntry>>();
+      ArrayList<Boolean> resets = new ArrayList<Boolean>();
+      for (Secret secret : secrets) {
+        List<Secret.LogEntry> entries;
+        boolean reset;
+        synchronized (secret) {
+          entries = secret.getUnloggedEntries();
+          reset = secret.isLogReset();
+        }
+        if (entries.isEmpty() && !reset)
+          continue;
+
+        if (reset) {
+          plain.writeRawVarint(OP_LOG_RESET);
+          plain.writeRawVarint(secret.getId());
+        }
+        writeEntries(plain, secret.getId(), entries);
+        flushed.add(secret);
+        flushedEntries.add(entries);
+        resets.add(reset);
+      }
+
+      if (flushed.isEmpty())
+        return;
+
+      FileOutputStream output = null;
+      try {
+        ByteArrayOutputStream bytes = new ByteArrayOutputStream();
+        if (0 == state.getLength()) {
+          state.setFlags(
+              Deflater.NO_COMPRESSION != FileUtils.getCompressionLevel()
+              ? FileUtils.FLAG_DEFLATE : 0);
+          bytes.write(createHeader(info, state.getFlags()));
+        }
+        FrameCodec.writeFrame(bytes, FRAME_ACCESS_LOG, FrameCodec.encryptFrame(
+            info, plain, 0 != (state.getFlags() & FileUtils.FLAG_DEFLATE)));
+
+        output = new FileOutputStream(file, true);
+        bytes.writeTo(output);
+        output.flush();
+        output.getFD().sync();
+        state.setLength(state.getLength() + bytes.size());
+      } catch (Exception ex) {
+        Log.e(LOG_TAG, "flush", ex);
+        // The file may now end with a partial frame.  The next flush finds the
+        // valid part of the file again.
+        state.setLength(-1);
+        return;
+      } finally {
+        try {if (null != output) output.close();} catch (IOException ex) {}
+      }
+
+      for (int i = 0; i < flushed.size(); ++i) {
+        Secret secret = flushed.get(i);
+        state.append(secret.getId(), flushedEntries.get(i), resets.get(i));
+        secret.setLogged(flushedEntries.get(i), resets.get(i));
+      }
+      Log.d(LOG_TAG, "AccessLogStore.flush: secrets=" + flushed.size() +
+            " length=" + state.getLength());
+    }
+  }
+
+  /**
+   * Rewrites the access log file with only the pruned logs of the given
+   * secrets, encrypted with the given key.  The new file is written to a
+   * temporary file first, and then renamed over the old one.  The caller
+   * must hold lock.
+   */
+  private static void compact(AccessLogFile state,
+                              CipherInfo info,
+                              ArrayList<Secret> secrets) {
+    if (!state.isLoaded())
+      read(state);
+
+    File file = state.getFile();
+    File temp =
+        new File(file.getParentFile(), "new" + FileUtils.ACCESS_LOG_FILE_NAME);
+    int flags = Deflater.NO_COMPRESSION != FileUtils.getCompressionLevel()
+        ? FileUtils.FLAG_DEFLATE : 0;
+    boolean compress = 0 != flags;
+    HashMap<Long, ArrayList<Secret.LogEntry>> compacted =
+        new HashMap<Long, ArrayList<Secret.LogEntry>>(secrets.size() * 2);
+    ArrayList<List<Secret.LogEntry>> flushedEntries =
+        new ArrayList<List<Secret.LogEntry>>(secrets.size());
+    ArrayList<Boolean> resets = new ArrayList<Boolean>(secrets.size());
+
+    FileOutputStream fos = null;
+    long length;
+    try {
+      fos = new FileOutputStream(temp);
+      OutputStream output = new BufferedOutputStream(fos, 16 * 1024);
+      byte[] header = createHeader(info, flags);
+      output.write(header);
+      length = header.length;
+
+      RecordWriter plain = new RecordWriter(ACCESS_LOG_FRAME_SIZE + 1024);
+      plain.writeRawBytes(FrameCodec.PAYLOAD_MAGIC, 0,
+                          FrameCodec.PAYLOAD_MAGIC.length);
+      for (Secret secret : secrets) {
+        List<Secret.LogEntry> entries;
+        boolean reset;
+        synchronized (secret) {
+          entries = secret.getUnloggedEntries();
+          reset = secret.isLogReset();
+        }
+        flushedEntries.add(entries);
+        resets.add(reset);
+
+        ArrayList<Secret.LogEntry> history = new ArrayList<Secret.LogEntry>();
+        List<Secret.LogEntry> old = state.getEntries(secret.getId());
+        if (!reset && null != old)
+          history.addAll(old);
+        history.addAll(entries);
+        if (history.isEmpty())
+          continue;
+
+        ArrayList<Secret.LogEntry> log = Secret.buildAccessLog(history);
+        Collections.reverse(log);
+        compacted.put(secret.getId(), log);
+        writeEntries(plain, secret.getId(), log);
+
+        if (plain.size() >= ACCESS_LOG_FRAME_SIZE) {
+          length += FrameCodec.writeFrame(
+              output, FRAME_ACCESS_LOG,
+              FrameCodec.encryptFrame(info, plain, compress));
+          plain.reset();
+          plain.writeRawBytes(FrameCodec.PAYLOAD_MAGIC, 0,
+                              FrameCodec.PAYLOAD_MAGIC.length);
+        }
+      }
+      if (plain.size() > FrameCodec.PAYLOAD_MAGIC.length) {
+        length += FrameCodec.writeFrame(
+            output, FRAME_ACCESS_LOG,
+            FrameCodec.encryptFrame(info, plain, compress));
+      }
+
+      output.flush();
+      fos.getFD().sync();
+    } catch (Exception ex) {
+      Log.e(LOG_TAG, "compact", ex);
+      temp.delete();
+      return;
+    } finally {
+      try {if (null != fos) fos.close();} catch (IOException ex) {}
+    }
+
+    if (!temp.renameTo(file)) {
+      Log.d(LOG_TAG, "AccessLogStore.compact: could not move new file");
+      temp.delete();
+      return;
+    }
+
+    AccessLogFile compactedState = new AccessLogFile(file, info);
+    compactedState.setLength(length);
+    compactedState.setBaseline(length);
+    compactedState.setFlags(flags);
+    compactedState.setEntries(compacted);
+    accessLog = compactedState;
+
+    for (int i = 0; i < secrets.size(); ++i)
+      secrets.get(i).setLogged(flushedEntries.get(i), resets.get(i));
+    Log.d(LOG_TAG, "AccessLogStore.compact: secrets=" + compacted.size() +
+          " length=" + length);
+  }
+
+  /** Writes OP_LOG_ENTRY operations for the given entries of a secret. */
+  private static void writeEntries(RecordWriter plain,
+                                   long id,
+                                   List<Secret.LogEntry> entries) {
+    for (Secret.LogEntry entry : entries) {
+      plain.writeRawVarint(OP_LOG_ENTRY);
+      plain.writeRawVarint(id);
+      plain.writeRawVarint(entry.getType());
+      plain.writeRawVarint(entry.getTime());
+    }
+  }
+
+  /** Creates the header of an access log file. */
+  private static byte[] createHeader(CipherInfo info, int flags) {
+    ByteArrayOutputStream header = new ByteArrayOutputStream();
+    header.write(SIGNATURE_ACCESS_LOG, 0, SIGNATURE_ACCESS_LOG.length);
+    header.write(ACCESS_LOG_VERSION);
+    header.write(flags);
+    header.write(info.salt.length);
+    header.write(info.salt, 0, info.salt.length);
+    header.write(info.rounds);
+    return header.toByteArray();
+  }
+
+  /**
+   * Reads all the entries of the access log file into its state.  If the
+   * file cannot be read, the state holds no entries.
+   */
+  private static void read(AccessLogFile state) {
+    HashMap<Long, ArrayList<Secret.LogEntry>> entries =
+        new HashMap<Long, ArrayList<Secret.LogEntry>>();
+    state.setEntries(entries);
+    check(state, entries);
+  }
+
+  /**
+   * Finds the valid part of the access log file.  A file that was not
+   * written with the key of the state is deleted, and a partial frame at
+   * the end of the file, left behind if the process died while appending, is
+   * truncated away.
+   *
+   * @param state The state of the file, whose length is updated.
+   * @param entries If not null, the frames are decrypted and their entries
+   *     added to this map.  Otherwise only the framing is checked.
+   */
+  private static void check(AccessLogFile state,
+                            HashMap<Long, ArrayList<Secret.LogEntry>> entries) {
+    File file = state.getFile();
+    RandomAccessFile output = null;
+    try {
+      long length = file.exists() ? scan(state, entries) : 0;
+      if (0 == length) {
+        if (file.exists() && !file.delete())
+          throw new IOException("Cannot delete stale access log");
+      } else if (length < file.length()) {
+        output = new RandomAccessFile(file, "rw");
+        output.setLength(length);
+      }
+      state.setLength(length);
+    } catch (Exception ex) {
+      Log.e(LOG_TAG, "check", ex);
+      state.setLength(-1);
+    } finally {
+      try {if (null != output) output.close();} catch (IOException ex) {}
+    }
+  }
+
+  /**
+   * Reads the frames of the access log file.  Reading stops at the first
+   * frame that is truncated or cannot be decrypted.
+   *
+   * @return The length of the valid part of the file, or zero if it was not
+   *     written with the key of the state.
+   * @throws IOException if the file cannot be read.
+   */
+  private static long scan(AccessLogFile state,
+                           HashMap<Long, ArrayList<Secret.LogEntry>> entries)
+      throws IOException {
+    CipherInfo info = state.getCipherInfo();
+    DataInputStream input = new DataInputStream(
+        new BufferedInputStream(new FileInputStream(state.getFile())));
+    try {
+      byte[] signature = new byte[SIGNATURE_ACCESS_LOG.length];
+      byte[] salt;
+      int version;
+      int flags;
+      int rounds;
+      try {
+        input.readFully(signature);
+        version = input.readUnsignedByte();
+        flags = input.readUnsignedByte();
+        salt = new byte[input.readUnsignedByte()];
+        input.readFully(salt);
+        rounds = input.readUnsignedByte();
+      } catch (EOFException ex) {
+        return 0;
+      }
+
+      if (!Arrays.equals(signature, SIGNATURE_ACCESS_LOG) ||
+          ACCESS_LOG_VERSION != version ||
+          0 != (flags & ~FileUtils.FLAG_DEFLATE) ||
+          !Arrays.equals(salt, info.salt) || rounds != info.rounds) {
+        Log.d(LOG_TAG, "AccessLogStore.scan: access log is stale");
+        return 0;
+      }
+
+      state.setFlags(flags);
+      boolean compressed = 0 != (flags & FileUtils.FLAG_DEFLATE);
+      long length = SIGNATURE_ACCESS_LOG.length + 3 + salt.length + 1;
+      int frames = 0;
+      for (;;) {
+        int kind = input.read();
+        if (kind < 0)
+          break;
+
+        // Decode the whole frame before applying it, so that a damaged frame
+        // is not applied partially.
+        ArrayList<long[]> ops = new ArrayList<long[]>();
+        int frameLength;
+        try {
+          if (FRAME_ACCESS_LOG != kind)
+            throw new IOException("Unknown frame kind " + kind);
+
+          int payloadLength =
+              FrameCodec.readLength(input, FrameCodec.MAX_FRAME_LENGTH);
+          byte[] payload = new byte[payloadLength];
+          input.readFully(payload);
+          frameLength = 1 + RecordWriter.rawVarintSize(payloadLength) +
+              payloadLength;
+
+          if (null != entries) {
+            RecordReader reader =
+                FrameCodec.decryptFrame(info, payload, compressed);
+            while (reader.hasMore()) {
+              long op = reader.readRawVarint();
+              if (OP_LOG_ENTRY == op) {
+                long id = reader.readRawVarint();
+                long type = reader.readRawVarint();
+                ops.add(new long[] {op, id, type, reader.readRawVarint()});
+              } else if (OP_LOG_RESET == op) {
+                ops.add(new long[] {op, reader.readRawVarint()});
+              } else {
+                throw new IOException("Unknown access log operation " + op);
+              }
+            }
+          }
+        } catch (IOException ex) {
+          Log.w(LOG_TAG, "AccessLogStore.scan: ignoring damaged frame", ex);
+          break;
+        }
+
+        for (long[] op : ops) {
+          ArrayList<Secret.LogEntry> list = entries.get(op[1]);
+          if (OP_LOG_RESET == op[0] || null == list) {
+            list = new ArrayList<Secret.LogEntry>();
+            entries.put(op[1], list);
+          }
+          if (OP_LOG_ENTRY == op[0])
+            list.add(new Secret.LogEntry((int) op[2], op[3]));
+        }
+
+        length += frameLength;
+        ++frames;
+      }
+
+      Log.d(LOG_TAG, "AccessLogStore.scan: frames=" + frames);
+      return length;
+    } finally {
+      try {input.close();} catch (IOException ex) {}
+    }
+  }
+}
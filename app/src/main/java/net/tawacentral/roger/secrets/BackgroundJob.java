@@ -0,0 +1,129 @@
+// Copyright (c) 2009, Google Inc.
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//      http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+
+package net.tawacentral.roger.secrets;
+
+import java.util.concurrent.ExecutorService;
+
+import android.os.Handler;
+import android.os.Looper;
+
+/**
+ * A job done on a worker thread on behalf of an activity, which reports its
+ * progress and result to a listener on the main thread.
+ *
+ * The listener can be replaced, for example when the activity is recreated,
+ * and a listener set after the job finished is told the result right away.
+ * Subclasses do their work in run(), and end it with finish().  The fields
+ * holding the result can be set on the worker thread before calling
+ * finish(), since the main thread only reads them once the job finished.
+ *
+ * All the public methods must be called on the main thread.
+ *
+ * @param <L> The type of the listener.
+ */
+public abstract class BackgroundJob<L> {
+  private final Handler handler = new Handler(Looper.getMainLooper());
+  private volatile boolean cancelled;
+
+  // Only used on the main thread.
+  private L listener;
+  private boolean finished;
+  private boolean delivered;
+
+  protected BackgroundJob(L listener) {
+    this.listener = listener;
+  }
+
+  /** Queues the job on the given worker. */
+  protected void execute(ExecutorService worker) {
+    worker.execute(new Runnable() {
+      @Override
+      public void run() {
+        BackgroundJob.this.run();
+      }
+    });
+  }
+
+  /** Does the work, on the worker thread, ending with finish(). */
+  protected abstract void run();
+
+  /** Tells the listener the result of the job, on the main thread. */
+  protected abstract void onFinished(L listener);
+
+  /**
+   * Runs the given update of the progress on the main thread, unless the job
+   * finished by then.  Called on the worker thread.
+   */
+  protected void postProgress(final Runnable update) {
+    handler.post(new Runnable() {
+      @Override
+      public void run() {
+        if (!finished)
+          update.run();
+      }
+    });
+  }
+
+  /**
+   * Records that the job is done and tells the listener, on the main thread.
+   * Called once, on the worker thread.
+   */
+  protected void finish() {
+    handler.post(new Runnable() {
+      @Override
+      public void run() {
+        finished = true;
+        deliver();
+      }
+    });
+  }
+
+  /** Tells the listener the result of a finished job, if not done yet. */
+  private void deliver() {
+    if (finished && !delivered && null != listener) {
+      delivered = true;
+      onFinished(listener);
+    }
+  }
+
+  /** Returns the listener, or null.  Only used on the main thread. */
+  protected L getListener() {
+    return listener;
+  }
+
+  /**
+   * Sets the listener, or removes it if null.  If the job already finished
+   * and no listener was told, the new one is told right away.
+   */
+  public void setListener(L listener) {
+    this.listener = listener;
+    deliver();
+  }
+
+  /** Asks the job to stop.  The work checks isCancelled() as it goes. */
+  public void cancel() {
+    cancelled = true;
+  }
+
+  /** Was the job cancelled? */
+  public boolean isCancelled() {
+    return cancelled;
+  }
+
+  /** Has the job finished, successfully or not? */
+  public boolean isFinished() {
+    return finished;
+  }
+}
@@ -0,0 +1,189 @@
+// Copyright (c) 2009, Google Inc.
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//      http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+
+package net.tawacentral.roger.secrets;
+
+import java.util.ArrayList;
+import java.util.List;
+import java.util.concurrent.ExecutorService;
+import java.util.concurrent.Executors;
+
+import android.content.Context;
+import android.os.SystemClock;
+import android.util.Log;
+
+import net.tawacentral.roger.secrets.SecurityUtils.CipherInfo;
+
+/**
+ * A backup or CSV export of the secrets to the SD card, done on a worker
+ * thread so that the UI stays responsive however large the vault is.
+ *
+ * The job works on copies of the secrets taken when it starts, see
+ * Secret.snapshot(), and on its own copy of the key, so the activity is free
+ * to modify the list or the secrets, or go away, while the job runs.  Progress and the result are posted
+ * to the listener on the main thread, see BackgroundJob.  A cancelled job
+ * leaves any previous backup or export file as it was, and finishes with
+ * success false.
+ *
+ * Jobs run one at a time, in the order they are started.  All the methods
+ * must be called on the main thread.
+ */
+public class BackupJob extends BackgroundJob<BackupJob.Listener> {
+  /** Kind of job that writes an encrypted backup of the secrets. */
+  public static final int BACKUP = 0;
+  /** Kind of job that exports the secrets in clear to a CSV file. */
+  public static final int EXPORT = 1;
+
+  /** Tag for logging purposes. */
+  public static final String LOG_TAG = "BackupJob";
+
+  // Progress is posted to the listener at most this often.
+  private static final long PROGRESS_INTERVAL_MS = 100;
+
+  /** Receives the progress and the result of a job, on the main thread. */
+  public interface Listener {
+    /** Reports how many secrets and bytes the job wrote so far. */
+    void onProgress(BackupJob job, int records, long bytes);
+
+    /**
+     * Reports that the job is done.  Called once per job.
+     *
+     * @param success False if the job failed or was cancelled.
+     */
+    void onFinished(BackupJob job, boolean success);
+  }
+
+  private static final ExecutorService worker =
+      Executors.newSingleThreadExecutor();
+
+  private final int kind;
+  private final Context context;
+  private final ArrayList<Secret> secrets;
+  private final List<Secret> originals;
+  private final CipherInfo info;
+  private boolean success;  // Set by run() before finish().
+
+  // Only used on the main thread.
+  private int records;
+  private long bytes;
+
+  private BackupJob(Context context, int kind, ArrayList<Secret> secrets,
+                    List<Secret> originals, CipherInfo info,
+                    Listener listener) {
+    super(listener);
+    this.context = context;
+    this.kind = kind;
+    this.secrets = secrets;
+    this.originals = originals;
+    this.info = info;
+  }
+
+  /**
+   * Starts a job on copies of the given secrets.
+   *
+   * @param context The activity starting the job.
+   * @param kind BACKUP or EXPORT.
+   * @param secrets The secrets to write.
+   * @param info The key, salt and rounds to write a backup with.
+   * @param listener Receives the progress and the result, or null.
+   * @return The job, which can be cancelled.
+   */
+  public static BackupJob start(Context context, int kind,
+                                List<Secret> secrets, CipherInfo info,
+                                Listener listener) {
+    ArrayList<Secret> copies = new ArrayList<Secret>(secrets.size());
+    for (Secret secret : secrets)
+      copies.add(secret.snapshot());
+    BackupJob job = new BackupJob(context.getApplicationContext(), kind,
+        copies, new ArrayList<Secret>(secrets), info, listener);
+    job.execute(worker);
+    return job;
+  }
+
+  /** Writes the secrets, on the worker thread. */
+  @Override
+  protected void run() {
+    FileUtils.Progress progress = new FileUtils.Progress() {
+      private long lastPost;
+
+      @Override
+      public boolean update(final int records, final long bytes) {
+        long now = SystemClock.uptimeMillis();
+        if (now - lastPost >= PROGRESS_INTERVAL_MS) {
+          lastPost = now;
+          postProgress(new Runnable() {
+            @Override
+            public void run() {
+              setProgress(records, bytes);
+            }
+          });
+        }
+        return !isCancelled();
+      }
+    };
+
+    long start = SystemClock.uptimeMillis();
+    boolean result = false;
+    if (!isCancelled()) {
+      result = BACKUP == kind
+          ? FileUtils.backupSecrets(context, info, secrets, progress)
+          : FileUtils.exportSecrets(context, secrets, progress);
+    }
+
+    // The export logged the copies, log the secrets themselves.
+    if (result && EXPORT == kind) {
+      for (Secret secret : originals)
+        secret.setExported();
+    }
+    Log.d(LOG_TAG, "BackupJob.run: kind=" + kind + " success=" + result +
+          " time=" + (SystemClock.uptimeMillis() - start));
+
+    success = result;
+    finish();
+  }
+
+  /** Records the progress and tells the listener, on the main thread. */
+  private void setProgress(int records, long bytes) {
+    this.records = records;
+    this.bytes = bytes;
+    Listener listener = getListener();
+    if (null != listener)
+      listener.onProgress(this, records, bytes);
+  }
+
+  @Override
+  protected void onFinished(Listener listener) {
+    listener.onFinished(this, success);
+  }
+
+  /** Returns the kind of the job, BACKUP or EXPORT. */
+  public int getKind() {
+    return kind;
+  }
+
+  /** Returns the number of secrets to write. */
+  public int getTotal() {
+    return secrets.size();
+  }
+
+  /** Returns the number of secrets written so far. */
+  public int getRecords() {
+    return records;
+  }
+
+  /** Returns the number of bytes written so far. */
+  public long getBytes() {
+    return bytes;
+  }
+}
@@ -0,0 +1,58 @@
+// Copyright (c) 2009, Google Inc.
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//      http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+
+package net.tawacentral.roger.secrets;
+
+import java.util.concurrent.atomic.AtomicLong;
+
+/**
+ * Tracks changes made to the secrets in memory with a generation number,
+ * which is incremented every time a secret is modified, gets a new access
+ * log entry that changes it, or is added to or removed from the list.
+ * Access log entries that only record a view or an export do not change the
+ * secrets, and are counted separately.
+ *
+ * SaveService compares the generation against the one it last saved, so that
+ * pausing the app without changing anything does not write any file.
+ */
+class ChangeTracker {
+  private static final AtomicLong generation = new AtomicLong();
+  private static final AtomicLong accesses = new AtomicLong();
+
+  private ChangeTracker() {
+  }
+
+  /** Records that the secrets were modified. */
+  static void changed() {
+    generation.incrementAndGet();
+  }
+
+  /** Returns the current generation of the secrets. */
+  static long getGeneration() {
+    return generation.get();
+  }
+
+  /**
+   * Records that a secret got an access log entry that only goes to the
+   * access log file.
+   */
+  static void accessed() {
+    accesses.incrementAndGet();
+  }
+
+  /** Returns the number of access log entries recorded by accessed(). */
+  static long getAccesses() {
+    return accesses.get();
+  }
+}
@@ -23,6 +23,8 @@ import android.content.Context;
 import android.content.SharedPreferences;
 import android.os.Environment;
 import android.os.ParcelFileDescriptor;
+import android.util.JsonReader;
+import android.util.JsonToken;
 import android.util.Log;
 
 import net.tawacentral.roger.secrets.SecurityUtils.CipherInfo;
@@ -32,22 +34,43 @@ import org.json.JSONException;
 import org.json.JSONObject;
 
 import java.io.BufferedInputStream;
+import java.io.BufferedOutputStream;
+import java.io.BufferedWriter;
 import java.io.ByteArrayOutputStream;
+import java.io.DataInputStream;
+import java.io.EOFException;
 import java.io.File;
 import java.io.FileInputStream;
 import java.io.FileOutputStream;
 import java.io.FileReader;
-import java.io.FileWriter;
+import java.io.FilterOutputStream;
 import java.io.IOException;
 import java.io.InputStream;
+import java.io.InputStreamReader;
+import java.io.InterruptedIOException;
 import java.io.ObjectInputStream;
 import java.io.OutputStream;
+import java.io.OutputStreamWriter;
+import java.io.RandomAccessFile;
+import java.io.Writer;
+import java.nio.ByteBuffer;
 import java.nio.charset.StandardCharsets;
+import java.security.MessageDigest;
+import java.security.SecureRandom;
 import java.text.MessageFormat;
 import java.util.ArrayList;
 import java.util.Arrays;
 import java.util.Date;
 import java.util.List;
+import java.util.Locale;
+import java.util.concurrent.Callable;
+import java.util.concurrent.ExecutionException;
+import java.util.concurrent.ExecutorService;
+import java.util.concurrent.Future;
+import java.util.concurrent.LinkedBlockingQueue;
+import java.util.concurrent.ThreadPoolExecutor;
+import java.util.concurrent.TimeUnit;
+import java.util.zip.Deflater;
 
 import javax.crypto.Cipher;
 import javax.crypto.CipherInputStream;
@@ -78,6 +101,48 @@ public class FileUtils {
     }
     public byte[] salt;
     public int rounds;
+    /**
+     * Version of the binary file format, or 0 for files written with the
+     * older header, whose body may be in any of the V2 to V4 formats.
+     */
+    public int version;
+    /** Flags of the binary file format, 0 for older files. */
+    public int flags;
+    /**
+     * True for a restore point stored as a delta, which can only be read
+     * with loadSecrets() since it needs its base.
+     */
+    public boolean delta;
+    /** Number of bytes read from the start of the file to parse the header. */
+    public int headerLength;
+    /**
+     * Key check value from the header, or null if the file has none, see
+     * checkKey().
+     */
+    public byte[] keyCheck;
+    /**
+     * Cipher suite of the binary file format, SecurityUtils.SUITE_AES_CBC for
+     * files without one in their header.
+     */
+    public int suite;
+    /**
+     * Key derivation function of the file, rounds being its cost.  Kdf.DEFAULT
+     * for files without one in their header.
+     */
+    public Kdf kdf = Kdf.DEFAULT;
+  }
+
+  /**
+   * Receives the progress of a long operation, such as a backup or an export,
+   * and can cancel it.  Called on the thread doing the operation.
+   */
+  public interface Progress {
+    /**
+     * Reports how many secrets and bytes were written so far.
+     *
+     * @return False to cancel the operation.
+     */
+    boolean update(int records, long bytes);
   }
 
   /** Name of the preferences file for backup. */
@@ -99,6 +164,24 @@ public class FileUtils {
   /** Name of the secrets file. */
   public static final String SECRETS_FILE_NAME = "secrets";
 
+  /**
+   * Name of the journal of edits made since the secrets file was last
+   * written, see JournalStore.append().
+   */
+  public static final String JOURNAL_FILE_NAME = "journal";
+
+  /**
+   * Name of the file holding the access logs of the secrets, see
+   * AccessLogStore.flush().
+   */
+  public static final String ACCESS_LOG_FILE_NAME = "accesslog";
+
+  /**
+   * Name of the file describing the secrets file and the restore points,
+   * see getRestorePoints().
+   */
+  public static final String MANIFEST_FILE_NAME = "manifest";
+
   /** Name of the secrets backup file on the SD card. */
   public static final String SECRETS_FILE_NAME_SDCARD =
       Environment.getExternalStorageDirectory().getPath() + "/secrets";
@@ -127,7 +210,7 @@ public class FileUtils {
 
   private static final String EMPTY_STRING = "";
   private static final String INDENT = "   ";
-  private static final String RP_PREFIX = "@";
+  static final String RP_PREFIX = "@";
 
   // secrets ID for JSON
   private static final String JSON_SECRETS_ID = "secrets";
@@ -140,6 +223,88 @@ public class FileUtils {
 
   private static final byte[] SIGNATURE = {0x22, 0x34, 0x56, 0x79};
 
+  // Files in the binary format start with this signature, followed by a
+  // version byte and a flags byte, and then the salt and rounds just like
+  // older files.
+  private static final byte[] SIGNATURE_V5 = {0x22, 0x34, 0x56, 0x7A};
+  private static final int FORMAT_V5 = 5;
+
+  // Flags of the binary format.  FLAG_SEGMENTED means the payload is a
+  // sequence of independently encrypted frames rather than one encrypted
+  // stream, see writeSecrets().  FLAG_DEFLATE means the data of each frame
+  // is compressed before being encrypted.  FLAG_KEY_CHECK means the header
+  // has a length-prefixed key check value, see checkKey().  FLAG_CIPHER_SUITE
+  // means the header ends with the id of the cipher suite of the frames, see
+  // SecurityUtils.createCipher(); without it, frames use AES-CBC.  FLAG_KDF
+  // means the header then has the id of the key derivation function and its
+  // length-prefixed parameters, see Kdf; without it, the key is derived with
+  // bcrypt.  These last three flags are about the header, they do not change
+  // the frames.
+  private static final int FLAG_SEGMENTED = 0x01;
+  static final int FLAG_DEFLATE = 0x02;
+  private static final int FLAG_KEY_CHECK = 0x04;
+  private static final int FLAG_CIPHER_SUITE = 0x08;
+  private static final int FLAG_KDF = 0x10;
+  private static final int HEADER_FLAGS =
+      FLAG_KEY_CHECK | FLAG_CIPHER_SUITE | FLAG_KDF;
+  private static final int KNOWN_FLAGS =
+      FLAG_SEGMENTED | FLAG_DEFLATE | HEADER_FLAGS;
+
+  // Kinds of frames in a segmented file.
+  static final int FRAME_SEGMENT = 1;
+  static final int FRAME_INDEX = 2;
+
+  // A segment holds between SEGMENT_MIN and SEGMENT_MAX secrets.  In between,
+  // a segment ends after any secret whose description hash has its low bits
+  // all zero.  Since boundaries depend on content rather than on position,
+  // inserting or removing a secret only changes the segment it falls in, and
+  // all other segments can be copied as is by the next save.
+  private static final int SEGMENT_MIN = 16;
+  private static final int SEGMENT_MAX = 128;
+  private static final int SEGMENT_MASK = 0x1F;
+
+  // Segmented files of this size are mapped in memory when loaded, instead
+  // of being streamed, see isMappable().  Below the minimum, setting up the
+  // mapping costs more than copying the file.
+  private static final long MAP_MIN_SIZE = 128 * 1024;
+  private static final long MAP_MAX_SIZE = 64 * 1024 * 1024;
+
+  // The segments of a file are decrypted and decoded on up to this many
+  // threads, one per core, see decodeFrames().  The threads exit when idle.
+  private static final int MAX_DECODE_THREADS = 4;
+  private static final int DECODE_THREADS = Math.max(1, Math.min(
+      MAX_DECODE_THREADS, Runtime.getRuntime().availableProcessors()));
+  private static final long DECODE_KEEP_ALIVE_SECONDS = 30;
+  private static ExecutorService decoder;
+
+  /**
+   * Describes the segments of the main secrets file as it was last read or
+   * written by this process, or null if unknown.  Guarded by lock.
+   */
+  private static SegmentIndex segmentIndex;
+
+  /** Compression level used when writing, see setCompressionLevel(). */
+  private static volatile int compressionLevel = Deflater.DEFAULT_COMPRESSION;
+
+  /**
+   * Sets the level of the compression applied to secrets before they are
+   * encrypted.  Files are always readable whatever the level they were
+   * written with.
+   *
+   * @param level From 0, which disables compression, to 9 for the best
+   *     compression.  Any other value selects the default level.
+   */
+  public static void setCompressionLevel(int level) {
+    if (level < Deflater.NO_COMPRESSION || level > Deflater.BEST_COMPRESSION)
+      level = Deflater.DEFAULT_COMPRESSION;
+    compressionLevel = level;
+  }
+
+  /** Returns the compression level set with setCompressionLevel(). */
+  static int getCompressionLevel() {
+    return compressionLevel;
+  }
+
   /** Does the secrets file exist? */
   public static boolean secretsExist(Context context) {
     // Instead of just checking for the existence of the secrets file
@@ -225,15 +390,6 @@ public class FileUtils {
     return false;
   }
 
-  /** Is the restore point too old? */
-  private static boolean isRestorePointTooOld(File file) {
-    long lastModified = file.lastModified();
-    long now = System.currentTimeMillis();
-    long twoDays = 2 * 24 * 60 * 60 * 1000;  // 2 days.
-
-    return (now - lastModified) > twoDays;
-  }
-
   /**
    * Get all existing restore points, including the restore file on the SD card
    * if it exists.
@@ -242,8 +398,7 @@ public class FileUtils {
    * @return A list of all possible restore points.
    */
   public static List<String> getRestorePoints(Context context) {
-    String[] filenames = context.fileList();
-    ArrayList<String> list = new ArrayList<String>(filenames.length + 2);
+    ArrayList<String> list = new ArrayList<String>();
 
     if (restoreFileExist())
       list.add(SECRETS_FILE_NAME_SDCARD);
@@ -256,7 +411,20 @@ public class FileUtils {
     if (rpDownload.exists())
       list.add(rpDownload.getAbsolutePath());
 
-    for (String filename : filenames) {
+    // The manifest lists the restore points, most recent first, without
+    // having to look at each file.  Without a key it cannot be read.
+    CipherInfo info = SecurityUtils.getCipherInfo();
+    if (null != info) {
+      synchronized (lock) {
+        for (RestorePoint point : RestorePointManifest.read(context, info)) {
+          if (point.getName().startsWith(RP_PREFIX))
+            list.add(point.getName());
+        }
+      }
+      return list;
+    }
+
+    for (String filename : context.fileList()) {
       if (filename.startsWith(RP_PREFIX))
         list.add(filename);
     }
@@ -264,6 +432,31 @@ public class FileUtils {
     return list;
   }
 
+  /**
+   * Gets the description of a restore point from the manifest, without
+   * decrypting it.
+   *
+   * @param context Activity context in which the restore is called.
+   * @param name The name of the restore point, as returned by
+   *     getRestorePoints().
+   * @return The description, or null if the restore point is not in the
+   *     manifest, for example if it is not in the application's data
+   *     directory.
+   */
+  public static RestorePoint getRestorePoint(Context context, String name) {
+    CipherInfo info = SecurityUtils.getCipherInfo();
+    if (null == info)
+      return null;
+
+    synchronized (lock) {
+      for (RestorePoint point : RestorePointManifest.read(context, info)) {
+        if (point.getName().equals(name))
+          return point;
+      }
+    }
+    return null;
+  }
+
   /**
    * Cleanup any residual data files from a previous bad run, if any.  The
    * algorithm is as follows:
@@ -271,9 +464,11 @@ public class FileUtils {
    * - delete any file with "new" in the name.  These are possibly partial
    *   writes, so their contents is undefined.
    * - if no secrets file exists, rename the most recent auto restore point
-   *   file to secrets.
-   * - if too many auto restore point files exist, delete the extra ones.
-   *   However, don't delete any auto-backups younger than 48 hours.
+   *   file to secrets.  If it is a delta, loadSecrets() rebuilds it from its
+   *   base, and the next save writes it as a full copy.
+   *
+   * Extra restore points are deleted by saveSecrets(), using the restore
+   * point manifest, see RestorePointManifest.applyRetention().
    *
    * @param context Activity context in which the save is called.
    */
@@ -281,74 +476,33 @@ public class FileUtils {
     Log.d(LOG_TAG, "FileUtils.cleanupDataFiles");
     synchronized (lock) {
       String[] filenames = context.fileList();
-      int oldCount = filenames.length;
       boolean secretsFileExists = context.getFileStreamPath(SECRETS_FILE_NAME)
           .exists();
 
       // Cleanup any partial saves and find the most recent auto-backup file.
-      {
-        File mostRecent = null;
-        int mostRecentIndex = -1;
-        for (int i = 0; i < filenames.length; ++i) {
-          String filename = filenames[i];
-          if (0 == filename.indexOf("new")) {
-            // This is a partial write file, probably corrupted.  Delete it.
-            context.deleteFile(filename);
-            --oldCount;
-            filenames[i] = null;
-          } else if (filename.startsWith(RP_PREFIX)) {
-            // This is an auto-backup file.  Remember most recent.
-            if (!secretsFileExists) {
-              File f = context.getFileStreamPath(filename);
-              if (null == mostRecent ||
-                  f.lastModified() > mostRecent.lastModified()) {
-                mostRecent = f;
-                mostRecentIndex = i;
-              }
-            }
-          } else {
-            --oldCount;
-            filenames[i] = null;
-          }
-        }
-
-        // If we don't have a secrets file but found an auto-backup file,
-        // rename the more recent auto-backup to secrets.
-        if (null != mostRecent) {
-          mostRecent.renameTo(context.getFileStreamPath(SECRETS_FILE_NAME));
-          --oldCount;
-          filenames[mostRecentIndex] = null;
-        }
-      }
-
-      // If there are too many old files, delete the oldest extra ones.
-      while (oldCount > 10) {
-        File oldest = null;
-        int oldestIndex = -1;
-
-        for (int i = 0; i < filenames.length; ++i) {
-          String filename = filenames[i];
-          if (null == filename)
-            continue;
-
+      File mostRecent = null;
+      for (String filename : filenames) {
+        if (0 == filename.indexOf("new")) {
+          // This is a partial write file, probably corrupted.  Delete it.
+          context.deleteFile(filename);
+        } else if (!secretsFileExists && filename.startsWith(RP_PREFIX)) {
+          // This is an auto-backup file.  Remember most recent.
           File f = context.getFileStreamPath(filename);
-          if (null == oldest || f.lastModified() < oldest.lastModified()) {
-            oldest = f;
-            oldestIndex = i;
+          if (null == mostRecent ||
+              f.lastModified() > mostRecent.lastModified()) {
+            mostRecent = f;
           }
         }
+      }
 
-        if (null != oldest) {
-          // If the oldest file is not too old, then just break out of the
-          // loop.  We don't want to delete any "old" files that are too
-          // recent.
-          if (!FileUtils.isRestorePointTooOld(oldest))
-            break;
-
-          oldest.delete();
-          --oldCount;
-          filenames[oldestIndex] = null;
-        }
+      // If we don't have a secrets file but found an auto-backup file,
+      // rename the more recent auto-backup to secrets.
+      if (null != mostRecent) {
+        segmentIndex = null;
+        RestorePointManifest.reset();
+        VaultFile.clearCache();
+        JournalStore.delete(context);
+        mostRecent.renameTo(context.getFileStreamPath(SECRETS_FILE_NAME));
       }
     }
   }
@@ -365,23 +519,45 @@ public class FileUtils {
    */
   public static SaltAndRounds getSaltAndRounds(Context context, String path) {
     // The salt is stored as a byte array at the start of the secrets file.
-    FileInputStream input = null;
+    VaultFile vault = openVault(context, path);
+    if (null == vault)
+      return new SaltAndRounds(null, 0);
+
     try {
-      input = path.startsWith("/")
-          ? new FileInputStream(path)
-          : context.openFileInput(path);
-      return getSaltAndRounds(input);
-    } catch (Exception ex) {
-      Log.e(LOG_TAG, "getSaltAndRounds", ex);
+      return vault.getSaltAndRounds();
     } finally {
-      try {if (null != input) input.close();} catch (IOException ex) {}
+      vault.close();
+    }
+  }
+
+  /**
+   * Opens a secrets file and parses its header, so that the salt and rounds
+   * can be used to derive the key before the body is decrypted from the same
+   * file handle with loadSecrets().
+   *
+   * @param context Activity context in which the load is called.
+   * @param path The file to open.  Can either be the string
+   *     SECRETS_FILE_NAME_SDCARD, SECRETS_FILE_NAME, or the name of a restore
+   *     point.
+   * @return The open file, which the caller must close, or null if it cannot
+   *     be opened, for example because it does not exist.
+   */
+  public static VaultFile openVault(Context context, String path) {
+    File file = path.startsWith("/")
+        ? new File(path)
+        : context.getFileStreamPath(path);
+    try {
+      return VaultFile.open(file);
+    } catch (IOException ex) {
+      Log.d(LOG_TAG, "FileUtils.openVault: cannot open " + path, ex);
+      return null;
     }
-    return new SaltAndRounds(null, 0);
   }
 
   /**
    * Gets the salt and rounds already in use on this device, or null if none
-   * exists.
+   * exists.  A file too short to hold the header it starts with has no valid
+   * header, and gets no salt either.
    *
    * @param input The stream to read the salt and rounds from.
    * @return the salt and rounds
@@ -391,40 +567,112 @@ public class FileUtils {
   public static SaltAndRounds getSaltAndRounds(InputStream input)
       throws IOException {
     // The salt is stored as a byte array at the start of the secrets file.
+    DataInputStream data = new DataInputStream(input);
     byte[] signature = new byte[SIGNATURE.length];
     byte[] salt = null;
     int rounds = 0;
-    input.read(signature);
-    if (Arrays.equals(signature, SIGNATURE)) {
-      int length = input.read();
-      salt = new byte[length];
-      input.read(salt);
-      rounds = input.read();
-      if (rounds < 4 || rounds > 31) {
-        salt = null;
-        rounds = 0;
+    int version = 0;
+    int flags = 0;
+    byte[] keyCheck = null;
+    int suite = SecurityUtils.SUITE_AES_CBC;
+    Kdf kdf = Kdf.DEFAULT;
+    int headerLength = signature.length;
+    boolean isDelta;
+    try {
+      data.readFully(signature);
+      boolean isV5 = Arrays.equals(signature, SIGNATURE_V5);
+      isDelta = Arrays.equals(signature, RestorePointDeltas.SIGNATURE_DELTA);
+      if (isV5 || isDelta) {
+        version = data.readUnsignedByte();
+        flags = data.readUnsignedByte();
+        headerLength += 2;
       }
+      if ((isV5 && FORMAT_V5 == version) ||
+          (isDelta && RestorePointDeltas.DELTA_VERSION == version) ||
+          Arrays.equals(signature, SIGNATURE)) {
+        int length = data.readUnsignedByte();
+        salt = new byte[length];
+        data.readFully(salt);
+        rounds = data.readUnsignedByte();
+        headerLength += 2 + length;
+        if (rounds < 4 || rounds > 31) {
+          salt = null;
+          rounds = 0;
+        }
+        if (0 != (flags & FLAG_KEY_CHECK)) {
+          length = data.readUnsignedByte();
+          keyCheck = new byte[length];
+          data.readFully(keyCheck);
+          headerLength += 1 + length;
+        }
+        if (0 != (flags & FLAG_CIPHER_SUITE)) {
+          suite = data.readUnsignedByte();
+          headerLength += 1;
+        }
+        if (0 != (flags & FLAG_KDF)) {
+          int id = data.readUnsignedByte();
+          length = data.readUnsignedByte();
+          byte[] params = new byte[length];
+          data.readFully(params);
+          headerLength += 2 + params.length;
+          kdf = Kdf.decode(id, params);
+          if (null == kdf) {
+            kdf = Kdf.DEFAULT;
+            salt = null;
+            rounds = 0;
+          }
+        }
+      }
+    } catch (EOFException ex) {
+      Log.d(LOG_TAG, "FileUtils.getSaltAndRounds: truncated header");
+      return new SaltAndRounds(null, 0);
     }
 
-    return new SaltAndRounds(salt, rounds);
+    SaltAndRounds pair = new SaltAndRounds(salt, rounds);
+    pair.version = version;
+    pair.flags = flags;
+    pair.delta = isDelta;
+    pair.headerLength = headerLength;
+    pair.keyCheck = keyCheck;
+    pair.suite = suite;
+    pair.kdf = kdf;
+    return pair;
+  }
+
+  /**
+   * Checks the key of the given ciphers against the key check value in the
+   * header of a file, without decrypting anything.  Files written before key
+   * check values existed cannot be checked this way.
+   *
+   * @param pair The header of the file.
+   * @param info The ciphers, created with the salt and rounds of the header.
+   * @return False if the key is certainly wrong, true if it is right or if
+   *     the file has no key check value.
+   */
+  public static boolean checkKey(SaltAndRounds pair, CipherInfo info) {
+    if (null == pair.keyCheck)
+      return true;
+    if (null == info || null == info.key || null == info.salt)
+      return false;
+    return SecurityUtils.isKeyCheckValid(info.key, info.salt, pair.keyCheck);
   }
 
   /**
    * Saves the secrets to file using the password retrieved from the user.
    *
+   * The journal may be appended to while the file is written, with changes
+   * made after the given secrets were collected.  They are appended again to
+   * the new journal that replaces it, see JournalStore.append().
+   *
    * @param context Activity context in which the save is called.
    * @param existing The file to save into.
-   * @param cipher The encryption cipher to use with the file.
-   * @param salt The salt used to create the cipher.
-   * @param rounds The number of rounds for bcrypt.
+   * @param info The key, salt and rounds to use with the file.
    * @param secrets The collection of secrets to save.
    * @return True if saved successfully.
    */
   public static int saveSecrets(Context context,
                                 File existing,
-                                Cipher cipher,
-                                byte[] salt,
-                                int rounds,
+                                CipherInfo info,
                                 ArrayList<Secret> secrets) {
     Log.d(LOG_TAG, "FileUtils.saveSecrets");
     synchronized (lock) {
@@ -435,14 +683,20 @@ public class FileUtils {
       //
       //  1- write the secrets to a new temporary file (tempn)
       //     on error: delete tempn
-      //  2- rename the existing secrets file, if any (to tempo)
+      //  2- rename the existing secrets file, if any (to tempo), or write
+      //     the delta of the existing file to tempo
       //     on error: delete tempn
       //  3- rename the new temporary file to the official file name
-      //     on error: rename tempo back to existing, delete tempn
+      //     on error: rename tempo back to existing, or delete the delta,
+      //     delete tempn
       //
-      // Old files will hang around for a while.  The cleanupDataFiles()
-      // method, which is called whenever Secrets is re-launched, will make
-      // sure that the old files don't accumulate indefinitely.
+      // Old files will hang around for a while.  The restore point manifest
+      // is updated after step 3, which makes sure that the old files don't
+      // accumulate indefinitely.
+      //
+      // Segments of the existing file that hold only unmodified secrets are
+      // copied into tempn as is, so step 1 only serializes and encrypts what
+      // changed.  The existing file itself is never modified in place.
       String prefix = MessageFormat.format(RP_PREFIX +
           "{0,date,yy.MM.dd}-{0,time,HH:mm}", new Date(),
           null);
@@ -453,11 +707,23 @@ public class FileUtils {
         tempn = new File(parent, "new" + i);
         tempo = new File(parent, prefix + i);
       }
+      SegmentIndex previous = segmentIndex;
+      SegmentIndex index = new SegmentIndex(existing, info.key);
+      segmentIndex = null;
+
       // Step 1
       FileOutputStream fos = null;
+      RandomAccessFile source = null;
       try {
+        if (null != previous && previous.isValidFor(existing, info.key))
+          source = new RandomAccessFile(existing, "r");
         fos = new FileOutputStream(tempn);
-        writeSecrets(fos, cipher, salt, rounds, secrets);
+        writeSecrets(fos, info, secrets, false, index, previous, source,
+                     null);
+        // Step 3 deletes the old journal, whose edits are only in tempn from
+        // then on, so tempn must be on disk before it replaces the existing
+        // file.
+        fos.getFD().sync();
       } catch (Exception ex) {
         Log.d(LOG_TAG, "FileUtils.saveSecrets: could not write secrets file");
         // NOTE: this delete() works, even though the file is still open.
@@ -465,23 +731,60 @@ public class FileUtils {
         return R.string.error_save_secrets;
       } finally {
         try {if (null != fos) fos.close();} catch (IOException ex) {}
+        try {if (null != source) source.close();} catch (IOException ex) {}
       }
 
       // Step 2
-      if (existing.exists() && !existing.renameTo(tempo)) {
+      //
+      // If the existing file holds the same secrets as the latest restore
+      // point, keeping it would only add a copy of that restore point.  In
+      // that case step 3 replaces it directly, which is atomic.  Likewise
+      // when the restore point is written as a delta.
+      boolean main = existing.equals(context.getFileStreamPath(
+          SECRETS_FILE_NAME));
+      RestorePoint delta = null;
+      if (main && RestorePointManifest.isDuplicate(context, info, existing)) {
+        Log.d(LOG_TAG, "FileUtils.saveSecrets: same as last restore point");
+      } else if (main && null != (delta = RestorePointDeltas.write(
+          context, info, existing, previous, tempo))) {
+        Log.d(LOG_TAG, "FileUtils.saveSecrets: wrote delta restore point");
+      } else if (existing.exists() && !existing.renameTo(tempo)) {
         Log.d(LOG_TAG, "FileUtils.saveSecrets: could not move existing file");
         tempn.delete();
         return R.string.error_cannot_move_existing;
       }
 
       // Step 3
-      if (!tempn.renameTo(existing)) {
-        Log.d(LOG_TAG, "FileUtils.saveSecrets: could not move new file");
-        tempo.renameTo(existing);
-        tempn.delete();
-        return R.string.error_cannot_move_new;
+      //
+      // Once the new file is in place, the next load ignores the old journal,
+      // since it does not match the new base id.  So no append may happen
+      // until the new journal is started.
+      synchronized (JournalStore.lock) {
+        if (!tempn.renameTo(existing)) {
+          Log.d(LOG_TAG, "FileUtils.saveSecrets: could not move new file");
+          if (null != delta)
+            tempo.delete();
+          else
+            tempo.renameTo(existing);
+          tempn.delete();
+          return R.string.error_cannot_move_new;
+        }
+
+        index.setFileState(existing);
+        segmentIndex = index;
+        VaultFile.clearCache();
+
+        // The new file holds all the edits of the given secrets, so start a
+        // new journal for it.
+        JournalStore.restart(context, info, new File(parent, JOURNAL_FILE_NAME),
+                             main ? previous : null, index);
       }
 
+      if (main) {
+        RestorePointManifest.update(context, info, existing, tempo, delta,
+                                    index, secrets.size());
+      }
+      AccessLogStore.flush(context, info, secrets, true);
       Log.d(LOG_TAG, "FileUtils.saveSecrets: done");
       return 0;
     }
@@ -491,37 +794,94 @@ public class FileUtils {
    * Backup the secrets to SD card using the password retrieved from the user.
    *
    * @param context Activity context in which the backup is called.
-   * @param cipher The encryption cipher to use with the file.
-   * @param salt The salt used to create the cipher.
-   * @param rounds The number of rounds for bcrypt.
+   * @param info The key, salt and rounds to use with the file.
    * @param secrets The list of secrets to save.
    * @return True if saved successfully
    */
   public static boolean backupSecrets(Context context,
-                                      Cipher cipher,
-                                      byte[] salt,
-                                      int rounds,
+                                      CipherInfo info,
                                       ArrayList<Secret> secrets) {
+    return backupSecrets(context, info, secrets, null);
+  }
+
+  /**
+   * Backup the secrets to SD card, reporting progress as the secrets are
+   * written.  The backup is written to a new file that replaces the previous
+   * backup once complete, so a failed or cancelled backup leaves the
+   * previous one untouched.
+   *
+   * @param context Activity context in which the backup is called.
+   * @param info The key, salt and rounds to use with the file.
+   * @param secrets The list of secrets to save.
+   * @param progress Receives the progress and can cancel the backup, or null.
+   * @return True if saved successfully
+   */
+  public static boolean backupSecrets(Context context,
+                                      CipherInfo info,
+                                      ArrayList<Secret> secrets,
+                                      Progress progress) {
     Log.d(LOG_TAG, "FileUtils.backupSecrets");
 
-    if (null == cipher)
+    if (null == info)
       return false;
 
+    File file = new File(SECRETS_FILE_NAME_SDCARD);
+    File temp = new File(file.getParentFile(), "new" + file.getName());
     FileOutputStream output = null;
     boolean success = false;
 
     try {
-    	output = new FileOutputStream(SECRETS_FILE_NAME_SDCARD);
-      writeSecrets(output, cipher, salt, rounds, secrets);
-      success = true;
+      // The backup does not come with the access log file, so it holds the
+      // access logs in its records.
+      for (Secret secret : secrets)
+        secret.getAccessLog();
+
+      output = new FileOutputStream(temp);
+      writeSecrets(output, info, secrets, true, null, null, null, progress);
+      output.close();
+      output = null;
+      success = temp.renameTo(file);
     } catch (Exception ex) {
+      Log.d(LOG_TAG, "FileUtils.backupSecrets: " + ex.getMessage());
     } finally {
       try {if (null != output) output.close();} catch (IOException ex) {}
+      if (!success)
+        temp.delete();
     }
 
     return success;
   }
 
+  /**
+   * Reports progress, if there is anyone to report it to.
+   *
+   * @throws InterruptedIOException if the operation was cancelled.
+   */
+  private static void reportProgress(Progress progress, int records,
+                                     long bytes) throws IOException {
+    if (null != progress && !progress.update(records, bytes))
+      throw new InterruptedIOException("Cancelled");
+  }
+
+  /**
+   * Writes the restore point manifest with a new key when the password
+   * changes, with the entries read with the previous key, so that they are
+   * not replaced by entries from RestorePointManifest.unknownRestorePoint().
+   *
+   * @param context Activity context.
+   * @param previous The key, salt and rounds of the current secrets file.
+   * @param info The new key, salt and rounds.
+   */
+  public static void rewriteManifest(Context context,
+                                     CipherInfo previous,
+                                     CipherInfo info) {
+    Log.d(LOG_TAG, "FileUtils.rewriteManifest");
+    synchronized (lock) {
+      RestorePointManifest.write(context, info,
+                                 RestorePointManifest.read(context, previous));
+    }
+  }
+
   /* start new load/restore methods */
 
   /*
@@ -537,7 +897,9 @@ public class FileUtils {
    * stored values, the file format (F2) differs from V1.
    * V3 used a modified version of the V2 cipher (password fix) (C3), and the same
    * file format as V2.
-   * Current (V4): uses same V3 cipher mechanism, and JSON file format (F3)
+   * V4 uses same V3 cipher mechanism, and JSON file format (F3)
+   * Current (V5): uses the V3 key derivation with a random IV per file (C5),
+   * and a binary record format (F5) with its own signature and version byte.
    *
    * Pictorially:
    *                 Cipher format
@@ -549,6 +911,13 @@ public class FileUtils {
    * format   F2 |      |  V2  |  V3
    *          ---|------|------|------
    *          F3 |      |      |  V4
+   *
+   * V5 files use C5/F5 only.  They are recognized by their signature, so they
+   * never go through the fallbacks above.
+   *
+   * loadSecrets() reads V5 and V4 files.  When it fails, loadLegacySecrets()
+   * uses the header to pick the only other format the file can be in, so
+   * that a wrong password costs at most one more key derivation.
    */
 
   /**
@@ -558,10 +927,71 @@ public class FileUtils {
    * @return A list of loaded secrets.
    */
   public static ArrayList<Secret> loadSecrets(Context context) {
+    VaultFile vault = openVault(context, SECRETS_FILE_NAME);
+    try {
+      return loadSecrets(context, vault);
+    } finally {
+      if (null != vault)
+        vault.close();
+    }
+  }
+
+  /**
+   * Opens the secrets file using the password retrieved from the user,
+   * reading it from a file already opened with openVault(), whose header
+   * gave the salt and rounds of the password.
+   *
+   * @param context Activity context in which the load is called.
+   * @param vault The secrets file, as returned by openVault() for
+   *     SECRETS_FILE_NAME, or null if it could not be opened.
+   * @return A list of loaded secrets.
+   */
+  public static ArrayList<Secret> loadSecrets(Context context,
+                                              VaultFile vault) {
     synchronized (lock) {
       Log.d(LOG_TAG, "FileUtils.loadSecrets: got lock");
-      return loadSecrets(context, SECRETS_FILE_NAME,
-          SecurityUtils.getCipherInfo());
+      CipherInfo info = SecurityUtils.getCipherInfo();
+      File file = context.getFileStreamPath(SECRETS_FILE_NAME);
+      SegmentIndex index = null == info ? null : new SegmentIndex(file, info.key);
+      segmentIndex = null;
+      JournalStore.reset();
+      AccessLogStore.reset();
+
+      // A save may have replaced the file since it was opened.
+      ArrayList<Secret> secrets;
+      boolean delta;
+      if (null != vault && !vault.isCurrent()) {
+        VaultFile current = openVault(context, SECRETS_FILE_NAME);
+        try {
+          secrets = loadSecrets(context, current, info, index);
+          delta = null != current && current.getSaltAndRounds().delta;
+        } finally {
+          if (null != current)
+            current.close();
+        }
+      } else {
+        secrets = loadSecrets(context, vault, info, index);
+        delta = null != vault && vault.getSaltAndRounds().delta;
+      }
+      // A delta restore point recovered by cleanupDataFiles() must be
+      // written as a full copy by the next save.
+      if (null != secrets && delta)
+        ChangeTracker.changed();
+      // The access logs are only read when one of them is needed.
+      if (null != secrets)
+        AccessLogStore.open(context, info);
+      // Files written before secrets had ids have no base id.  Their secrets
+      // get new ids, so the first save must rewrite the whole file.
+      if (null != secrets && null != index && 0 != index.getBaseId()) {
+        // Remember the layout of the file so that the next save can reuse
+        // the segments that don't change.
+        index.setFileState(file);
+        segmentIndex = index;
+
+        // Apply the edits made since the file was written.
+        JournalStore.load(context, info, index.getBaseId(), secrets);
+      }
+      return secrets;
     }
   }
 
@@ -575,27 +1005,70 @@ public class FileUtils {
    */
   public static ArrayList<Secret> loadSecrets(Context context,
       String fileName, CipherInfo info) {
+    if (null == info)
+      return null;
+
+    VaultFile vault = openVault(context, fileName);
+    try {
+      return loadSecrets(context, vault, info, null);
+    } finally {
+      if (null != vault)
+        vault.close();
+    }
+  }
+
+  /**
+   * Opens a secrets file or restore point already opened with openVault(),
+   * whose header gave the salt and rounds of the password.
+   *
+   * @param context Activity context in which the load is called.
+   * @param vault The file to be loaded, or null if it could not be opened.
+   * @param info CipherInfo
+   * @return A list of loaded secrets.
+   */
+  public static ArrayList<Secret> loadSecrets(Context context,
+      VaultFile vault, CipherInfo info) {
+    return loadSecrets(context, vault, info, null);
+  }
+
+  /**
+   * See previous method for description.
+   *
+   * @param context Activity context in which the load is called.
+   * @param vault The file to be loaded, or null if it could not be opened.
+   * @param info CipherInfo
+   * @param index If not null, filled in with the segments of the file.
+   * @return A list of loaded secrets.
+   */
+  private static ArrayList<Secret> loadSecrets(Context context,
+      VaultFile vault, CipherInfo info, SegmentIndex index) {
     Log.d(LOG_TAG, "FileUtils.loadSecrets");
 
-    if (null == info)
+    if (null == info || null == vault)
       return null;
 
-    ArrayList<Secret> secrets = null;
-    InputStream input = null;
+    // The header was parsed when the file was opened.  If it has a key
+    // check value, a wrong password is rejected without reading further.
+    SaltAndRounds pair = vault.getSaltAndRounds();
+    if (!checkKey(pair, info)) {
+      Log.d(LOG_TAG, "FileUtils.loadSecrets: wrong password");
+      return null;
+    }
 
+    ArrayList<Secret> secrets = null;
     try {
-      input = fileName.startsWith("/")
-          ? new FileInputStream(fileName)
-          : context.openFileInput(fileName);
-      secrets = readSecrets(input, info.decryptCipher, info.salt, info.rounds);
+      // Restore points may be deltas, which are rebuilt from their base.
+      // Large files are decrypted straight from memory mapped pages.
+      if (pair.delta) {
+        secrets =
+            RestorePointDeltas.read(context, pair, vault.openBody(), info);
+      } else if (isMappable(pair, vault.getFile().length())) {
+        secrets = readMappedSecrets(pair, vault.map(), info, index);
+      } else {
+        secrets = readSecrets(pair, vault.openBody(), info, index);
+      }
     } catch (Exception ex) {
       Log.e(LOG_TAG, "loadSecrets", ex);
-    } finally {
-      try {
-        if (null != input)
-          input.close();
-      } catch (IOException ex) {
-      }
     }
     Log.d(LOG_TAG, "FileUtils.loadSecrets: done");
     return secrets;
@@ -753,7 +1226,8 @@ public class FileUtils {
       input = fileName.startsWith("/")
           ? new FileInputStream(fileName)
           : context.openFileInput(fileName);
-      secrets = readSecretsV2(input, info.decryptCipher, info.salt, info.rounds);
+      secrets = readSecretsV2(input, info.createDecryptCipher(), info.salt,
+                              info.rounds);
     } catch (Exception ex) {
       Log.e(LOG_TAG, "loadSecretsV3", ex);
     } finally {
@@ -767,13 +1241,298 @@ public class FileUtils {
     return secrets;
   }
 
+  /**
+   * Opens a secrets file in one of the older formats, after loadSecrets()
+   * failed with the same password.  Only the format that the file can be in
+   * is tried, see the description of the formats above:
+   *
+   * - a file with the V5 header is never in an older format, so the password
+   *   is wrong
+   * - a file without a known header can only be V1
+   * - a file with the older header is V3 if its first block decrypts to a
+   *   serialized object with the current cipher, and can only be V2
+   *   otherwise, since loadSecrets() already tried V4
+   *
+   * @param context Activity context in which the load is called.
+   * @param fileName Name of file to be loaded.
+   * @param pair The header of the file.
+   * @param info The ciphers of the password, created with the salt and
+   *     rounds of the header.
+   * @param password The password, for the older ciphers.
+   * @return A list of loaded secrets, or null if the file cannot be read
+   *     with the password.
+   */
+  public static ArrayList<Secret> loadLegacySecrets(Context context,
+                                                    String fileName,
+                                                    SaltAndRounds pair,
+                                                    CipherInfo info,
+                                                    String password) {
+    if (pair.delta || 0 != pair.version)
+      return null;
+
+    synchronized (lock) {
+      if (null == pair.salt) {
+        Log.d(LOG_TAG, "FileUtils.loadLegacySecrets: trying V1");
+        return loadSecretsV1(context,
+            SecurityUtils.createDecryptionCipherV1(password), fileName);
+      }
+
+      if (isObjectStream(context, fileName, pair, info)) {
+        Log.d(LOG_TAG, "FileUtils.loadLegacySecrets: trying V3");
+        return loadSecretsV3(context, info, fileName);
+      }
+
+      Log.d(LOG_TAG, "FileUtils.loadLegacySecrets: trying V2");
+      Cipher cipher = SecurityUtils.createDecryptionCipherV2(password,
+          pair.salt, pair.rounds);
+      return loadSecretsV2(context, fileName, cipher, pair.salt, pair.rounds);
+    }
+  }
+
+  /**
+   * Does the body of a file with the older header decrypt to a serialized
+   * object with the given ciphers?  Only the first block is decrypted.
+   */
+  private static boolean isObjectStream(Context context,
+                                        String fileName,
+                                        SaltAndRounds pair,
+                                        CipherInfo info) {
+    VaultFile vault = openVault(context, fileName);
+    if (null == vault || null == info || null == info.key)
+      return false;
+
+    try {
+      // In decrypt mode, the cipher holds back the last block it was given
+      // in case it is padding, so give it two.
+      byte[] blocks = new byte[2 * SecurityUtils.IV_LENGTH];
+      new DataInputStream(vault.openBody()).readFully(blocks);
+      Cipher cipher = FrameCodec.createCipher(
+          Cipher.DECRYPT_MODE, withSuite(info, pair),
+          new byte[SecurityUtils.IV_LENGTH]);
+      byte[] plain = cipher.update(blocks);
+      return null != plain && plain.length >= 2 &&
+          (byte) 0xAC == plain[0] && (byte) 0xED == plain[1];
+    } catch (IOException ex) {
+      return false;
+    } finally {
+      vault.close();
+    }
+  }
+
   /* end new load/restore methods */
 
   /**
-   * Writes the secrets to the given output stream encrypted with the given
-   * cipher.
+   * Writes the secrets to the given output stream in the binary format.
+   *
+   * @param output The output stream to write the secrets to.
+   * @param info The key, salt and rounds to use.
+   * @param secrets The secrets to write.
+   * @throws IOException
+   */
+  static void writeSecrets(OutputStream output,
+                           CipherInfo info,
+                           ArrayList<Secret> secrets) throws IOException {
+    writeSecrets(output, info, secrets, true, null, null, null, null);
+  }
+
+  /**
+   * Writes the secrets to the given output stream in the segmented binary
+   * format.
+   *
+   * The header holds the signature, format version, flags, salt and rounds.
+   * It is followed by a sequence of frames.  Each frame is a kind byte, a
+   * varint length and a payload made of a random IV and the encrypted data.
+   * The decrypted data of every frame starts with the PAYLOAD_MAGIC bytes.
    *
-   * The output stream is closed by the caller.
+   * The secrets are split into FRAME_SEGMENT frames, each holding a varint
+   * count followed by the length-prefixed records written by
+   * Secret.writeRecord().  The last frame is a FRAME_INDEX, holding the
+   * number of segments and, for each, its number of secrets and a digest of
+   * its payload, so that missing, truncated or reordered segments are
+   * detected when reading.  The index frame ends with a random base id, which
+   * changes every time the file is written and binds the journal to it.
+   *
+   * If a previous index and its source file are given, segments holding
+   * exactly the same unmodified secrets are copied from the source file
+   * instead of being encrypted again.
+   *
+   * The output stream is flushed, but not closed.
+   *
+   * @param output The output stream to write the secrets to.
+   * @param info The key, salt and rounds to use.
+   * @param secrets The secrets to write.
+   * @param inlineLog Write the access logs in the records, for files that
+   *     travel without the access log file.  The logs must be loaded.
+   * @param index If not null, filled in with the segments written.
+   * @param previous Index of the source file, or null.
+   * @param source The file described by previous, or null.
+   * @param progress Told after each segment, or null.
+   * @throws IOException
+   */
+  private static void writeSecrets(OutputStream output,
+                                   CipherInfo info,
+                                   ArrayList<Secret> secrets,
+                                   boolean inlineLog,
+                                   SegmentIndex index,
+                                   SegmentIndex previous,
+                                   RandomAccessFile source,
+                                   Progress progress)
+      throws IOException {
+    OutputStream bos = new BufferedOutputStream(output, 16 * 1024);
+    boolean compress = Deflater.NO_COMPRESSION != compressionLevel;
+    int flags = FLAG_SEGMENTED | (compress ? FLAG_DEFLATE : 0);
+    byte[] header = createHeader(SIGNATURE_V5, FORMAT_V5, info, flags);
+    bos.write(header);
+
+    // Frames can only be copied from a file that has the same flags.
+    if (null != previous && previous.getFlags() != flags)
+      source = null;
+
+    long offset = header.length;
+    int copied = 0;
+    MessageDigest digester = FrameCodec.createDigest();
+    RecordWriter plain = new RecordWriter(16 * 1024);
+    RecordWriter record = new RecordWriter();
+    ArrayList<Secret> segment = new ArrayList<Secret>(SEGMENT_MAX);
+    ArrayList<SegmentIndex.Segment> segments =
+        new ArrayList<SegmentIndex.Segment>();
+
+    for (int i = 0; i < secrets.size(); ++i) {
+      Secret secret = secrets.get(i);
+      segment.add(secret);
+      if (i < secrets.size() - 1 && !isSegmentEnd(secret, segment.size()))
+        continue;
+
+      SegmentIndex.Segment old = null == source
+          ? null : previous.findSegment(segment.get(0));
+      int[] revisions;
+      byte[] digest;
+      byte[] contentDigest;
+      int length;
+      if (null != old && old.isUnchanged(segment)) {
+        byte[] frame = new byte[old.length];
+        source.seek(old.offset);
+        source.readFully(frame);
+        bos.write(frame);
+        revisions = old.revisions;
+        digest = old.digest;
+        contentDigest = old.contentDigest;
+        length = old.length;
+        ++copied;
+      } else {
+        revisions = new int[segment.size()];
+        plain.reset();
+        plain.writeRawBytes(FrameCodec.PAYLOAD_MAGIC, 0,
+                            FrameCodec.PAYLOAD_MAGIC.length);
+        plain.writeRawVarint(segment.size());
+        for (int j = 0; j < segment.size(); ++j) {
+          Secret s = segment.get(j);
+          revisions[j] = s.getRevision();
+          record.reset();
+          s.writeRecord(record, info.key, info.suite, inlineLog);
+          plain.writeRawVarint(record.size());
+          plain.writeRawBytes(record);
+        }
+        contentDigest = FrameCodec.digest(digester, plain.toByteArray());
+        byte[] payload = FrameCodec.encryptFrame(info, plain, compress);
+        digest = FrameCodec.digest(digester, payload);
+        length = FrameCodec.writeFrame(bos, FRAME_SEGMENT, payload);
+      }
+
+      segments.add(new SegmentIndex.Segment(segment, revisions, offset, length,
+                                            digest, contentDigest));
+      offset += length;
+      segment.clear();
+      reportProgress(progress, i + 1, offset);
+    }
+
+    long baseId = new SecureRandom().nextLong();
+    plain.reset();
+    plain.writeRawBytes(FrameCodec.PAYLOAD_MAGIC, 0,
+                        FrameCodec.PAYLOAD_MAGIC.length);
+    plain.writeRawVarint(segments.size());
+    for (SegmentIndex.Segment s : segments) {
+      plain.writeRawVarint(s.secrets.length);
+      plain.writeRawBytes(s.digest, 0, s.digest.length);
+    }
+    plain.writeRawVarint(baseId);
+    FrameCodec.writeFrame(bos, FRAME_INDEX,
+                          FrameCodec.encryptFrame(info, plain, compress));
+    bos.flush();
+
+    if (null != index) {
+      for (SegmentIndex.Segment s : segments)
+        index.add(s);
+      index.setBaseId(baseId);
+      index.setFlags(flags);
+    }
+    Log.d(LOG_TAG, "FileUtils.writeSecrets: segments=" + segments.size() +
+          " copied=" + copied);
+  }
+
+  /** Should the current segment end after the given secret? */
+  private static boolean isSegmentEnd(Secret secret, int count) {
+    if (count >= SEGMENT_MAX)
+      return true;
+    if (count < SEGMENT_MIN)
+      return false;
+
+    // String.hashCode() is specified, so boundaries are stable across
+    // devices and versions.  Mix the bits since the low bits of string
+    // hashes are poorly distributed for similar strings.
+    int hash = secret.getDescription().toLowerCase(Locale.ROOT)
+        .hashCode() * 0x9E3779B9;
+    return ((hash >>> 16) & SEGMENT_MASK) == 0;
+  }
+
+  /**
+   * Creates the header of a binary format file or delta restore point.  The
+   * key check value of the key, the cipher suite unless it is AES-CBC, and
+   * the key derivation function unless it is bcrypt, are added to the given
+   * flags.
+   */
+  static byte[] createHeader(byte[] signature, int version,
+                                     CipherInfo info, int flags) {
+    byte[] keyCheck = SecurityUtils.createKeyCheck(info.key, info.salt);
+    if (null != keyCheck)
+      flags |= FLAG_KEY_CHECK;
+    if (SecurityUtils.SUITE_AES_CBC != info.suite)
+      flags |= FLAG_CIPHER_SUITE;
+    if (!Kdf.DEFAULT.equals(info.kdf))
+      flags |= FLAG_KDF;
+
+    ByteArrayOutputStream header = new ByteArrayOutputStream();
+    header.write(signature, 0, signature.length);
+    header.write(version);
+    header.write(flags);
+    header.write(info.salt.length);
+    header.write(info.salt, 0, info.salt.length);
+    header.write(info.rounds);
+    if (null != keyCheck) {
+      header.write(keyCheck.length);
+      header.write(keyCheck, 0, keyCheck.length);
+    }
+    if (0 != (flags & FLAG_CIPHER_SUITE))
+      header.write(info.suite);
+    if (0 != (flags & FLAG_KDF)) {
+      byte[] params = info.kdf.getParams();
+      header.write(info.kdf.getId());
+      header.write(params.length);
+      header.write(params, 0, params.length);
+    }
+    return header.toByteArray();
+  }
+
+  /**
+   * Writes the secrets to the given output stream in the V4 JSON format,
+   * encrypted with the given cipher.  Secrets no longer saves in this format,
+   * this is kept so that the formats can be compared by the benchmarks
+   * in the instrumented tests.
+   *
+   * The secrets are streamed through the cipher one at a time, so the size of
+   * the vault does not affect the amount of memory needed to save it.  The
+   * output stream is closed when the cipher is finalized; it is safe for the
+   * caller to close it again.
    *
    * @param output The output stream to write the secrets to.
    * @param cipher The cipher to encrypt the secrets with.
@@ -781,57 +1540,503 @@ public class FileUtils {
    * @param rounds The number of rounds for bcrypt.
    * @throws IOException
    */
-  private static void writeSecrets(OutputStream output,
-                                   Cipher cipher,
-                                   byte[] salt,
-                                   int rounds,
-                                   ArrayList<Secret> secrets) throws IOException {
+  static void writeSecretsV4(OutputStream output,
+                             Cipher cipher,
+                             byte[] salt,
+                             int rounds,
+                             ArrayList<Secret> secrets) throws IOException {
     output.write(SIGNATURE);
     output.write(salt.length);
     output.write(salt);
     output.write(rounds);
-    output.write(FileUtils.toEncryptedJSONSecretsStream(cipher, secrets));
-  	output.flush();
+    writeEncryptedJSONSecrets(output, cipher, secrets);
   }
 
   /**
    * Read the secrets from the given input stream, decrypting with the given
-   * cipher.
+   * cipher information.  Both the binary format and the V4 JSON format are
+   * supported, the header tells which one the stream holds.
    *
    * @param input
    *          The input stream to read the secrets from.
-   * @param cipher
-   *          The cipher to decrypt the secrets with.
-   * @return The secrets read from the stream.
+   * @param info
+   *          The key, salt and rounds to decrypt the secrets with.
+   * @return The secrets read from the stream, or null if the stream was
+   *          not written with the given salt and rounds.
+   * @throws IOException
+   */
+  static ArrayList<Secret> readSecrets(InputStream input, CipherInfo info)
+      throws IOException {
+    return readSecrets(input, info, null);
+  }
+
+  /**
+   * Reads the secrets of a segmented file by mapping it in memory, whatever
+   * its size.  Used by the benchmarks to compare with readSecrets().
+   *
+   * @param file The file to read the secrets from.
+   * @param info The key, salt and rounds to decrypt the secrets with.
+   * @return The secrets read from the file, or null if the file was not
+   *     written with the given salt and rounds.
+   * @throws IOException
+   */
+  static ArrayList<Secret> readMappedSecrets(File file, CipherInfo info)
+      throws IOException {
+    VaultFile vault = VaultFile.open(file);
+    try {
+      return readMappedSecrets(vault.getSaltAndRounds(), vault.map(), info,
+                               null);
+    } finally {
+      vault.close();
+    }
+  }
+
+  /**
+   * See previous method for description.
+   *
+   * @param input
+   *          The input stream to read the secrets from.
+   * @param info
+   *          The key, salt and rounds to decrypt the secrets with.
+   * @param index
+   *          If not null, filled in with the segments of a segmented file.
+   * @return The secrets read from the stream, or null if the stream was
+   *          not written with the given salt and rounds.
    * @throws IOException
-   * @throws ClassNotFoundException
    */
   private static ArrayList<Secret> readSecrets(InputStream input,
-                                               Cipher cipher, byte[] salt,
-                                               int rounds) throws IOException,
-      ClassNotFoundException {
-    SaltAndRounds pair = getSaltAndRounds(input);
-    if (!Arrays.equals(pair.salt, salt) || pair.rounds != rounds) {
+                                               CipherInfo info,
+                                               SegmentIndex index)
+      throws IOException {
+    return readSecrets(getSaltAndRounds(input), input, info, index);
+  }
+
+  /**
+   * See previous method for description.
+   *
+   * @param pair
+   *          The header of the stream, already read.
+   * @param input
+   *          The input stream, positioned after the header.
+   * @param info
+   *          The key, salt and rounds to decrypt the secrets with.
+   * @param index
+   *          If not null, filled in with the segments of a segmented file.
+   * @return The secrets read from the stream, or null if the stream was
+   *          not written with the given salt and rounds.
+   * @throws IOException
+   */
+  private static ArrayList<Secret> readSecrets(SaltAndRounds pair,
+                                               InputStream input,
+                                               CipherInfo info,
+                                               SegmentIndex index)
+      throws IOException {
+    if (!Arrays.equals(pair.salt, info.salt) || pair.rounds != info.rounds ||
+        !pair.kdf.equals(info.kdf)) {
       return null;
     }
-    BufferedInputStream bis = new BufferedInputStream(input);
-    ByteArrayOutputStream buffer = new ByteArrayOutputStream();
+    if (pair.delta)
+      throw new IOException("Delta restore point read without its base");
+    info = withSuite(info, pair);
+    InputStream bis = new BufferedInputStream(input);
+    if (FORMAT_V5 == pair.version) {
+      if (0 != (pair.flags & ~KNOWN_FLAGS))
+        throw new IOException("Unsupported flags " + pair.flags);
+
+      // Some flags are about the header, not the frames.
+      int flags = pair.flags & ~HEADER_FLAGS;
+      if (0 != (flags & FLAG_SEGMENTED)) {
+        return readSegmentedSecrets(bis, info, pair.headerLength, flags,
+                                    index);
+      }
+      if (0 != flags)
+        throw new IOException("Unsupported flags " + pair.flags);
+      return readBinarySecrets(bis, info);
+    }
+
+    return readEncryptedJSONSecrets(bis, info.createDecryptCipher());
+  }
+
+  /**
+   * Reads the frames of a segmented file, as written by writeSecrets().
+   * The input stream is closed before returning.
+   *
+   * @param input
+   *          The input stream, positioned after the file header.
+   * @param info
+   *          The key to decrypt the secrets with.
+   * @param offset
+   *          Offset of the first frame from the start of the file.
+   * @param flags
+   *          The flags from the file header.
+   * @param index
+   *          If not null, filled in with the segments read.
+   * @return The secrets read from the stream.
+   * @throws IOException if the file is corrupt or the key is wrong.
+   */
+  private static ArrayList<Secret> readSegmentedSecrets(InputStream input,
+                                                        CipherInfo info,
+                                                        long offset,
+                                                        int flags,
+                                                        SegmentIndex index)
+      throws IOException {
+    DataInputStream data = new DataInputStream(input);
+    ArrayList<ByteBuffer> payloads = new ArrayList<ByteBuffer>();
+    ArrayList<Integer> kinds = new ArrayList<Integer>();
+
     try {
-      // read the whole stream into the buffer
-      int nRead;
-      byte[] data = new byte[4096];
-      while ((nRead = bis.read(data, 0, data.length)) != -1) {
-        buffer.write(data, 0, nRead);
+      for (;;) {
+        int kind = data.read();
+        if (kind < 0)
+          throw new EOFException("Missing segment index");
+
+        int length = FrameCodec.readLength(data, FrameCodec.MAX_FRAME_LENGTH);
+        byte[] payload = new byte[length];
+        data.readFully(payload);
+        kinds.add(kind);
+        payloads.add(ByteBuffer.wrap(payload));
+        if (FRAME_INDEX == kind) {
+          if (-1 != data.read())
+            throw new IOException("Unexpected data after index");
+          break;
+        }
       }
-      buffer.flush();
-      return FileUtils.fromEncryptedJSONSecretsStream(cipher,
-              buffer.toByteArray());
     } finally {
-      try {
-        bis.close();
-      } catch (IOException ex) {
+      try {data.close();} catch (IOException ex) {}
+    }
+
+    return decodeFrames(kinds, payloads, info, offset, flags, index);
+  }
+
+  /**
+   * Reads the frames of a segmented file mapped in memory.  The payloads are
+   * decrypted straight from the mapped buffer, so the file is not copied
+   * into the heap first.
+   *
+   * @param pair
+   *          The header of the file.
+   * @param buffer
+   *          The whole file.
+   * @param info
+   *          The key, salt and rounds to decrypt the secrets with.
+   * @param index
+   *          If not null, filled in with the segments read.
+   * @return The secrets read from the file, or null if the file was not
+   *          written with the given salt and rounds.
+   * @throws IOException if the file is corrupt or the key is wrong.
+   */
+  private static ArrayList<Secret> readMappedSecrets(SaltAndRounds pair,
+                                                     ByteBuffer buffer,
+                                                     CipherInfo info,
+                                                     SegmentIndex index)
+      throws IOException {
+    if (!Arrays.equals(pair.salt, info.salt) || pair.rounds != info.rounds ||
+        !pair.kdf.equals(info.kdf))
+      return null;
+    if (!isSegmented(pair))
+      throw new IOException("Not a segmented file");
+    info = withSuite(info, pair);
+    int flags = pair.flags & ~HEADER_FLAGS;
+
+    ArrayList<ByteBuffer> payloads = new ArrayList<ByteBuffer>();
+    ArrayList<Integer> kinds = new ArrayList<Integer>();
+    buffer.position(pair.headerLength);
+    for (;;) {
+      if (!buffer.hasRemaining())
+        throw new EOFException("Missing segment index");
+
+      int kind = buffer.get() & 0xFF;
+      long length = RecordReader.readRawVarint(buffer);
+      if (length < 0 || length > buffer.remaining())
+        throw new EOFException("Truncated frame");
+
+      ByteBuffer payload = buffer.slice();
+      payload.limit((int) length);
+      buffer.position(buffer.position() + (int) length);
+      kinds.add(kind);
+      payloads.add(payload);
+      if (FRAME_INDEX == kind) {
+        if (buffer.hasRemaining())
+          throw new IOException("Unexpected data after index");
+        break;
       }
     }
+
+    return decodeFrames(kinds, payloads, info, pair.headerLength, flags, index);
+  }
+
+  /**
+   * Should a file with the given header and length be mapped in memory
+   * rather than streamed?  Only segmented files are read that way, and only
+   * if they are big enough for mapping to pay off, but not so big that they
+   * would use too much address space.
+   */
+  private static boolean isMappable(SaltAndRounds pair, long length) {
+    return isSegmented(pair) && length >= MAP_MIN_SIZE &&
+        length <= MAP_MAX_SIZE;
+  }
+
+  /** Is the header that of a segmented file this version can read? */
+  static boolean isSegmented(SaltAndRounds pair) {
+    return FORMAT_V5 == pair.version && !pair.delta &&
+        0 != (pair.flags & FLAG_SEGMENTED) &&
+        0 == (pair.flags & ~KNOWN_FLAGS);
+  }
+
+  /** A segment frame once decrypted and decoded, see decodeSegment(). */
+  private static class DecodedSegment {
+    final ArrayList<Secret> secrets;
+    final int[] revisions;
+    final byte[] digest;
+    final byte[] contentDigest;
+
+    DecodedSegment(ArrayList<Secret> secrets, int[] revisions,
+                   byte[] digest, byte[] contentDigest) {
+      this.secrets = secrets;
+      this.revisions = revisions;
+      this.digest = digest;
+      this.contentDigest = contentDigest;
+    }
+  }
+
+  /**
+   * Decrypts and decodes the frames of a segmented file, checking the
+   * segments against the index frame, which must be the last one.
+   *
+   * Each segment is encrypted on its own, so when there are several they are
+   * decrypted and decoded in parallel on the decoder threads.  The secrets
+   * are returned in the order of the segments, which is the sorted order
+   * they were written in.
+   *
+   * @param kinds The kind of each frame.
+   * @param payloads The payload of each frame.
+   * @param info The key to decrypt the secrets with.
+   * @param offset Offset of the first frame from the start of the file.
+   * @param flags The flags of the frames.
+   * @param index If not null, filled in with the segments read.
+   * @return The secrets of the file.
+   * @throws IOException if the file is corrupt or the key is wrong.
+   */
+  private static ArrayList<Secret> decodeFrames(List<Integer> kinds,
+                                                List<ByteBuffer> payloads,
+                                                CipherInfo info,
+                                                long offset,
+                                                int flags,
+                                                SegmentIndex index)
+      throws IOException {
+    int last = kinds.size() - 1;
+    for (int f = 0; f < kinds.size(); ++f) {
+      int kind = kinds.get(f);
+      if (FRAME_SEGMENT != kind && !(FRAME_INDEX == kind && f == last))
+        throw new IOException("Unknown frame kind " + kind);
+    }
+    boolean hasIndex = last >= 0 && FRAME_INDEX == kinds.get(last);
+    int segmentCount = hasIndex ? last : kinds.size();
+    boolean compressed = 0 != (flags & FLAG_DEFLATE);
+    List<DecodedSegment> decoded =
+        decodeSegments(payloads.subList(0, segmentCount), info, compressed);
+
+    ArrayList<Secret> secrets = new ArrayList<Secret>();
+    ArrayList<SegmentIndex.Segment> segments =
+        new ArrayList<SegmentIndex.Segment>(segmentCount);
+    for (int f = 0; f < segmentCount; ++f) {
+      DecodedSegment segment = decoded.get(f);
+      int length = payloads.get(f).remaining();
+      int frameLength = 1 + RecordWriter.rawVarintSize(length) + length;
+      secrets.addAll(segment.secrets);
+      segments.add(new SegmentIndex.Segment(segment.secrets,
+          segment.revisions, offset, frameLength, segment.digest,
+          segment.contentDigest));
+      offset += frameLength;
+    }
+
+    long baseId = 0;
+    if (hasIndex) {
+      byte[] plain =
+          FrameCodec.decryptFrameData(info, payloads.get(last), compressed);
+      RecordReader reader = new RecordReader(
+          plain, FrameCodec.PAYLOAD_MAGIC.length,
+          plain.length - FrameCodec.PAYLOAD_MAGIC.length);
+      if (FrameCodec.readCount(reader) != segments.size())
+        throw new IOException("Segment count mismatch");
+      for (SegmentIndex.Segment segment : segments) {
+        if (FrameCodec.readCount(reader) != segment.secrets.length ||
+            !Arrays.equals(reader.readRawBytes(FrameCodec.DIGEST_LENGTH),
+                           segment.digest)) {
+          throw new IOException("Segment does not match index");
+        }
+      }
+      if (reader.hasMore())
+        baseId = reader.readRawVarint();
+    }
+
+    if (null != index) {
+      for (SegmentIndex.Segment segment : segments)
+        index.add(segment);
+      index.setBaseId(baseId);
+      index.setFlags(flags);
+    }
+    return secrets;
+  }
+
+  /**
+   * Decrypts and decodes the given segment frames, on the decoder threads if
+   * there is more than one and the device has more than one core.
+   *
+   * @return The decoded segments, in the order of the payloads.
+   * @throws IOException if a segment is corrupt or the key is wrong.
+   */
+  private static List<DecodedSegment> decodeSegments(
+      List<ByteBuffer> payloads, final CipherInfo info,
+      final boolean compressed) throws IOException {
+    ArrayList<DecodedSegment> decoded =
+        new ArrayList<DecodedSegment>(payloads.size());
+    if (DECODE_THREADS < 2 || payloads.size() < 2) {
+      MessageDigest digester = FrameCodec.createDigest();
+      for (ByteBuffer payload : payloads)
+        decoded.add(decodeSegment(info, payload, compressed, digester));
+      return decoded;
+    }
+
+    ExecutorService executor = getDecoder();
+    ArrayList<Future<DecodedSegment>> futures =
+        new ArrayList<Future<DecodedSegment>>(payloads.size());
+    try {
+      for (final ByteBuffer payload : payloads) {
+        futures.add(executor.submit(new Callable<DecodedSegment>() {
+          @Override
+          public DecodedSegment call() throws IOException {
+            return decodeSegment(info, payload, compressed,
+                                 FrameCodec.createDigest());
+          }
+        }));
+      }
+      for (Future<DecodedSegment> future : futures)
+        decoded.add(future.get());
+      return decoded;
+    } catch (InterruptedException ex) {
+      Thread.currentThread().interrupt();
+      throw new InterruptedIOException("Interrupted while decoding");
+    } catch (ExecutionException ex) {
+      Throwable cause = ex.getCause();
+      if (cause instanceof IOException)
+        throw (IOException) cause;
+      if (cause instanceof RuntimeException)
+        throw (RuntimeException) cause;
+      throw new IOException("Cannot decode segment: " + cause);
+    } finally {
+      // Stop decoding the remaining segments if one of them failed.
+      for (Future<DecodedSegment> future : futures)
+        future.cancel(false);
+    }
+  }
+
+  /**
+   * Decrypts and decodes one segment frame.  This may run on any thread, so
+   * it only uses the digester given to it and ciphers of its own.
+   *
+   * @throws IOException if the segment is corrupt or the key is wrong.
+   */
+  private static DecodedSegment decodeSegment(CipherInfo info,
+                                              ByteBuffer payload,
+                                              boolean compressed,
+                                              MessageDigest digester)
+      throws IOException {
+    byte[] plain = FrameCodec.decryptFrameData(info, payload, compressed);
+    RecordReader reader = new RecordReader(
+        plain, FrameCodec.PAYLOAD_MAGIC.length,
+        plain.length - FrameCodec.PAYLOAD_MAGIC.length);
+    int count = FrameCodec.readCount(reader);
+    ArrayList<Secret> secrets = new ArrayList<Secret>(count);
+    int[] revisions = new int[count];
+    for (int i = 0; i < count; ++i) {
+      Secret secret = Secret.fromRecord(reader.readRecord(), info.key);
+      revisions[i] = secret.getRevision();
+      secrets.add(secret);
+    }
+    return new DecodedSegment(secrets, revisions,
+                              FrameCodec.digest(digester, payload),
+                              FrameCodec.digest(digester, plain));
+  }
+
+  /** Returns the pool of decoder threads, creating it if needed. */
+  private static synchronized ExecutorService getDecoder() {
+    if (null == decoder) {
+      ThreadPoolExecutor executor = new ThreadPoolExecutor(DECODE_THREADS,
+          DECODE_THREADS, DECODE_KEEP_ALIVE_SECONDS, TimeUnit.SECONDS,
+          new LinkedBlockingQueue<Runnable>());
+      executor.allowCoreThreadTimeOut(true);
+      decoder = executor;
+    }
+    return decoder;
+  }
+
+  /**
+   * Reads the payload of a binary format file that is not segmented: a
+   * random IV followed by a single encrypted stream holding the payload
+   * magic, a varint count of secrets, and the length-prefixed records.
+   * Secrets does not write such files anymore, but may have in the past.
+   * The input stream is closed before returning.
+   *
+   * @param input
+   *          The input stream, positioned after the file header.
+   * @param info
+   *          The key to decrypt the secrets with.
+   * @return The secrets read from the stream.
+   * @throws IOException if the file is corrupt or the key is wrong.
+   */
+  private static ArrayList<Secret> readBinarySecrets(InputStream input,
+                                                     CipherInfo info)
+      throws IOException {
+    byte[] iv = new byte[SecurityUtils.getIvLength(info.suite)];
+    new DataInputStream(input).readFully(iv);
+    DataInputStream cis = new DataInputStream(new BufferedInputStream(
+        new CipherInputStream(input, FrameCodec.createCipher(
+            Cipher.DECRYPT_MODE, info, iv))));
+    try {
+      byte[] magic = new byte[FrameCodec.PAYLOAD_MAGIC.length];
+      cis.readFully(magic);
+      if (!Arrays.equals(magic, FrameCodec.PAYLOAD_MAGIC))
+        throw new IOException("Bad payload signature, wrong password?");
+
+      int count = FrameCodec.readLength(cis, FrameCodec.MAX_RECORD_COUNT);
+      ArrayList<Secret> secrets = new ArrayList<Secret>(count);
+      byte[] buffer = new byte[1024];
+      for (int i = 0; i < count; ++i) {
+        int length = FrameCodec.readLength(cis, FrameCodec.MAX_RECORD_LENGTH);
+        if (length > buffer.length)
+          buffer = new byte[Math.max(length, buffer.length * 2)];
+        cis.readFully(buffer, 0, length);
+        secrets.add(Secret.fromRecord(new RecordReader(buffer, 0, length),
+                                      info.key));
+      }
+
+      // Read to the end so that the cipher checks the padding.
+      if (-1 != cis.read())
+        throw new IOException("Unexpected data after secrets");
+
+      return secrets;
+    } finally {
+      try {cis.close();} catch (IOException ex) {}
+    }
+  }
+
+  /**
+   * Returns info, or a copy of it using the cipher suite from the header of
+   * a file if it differs.  The suite of a file is in its header, and a
+   * restore point may be older than the current suite.
+   */
+  static CipherInfo withSuite(CipherInfo info, SaltAndRounds pair) {
+    if (pair.suite == info.suite)
+      return info;
+
+    CipherInfo copy = new CipherInfo();
+    copy.key = info.key;
+    copy.salt = info.salt;
+    copy.rounds = info.rounds;
+    copy.suite = pair.suite;
+    copy.kdf = info.kdf;
+    return copy;
   }
 
   /**
@@ -902,6 +2107,127 @@ public class FileUtils {
     return secretList;
   }
 
+  /**
+   * Writes the json representation of the secrets to the given writer.  The
+   * output is identical to toJSONSecrets(secrets).toString(), but each secret
+   * is written as it is visited instead of building the whole tree first.
+   *
+   * @param writer
+   *          The writer to output the json text to.
+   * @param secrets
+   *          The list of secrets.
+   * @throws IOException
+   *           if any error occurs
+   */
+  public static void writeJSONSecrets(Writer writer, ArrayList<Secret> secrets)
+      throws IOException {
+    JSONStreamWriter json = new JSONStreamWriter(writer);
+    json.object();
+    json.key(JSON_SECRETS_ID).array();
+    for (Secret secret : secrets) {
+      secret.writeJSON(json);
+    }
+    json.endArray();
+    json.endObject();
+    json.flush();
+  }
+
+  /**
+   * Writes an encrypted json stream representing the user's secrets to the
+   * given output stream.  The cipher is finalized and the output stream is
+   * closed before returning.
+   *
+   * @param output
+   *          The stream to write the encrypted secrets to.
+   * @param cipher
+   *          The encryption cipher to use with the file.
+   * @param secrets
+   *          The list of secrets.
+   * @throws IOException
+   *           if any error occurs
+   */
+  public static void writeEncryptedJSONSecrets(OutputStream output,
+      Cipher cipher, ArrayList<Secret> secrets) throws IOException {
+    Writer writer = new BufferedWriter(new OutputStreamWriter(
+        new CipherOutputStream(output, cipher), StandardCharsets.UTF_8));
+    try {
+      writeJSONSecrets(writer, secrets);
+    } finally {
+      // Closing the writer finalizes the cipher, which writes out the last
+      // padded block.
+      writer.close();
+    }
+  }
+
+  /**
+   * Reads the secrets from a json stream.  Secrets are created one at a time
+   * as they are parsed, the json text is never held in memory as a whole.
+   *
+   * @param reader
+   *          The json reader, positioned at the start of the document.
+   * @return list of secrets
+   * @throws IOException
+   *           if the stream is not a valid json secrets document
+   */
+  public static ArrayList<Secret> readJSONSecrets(JsonReader reader)
+      throws IOException {
+    ArrayList<Secret> secretList = null;
+    try {
+      reader.beginObject();
+      while (reader.hasNext()) {
+        if (JSON_SECRETS_ID.equals(reader.nextName())) {
+          secretList = new ArrayList<Secret>();
+          reader.beginArray();
+          while (reader.hasNext()) {
+            secretList.add(Secret.fromJSON(reader));
+          }
+          reader.endArray();
+        } else {
+          reader.skipValue();
+        }
+      }
+      reader.endObject();
+
+      // Make sure there is nothing after the document.  This also reads the
+      // stream to the end so that a decrypting stream checks the padding.
+      if (reader.peek() != JsonToken.END_DOCUMENT)
+        throw new IOException("Unexpected data after secrets");
+    } catch (IllegalStateException e) {
+      // JsonReader reports unexpected tokens this way.
+      throw new IOException("readJSONSecrets failed: " + e.getMessage());
+    } catch (NumberFormatException e) {
+      throw new IOException("readJSONSecrets failed: " + e.getMessage());
+    }
+
+    if (null == secretList)
+      throw new IOException("readJSONSecrets failed: no secrets");
+
+    return secretList;
+  }
+
+  /**
+   * Reads secrets from the supplied encrypted json stream, decrypting and
+   * parsing incrementally.  The input stream is closed before returning.
+   *
+   * @param input
+   *          The stream of encrypted json, positioned after the file header.
+   * @param cipher
+   *          cipher to use
+   * @return list of secrets
+   * @throws IOException
+   *           if any error occurs
+   */
+  public static ArrayList<Secret> readEncryptedJSONSecrets(InputStream input,
+      Cipher cipher) throws IOException {
+    JsonReader reader = new JsonReader(new InputStreamReader(
+        new CipherInputStream(input, cipher), StandardCharsets.UTF_8));
+    try {
+      return readJSONSecrets(reader);
+    } finally {
+      try {reader.close();} catch (IOException ex) {}
+    }
+  }
+
   /**
    * Returns an encrypted json stream representing the user's secrets.
    *
@@ -915,18 +2241,13 @@ public class FileUtils {
    */
   public static byte[] toEncryptedJSONSecretsStream(Cipher cipher,
       ArrayList<Secret> secrets) throws IOException {
-    CipherOutputStream output = null;
     ByteArrayOutputStream baos = new ByteArrayOutputStream();
 
     try {
-      output = new CipherOutputStream(baos, cipher);
-      output.write(FileUtils.toJSONSecrets(secrets).toString().getBytes(
-          StandardCharsets.UTF_8));
+      writeEncryptedJSONSecrets(baos, cipher, secrets);
     } catch (Exception e) {
       Log.e(LOG_TAG, "toEncryptedJSONSecretsStream", e);
       throw new IOException("toEncryptedJSONSecretsStream failed: " + e.getMessage());
-    } finally {
-      try { if (null != output) output.close(); } catch (IOException ex) {}
     }
 
     return baos.toByteArray();
@@ -964,9 +2285,16 @@ public class FileUtils {
   public static boolean deleteSecrets(Context context) {
     Log.d(LOG_TAG, "FileUtils.deleteSecrets");
     synchronized (lock) {
-      String filenames[] = context.fileList();
-      for (String filename : filenames) {
-        context.deleteFile(filename);
+      synchronized (JournalStore.lock) {
+        segmentIndex = null;
+        JournalStore.reset();
+        AccessLogStore.reset();
+        RestorePointManifest.reset();
+        VaultFile.clearCache();
+        String filenames[] = context.fileList();
+        for (String filename : filenames) {
+          context.deleteFile(filename);
+        }
       }
     }
 
@@ -981,20 +2309,39 @@ public class FileUtils {
    * @return true if successful, false otherwise
    */
   public static boolean exportSecrets(Context context,List<Secret> secrets) {
+    return exportSecrets(context, secrets, null);
+  }
+
+  /**
+   * Export secrets to a CSV file on the SD card, reporting progress as the
+   * secrets are written.  The file replaces the previous export once
+   * complete, so a failed or cancelled export leaves it untouched.
+   * @param context the current context
+   * @param secrets the secrets to export
+   * @param progress receives the progress and can cancel the export, or null
+   * @return true if successful, false otherwise
+   */
+  public static boolean exportSecrets(Context context, List<Secret> secrets,
+                                      Progress progress) {
     // An array to hold the rows that will be written to the CSV file.
     String[] row = new String[] {
         COL_DESCRIPTION, COL_USERNAME, COL_PASSWORD, COL_EMAIL, COL_NOTES
     };
+    File temp = new File(SECRETS_FILE_CSV.getParentFile(),
+                         "new" + SECRETS_FILE_CSV.getName());
+    CountingOutputStream counter = null;
     CSVWriter writer = null;
     boolean success = false;
 
     try {
-      writer = new CSVWriter(new FileWriter(SECRETS_FILE_NAME_CSV));
+      counter = new CountingOutputStream(new FileOutputStream(temp));
+      writer = new CSVWriter(new OutputStreamWriter(counter));
 
       // Write descriptive headers.
       writer.writeNext(row);
 
       // Write out each secret.
+      int records = 0;
       for (Secret secret : secrets) {
         row[0] = secret.getDescription();
         row[1] = secret.getUsername();
@@ -1005,16 +2352,53 @@ public class FileUtils {
         // NOTE: writeNext() handles nulls in row[] gracefully.
         writer.writeNext(row);
         success = true;
+        reportProgress(progress, ++records, counter.getCount());
       }
+      writer.close();
+      writer = null;
+      success = success && temp.renameTo(SECRETS_FILE_CSV);
     } catch (Exception ex) {
       Log.e(LOG_TAG, "exportSecrets", ex);
+      success = false;
     } finally {
       try {if (null != writer) writer.close();} catch (IOException ex) {}
+      try {if (null != counter) counter.close();} catch (IOException ex) {}
+      if (!success)
+        temp.delete();
     }
 
     return success;
   }
 
+  /**
+   * An output stream that counts the bytes written through it, to report
+   * the progress of an export.
+   */
+  private static class CountingOutputStream extends FilterOutputStream {
+    private long count;
+
+    CountingOutputStream(OutputStream output) {
+      super(output);
+    }
+
+    @Override
+    public void write(int b) throws IOException {
+      out.write(b);
+      ++count;
+    }
+
+    @Override
+    public void write(byte[] b, int off, int len) throws IOException {
+      out.write(b, off, len);
+      count += len;
+    }
+
+    /** Returns the number of bytes written so far. */
+    long getCount() {
+      return count;
+    }
+  }
+
   /**
    * Returns the file that should be imported.  This method will look for a file
    * on the SD card whose name is either the secrets CSV file or the OI Safe
@@ -1182,7 +2566,8 @@ public class FileUtils {
       Log.d(LOG_TAG_AGENT, "onCreate");
 
       FileBackupHelper helper = new FileBackupHelper(this,
-          FileUtils.SECRETS_FILE_NAME);
+          FileUtils.SECRETS_FILE_NAME, FileUtils.JOURNAL_FILE_NAME,
+          FileUtils.ACCESS_LOG_FILE_NAME);
       addHelper(KEY, helper);
     }
 
@@ -1192,7 +2577,11 @@ public class FileUtils {
                          ParcelFileDescriptor newState) throws IOException {
       Log.d(LOG_TAG_AGENT, "onBackup");
       synchronized (lock) {
-        super.onBackup(oldState, data, newState);
+        synchronized (JournalStore.lock) {
+          synchronized (AccessLogStore.lock) {
+            super.onBackup(oldState, data, newState);
+          }
+        }
       }
       getSharedPreferences(PREFS_FILE_NAME, 0).edit()
           .putLong(PREF_LAST_BACKUP_DATE, System.currentTimeMillis()).apply();
@@ -1204,7 +2593,16 @@ public class FileUtils {
                           ParcelFileDescriptor newState)  throws IOException {
       Log.d(LOG_TAG_AGENT, "onRestore");
       synchronized (lock) {
-        super.onRestore(data, appVersionCode, newState);
+        synchronized (JournalStore.lock) {
+          synchronized (AccessLogStore.lock) {
+            segmentIndex = null;
+            JournalStore.reset();
+            AccessLogStore.reset();
+            RestorePointManifest.reset();
+            VaultFile.clearCache();
+            super.onRestore(data, appVersionCode, newState);
+          }
+        }
       }
     }
 
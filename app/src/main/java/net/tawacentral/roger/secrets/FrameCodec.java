@@ -0,0 +1,270 @@
+// Copyright (c) 2009, Google Inc.
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//      http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+
+package net.tawacentral.roger.secrets;
+
+import net.tawacentral.roger.secrets.SecurityUtils.CipherInfo;
+
+import java.io.ByteArrayOutputStream;
+import java.io.EOFException;
+import java.io.IOException;
+import java.io.InputStream;
+import java.io.OutputStream;
+import java.nio.ByteBuffer;
+import java.security.GeneralSecurityException;
+import java.security.MessageDigest;
+import java.security.NoSuchAlgorithmException;
+import java.util.Arrays;
+import java.util.zip.DataFormatException;
+import java.util.zip.Deflater;
+import java.util.zip.Inflater;
+
+import javax.crypto.Cipher;
+
+/**
+ * Encoding of the frames that make up the binary files of Secrets: the
+ * secrets file, the journal, the access log, the restore point manifest and
+ * delta restore points.  A frame is a kind byte, a varint length and a
+ * payload made of a random IV and the encrypted data, which starts with
+ * PAYLOAD_MAGIC once decrypted.
+ */
+class FrameCodec {
+  // The decrypted payload of a binary file starts with these bytes.  Since
+  // CBC decryption with the wrong key does not reliably fail, this is how a
+  // wrong password is detected.
+  static final byte[] PAYLOAD_MAGIC = {0x53, 0x43, 0x52, 0x54};
+
+  // Length of the segment digests stored in the index frame.
+  static final int DIGEST_LENGTH = 16;
+
+  // Sanity limits when reading binary files, to fail cleanly on corrupt data.
+  static final int MAX_RECORD_COUNT = 10 * 1000 * 1000;
+  static final int MAX_RECORD_LENGTH = 16 * 1024 * 1024;
+  static final int MAX_FRAME_LENGTH = 64 * 1024 * 1024;
+
+  /**
+   * Writes a frame to the output stream.
+   *
+   * @return The number of bytes written.
+   */
+  static int writeFrame(OutputStream output, int kind, byte[] payload)
+      throws IOException {
+    output.write(kind);
+    RecordWriter.writeRawVarint(output, payload.length);
+    output.write(payload);
+    return 1 + RecordWriter.rawVarintSize(payload.length) + payload.length;
+  }
+
+  /**
+   * Encrypts the given data with a new random IV, optionally compressing it
+   * first.  The IV is a nonce for the authenticated cipher suites.
+   *
+   * @return The payload of a frame: the IV followed by the encrypted data.
+   */
+  static byte[] encryptFrame(CipherInfo info, RecordWriter plain,
+                             boolean compress) throws IOException {
+    byte[] data = plain.toByteArray();
+    if (compress)
+      data = deflate(data, 0, data.length, FileUtils.getCompressionLevel());
+
+    byte[] iv = SecurityUtils.createIv(info.suite);
+    Cipher cipher = createCipher(Cipher.ENCRYPT_MODE, info, iv);
+    byte[] encrypted;
+    try {
+      encrypted = cipher.doFinal(data);
+    } catch (GeneralSecurityException ex) {
+      throw new IOException("Cannot encrypt frame: " + ex.getMessage());
+    }
+
+    byte[] payload = new byte[iv.length + encrypted.length];
+    System.arraycopy(iv, 0, payload, 0, iv.length);
+    System.arraycopy(encrypted, 0, payload, iv.length, encrypted.length);
+    return payload;
+  }
+
+  /**
+   * Decrypts the payload of a frame written by encryptFrame().
+   *
+   * @return A reader over the decrypted data, positioned after the magic.
+   * @throws IOException if the data cannot be decrypted, which usually means
+   *     the key is wrong.
+   */
+  static RecordReader decryptFrame(CipherInfo info, byte[] payload,
+                                   boolean compressed)
+      throws IOException {
+    byte[] plain = decryptFrameData(info, payload, compressed);
+    return new RecordReader(plain, PAYLOAD_MAGIC.length,
+                            plain.length - PAYLOAD_MAGIC.length);
+  }
+
+  /**
+   * Decrypts the payload of a frame written by encryptFrame().
+   *
+   * @return The decrypted data, starting with the magic.
+   * @throws IOException if the data cannot be decrypted, which usually means
+   *     the key is wrong.
+   */
+  static byte[] decryptFrameData(CipherInfo info, byte[] payload,
+                                 boolean compressed)
+      throws IOException {
+    return decryptFrameData(info, ByteBuffer.wrap(payload), compressed);
+  }
+
+  /**
+   * Decrypts the payload of a frame written by encryptFrame(), held in a
+   * buffer that may be memory mapped.  The position of the buffer is not
+   * changed.
+   *
+   * @return The decrypted data, starting with the magic.
+   * @throws IOException if the data cannot be decrypted, which usually means
+   *     the key is wrong.
+   */
+  static byte[] decryptFrameData(CipherInfo info, ByteBuffer payload,
+                                 boolean compressed)
+      throws IOException {
+    int ivLength = SecurityUtils.getIvLength(info.suite);
+    if (payload.remaining() < ivLength)
+      throw new EOFException("Truncated frame");
+
+    ByteBuffer data = payload.duplicate();
+    byte[] iv = new byte[ivLength];
+    data.get(iv);
+    Cipher cipher = createCipher(Cipher.DECRYPT_MODE, info, iv);
+    byte[] plain;
+    try {
+      plain = new byte[cipher.getOutputSize(data.remaining())];
+      int length = cipher.doFinal(data, ByteBuffer.wrap(plain));
+      if (length != plain.length)
+        plain = Arrays.copyOf(plain, length);
+    } catch (GeneralSecurityException ex) {
+      throw new IOException("Cannot decrypt frame, wrong password?");
+    }
+
+    if (compressed)
+      plain = inflate(plain, 0, plain.length);
+
+    if (plain.length < PAYLOAD_MAGIC.length ||
+        !Arrays.equals(Arrays.copyOf(plain, PAYLOAD_MAGIC.length),
+                       PAYLOAD_MAGIC)) {
+      throw new IOException("Bad frame signature, wrong password?");
+    }
+
+    return plain;
+  }
+
+  /**
+   * Compresses data with DEFLATE, in the zlib format.
+   *
+   * @param level Compression level, as defined by Deflater.
+   */
+  static byte[] deflate(byte[] data, int offset, int length, int level) {
+    Deflater deflater = new Deflater(level);
+    try {
+      deflater.setInput(data, offset, length);
+      deflater.finish();
+      ByteArrayOutputStream output =
+          new ByteArrayOutputStream(length / 2 + 64);
+      byte[] buffer = new byte[8 * 1024];
+      while (!deflater.finished()) {
+        int count = deflater.deflate(buffer);
+        output.write(buffer, 0, count);
+      }
+      return output.toByteArray();
+    } finally {
+      deflater.end();
+    }
+  }
+
+  /**
+   * Decompresses data written by deflate().
+   *
+   * @throws IOException if the data is corrupt or expands to more than
+   *     MAX_FRAME_LENGTH bytes.
+   */
+  static byte[] inflate(byte[] data, int offset, int length)
+      throws IOException {
+    Inflater inflater = new Inflater();
+    try {
+      inflater.setInput(data, offset, length);
+      ByteArrayOutputStream output = new ByteArrayOutputStream(length * 3);
+      byte[] buffer = new byte[8 * 1024];
+      while (!inflater.finished()) {
+        int count = inflater.inflate(buffer);
+        if (0 == count && (inflater.needsInput() || inflater.needsDictionary()))
+          throw new EOFException("Truncated compressed data");
+        output.write(buffer, 0, count);
+        if (output.size() > MAX_FRAME_LENGTH)
+          throw new IOException("Compressed data too large");
+      }
+      return output.toByteArray();
+    } catch (DataFormatException ex) {
+      throw new IOException("Corrupt compressed data: " + ex.getMessage());
+    } finally {
+      inflater.end();
+    }
+  }
+
+  /** Creates the message digest used for segment digests. */
+  static MessageDigest createDigest() throws IOException {
+    try {
+      return MessageDigest.getInstance("SHA-256");
+    } catch (NoSuchAlgorithmException ex) {
+      throw new IOException("SHA-256 not available");
+    }
+  }
+
+  /** Returns the truncated digest of the given frame payload. */
+  static byte[] digest(MessageDigest digester, byte[] payload) {
+    return Arrays.copyOf(digester.digest(payload), DIGEST_LENGTH);
+  }
+
+  /**
+   * Returns the digest of the given payload, truncated to DIGEST_LENGTH.  The
+   * position of the buffer is not changed.
+   */
+  static byte[] digest(MessageDigest digester, ByteBuffer payload) {
+    digester.update(payload.duplicate());
+    return Arrays.copyOf(digester.digest(), DIGEST_LENGTH);
+  }
+
+  /** Reads a varint count from a record, checking it is reasonable. */
+  static int readCount(RecordReader reader) throws IOException {
+    long count = reader.readRawVarint();
+    if (count < 0 || count > MAX_RECORD_COUNT)
+      throw new IOException("Invalid count " + count);
+    return (int) count;
+  }
+
+  /** Reads a varint length from the stream, checking it against a limit. */
+  static int readLength(InputStream input, int max)
+      throws IOException {
+    long length = RecordReader.readRawVarint(input);
+    if (length < 0 || length > max)
+      throw new IOException("Invalid length " + length);
+    return (int) length;
+  }
+
+  /**
+   * Creates a cipher for the binary format, of the cipher suite of info.
+   *
+   * @throws IOException if the cipher cannot be created.
+   */
+  static Cipher createCipher(int mode, CipherInfo info, byte[] iv)
+      throws IOException {
+    Cipher cipher = null == info.key ? null : info.createCipher(mode, iv);
+    if (null == cipher)
+      throw new IOException("Cannot create cipher for suite " + info.suite);
+    return cipher;
+  }
+}
@@ -0,0 +1,175 @@
+// Copyright (c) 2009, Google Inc.
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//      http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+
+package net.tawacentral.roger.secrets;
+
+import java.io.IOException;
+import java.io.Writer;
+
+/**
+ * A minimal streaming JSON writer used to save secrets without first building
+ * a tree of JSONObjects in memory.
+ *
+ * The output is byte for byte identical to what JSONObject.toString() produces
+ * for the same values: no whitespace, the same string escaping rules, and
+ * null values are skipped just like JSONObject.put() does.  This means files
+ * written with this class are indistinguishable from files written by older
+ * versions of Secrets.
+ *
+ * Nesting is not validated, callers are expected to balance their calls to
+ * object()/endObject() and array()/endArray().
+ */
+public class JSONStreamWriter {
+  private static final char[] HEX = "0123456789abcdef".toCharArray();
+
+  private final Writer writer;
+
+  // True if a value has already been written at the current nesting level,
+  // which means the next value or key must be preceded by a comma.
+  private boolean needsComma;
+
+  /**
+   * Creates a JSON writer that outputs to the given writer.
+   *
+   * @param writer The destination of the JSON text.
+   */
+  public JSONStreamWriter(Writer writer) {
+    this.writer = writer;
+  }
+
+  /** Begins a new JSON object. */
+  public JSONStreamWriter object() throws IOException {
+    return open('{');
+  }
+
+  /** Ends the current JSON object. */
+  public JSONStreamWriter endObject() throws IOException {
+    return close('}');
+  }
+
+  /** Begins a new JSON array. */
+  public JSONStreamWriter array() throws IOException {
+    return open('[');
+  }
+
+  /** Ends the current JSON array. */
+  public JSONStreamWriter endArray() throws IOException {
+    return close(']');
+  }
+
+  /**
+   * Writes the name of the next member of the current object.  Must be
+   * followed by exactly one value, object or array.
+   */
+  public JSONStreamWriter key(String name) throws IOException {
+    separate();
+    string(name);
+    writer.write(':');
+    needsComma = false;
+    return this;
+  }
+
+  /**
+   * Writes a string member to the current object.  If the value is null the
+   * member is skipped entirely, just like JSONObject.put().
+   */
+  public JSONStreamWriter put(String name, String value) throws IOException {
+    if (null != value) {
+      key(name);
+      string(value);
+      needsComma = true;
+    }
+    return this;
+  }
+
+  /** Writes a numeric member to the current object. */
+  public JSONStreamWriter put(String name, long value) throws IOException {
+    key(name);
+    writer.write(Long.toString(value));
+    needsComma = true;
+    return this;
+  }
+
+  /** Writes a boolean member to the current object. */
+  public JSONStreamWriter put(String name, boolean value) throws IOException {
+    key(name);
+    writer.write(value ? "true" : "false");
+    needsComma = true;
+    return this;
+  }
+
+  /** Flushes the underlying writer. */
+  public void flush() throws IOException {
+    writer.flush();
+  }
+
+  private JSONStreamWriter open(char c) throws IOException {
+    separate();
+    writer.write(c);
+    needsComma = false;
+    return this;
+  }
+
+  private JSONStreamWriter close(char c) throws IOException {
+    writer.write(c);
+    needsComma = true;
+    return this;
+  }
+
+  private void separate() throws IOException {
+    if (needsComma)
+      writer.write(',');
+  }
+
+  /** Writes a quoted string, escaped the same way as JSONStringer does. */
+  private void string(String value) throws IOException {
+    writer.write('"');
+    for (int i = 0, length = value.length(); i < length; ++i) {
+      char c = value.charAt(i);
+      switch (c) {
+        case '"':
+        case '\\':
+        case '/':
+          writer.write('\\');
+          writer.write(c);
+          break;
+        case '\t':
+          writer.write("\\t");
+          break;
+        case '\b':
+          writer.write("\\b");
+          break;
+        case '\n':
+          writer.write("\\n");
+          break;
+        case '\r':
+          writer.write("\\r");
+          break;
+        case '\f':
+          writer.write("\\f");
+          break;
+        default:
+          if (c <= 0x1F) {
+            writer.write("\\u00");
+            writer.write(HEX[c >> 4]);
+            writer.write(HEX[c & 0xF]);
+          } else {
+            writer.write(c);
+          }
+          break;
+      }
+    }
+    writer.write('"');
+  }
+}
@@ -0,0 +1,126 @@
+// Copyright (c) 2009, Google Inc.
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//      http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+
+package net.tawacentral.roger.secrets;
+
+import java.io.File;
+import java.util.IdentityHashMap;
+import java.util.List;
+import java.util.Set;
+
+import javax.crypto.SecretKey;
+
+/**
+ * In memory state of the edit journal that sits next to the secrets file.
+ *
+ * The journal is bound to one version of the secrets file, identified by the
+ * base id written in that file's index frame.  It remembers which Secret
+ * objects are persisted, by either the secrets file or the journal, and their
+ * revisions at that time.  Comparing this against the current list of secrets
+ * gives the records that need to be appended on the next save.
+ *
+ * Like SegmentIndex, this is only valid as long as nobody else touches the
+ * journal file, so its expected length is checked before appending to it.
+ */
+class Journal {
+  private final String path;
+  private final SecretKey key;
+  private final long baseId;
+  private final IdentityHashMap<Secret, Integer> revisions =
+      new IdentityHashMap<Secret, Integer>();
+  private long length;
+
+  /**
+   * Creates the state of an empty journal.
+   *
+   * @param file The journal file.
+   * @param key The key used to encrypt the journal records.
+   * @param baseId The base id of the secrets file the journal applies to.
+   */
+  Journal(File file, SecretKey key, long baseId) {
+    this.path = file.getAbsolutePath();
+    this.key = key;
+    this.baseId = baseId;
+  }
+
+  /**
+   * Creates the state of an empty journal for a secrets file that has just
+   * been written, from the segments of that file.
+   *
+   * @param file The journal file.
+   * @param index The segment index of the secrets file.
+   */
+  static Journal fromIndex(File file, SegmentIndex index) {
+    Journal journal = new Journal(file, index.getKey(), index.getBaseId());
+    for (SegmentIndex.Segment segment : index.getSegments()) {
+      for (int i = 0; i < segment.secrets.length; ++i)
+        journal.put(segment.secrets[i], segment.revisions[i]);
+    }
+    return journal;
+  }
+
+  /** Returns the base id of the secrets file this journal applies to. */
+  long getBaseId() {
+    return baseId;
+  }
+
+  /** Returns the length of the journal file, zero if it does not exist. */
+  long getLength() {
+    return length;
+  }
+
+  /** Sets the length of the journal file after it was read or appended to. */
+  void setLength(long length) {
+    this.length = length;
+  }
+
+  /** Records that the given secrets are persisted as they are now. */
+  void putAll(List<Secret> secrets) {
+    for (Secret secret : secrets)
+      put(secret, secret.getRevision());
+  }
+
+  /** Records that the given secret is persisted at the given revision. */
+  void put(Secret secret, int revision) {
+    revisions.put(secret, revision);
+  }
+
+  /** Records that the given secret is no longer persisted. */
+  void remove(Secret secret) {
+    revisions.remove(secret);
+  }
+
+  /** Returns the secrets that are persisted. */
+  Set<Secret> getSecrets() {
+    return revisions.keySet();
+  }
+
+  /**
+   * Is the given secret persisted, in its current revision?  If not, it must
+   * be written to the journal on the next save.
+   */
+  boolean isPersisted(Secret secret) {
+    Integer revision = revisions.get(secret);
+    return null != revision && revision == secret.getRevision();
+  }
+
+  /**
+   * Can this state be used to append to the given journal file, when saving
+   * with the given key?
+   */
+  boolean isValidFor(File file, SecretKey key) {
+    return path.equals(file.getAbsolutePath()) && this.key.equals(key) &&
+        file.length() == length;
+  }
+}
@@ -0,0 +1,475 @@
+// Copyright (c) 2009, Google Inc.
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//      http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+
+package net.tawacentral.roger.secrets;
+
+import android.content.Context;
+import android.util.Log;
+
+import net.tawacentral.roger.secrets.SecurityUtils.CipherInfo;
+
+import java.io.BufferedInputStream;
+import java.io.ByteArrayOutputStream;
+import java.io.DataInputStream;
+import java.io.DataOutputStream;
+import java.io.EOFException;
+import java.io.File;
+import java.io.FileInputStream;
+import java.io.FileOutputStream;
+import java.io.IOException;
+import java.io.RandomAccessFile;
+import java.util.ArrayList;
+import java.util.Arrays;
+import java.util.HashMap;
+import java.util.IdentityHashMap;
+
+/**
+ * The edit journal of the main secrets file, see append().  The journal file
+ * is a header followed by encrypted frames, each holding the operations of
+ * one save.  The in memory state of the journal is a Journal.
+ */
+class JournalStore {
+  /** Tag for logging purposes. */
+  public static final String LOG_TAG = "JournalStore";
+
+  /**
+   * Lock for accessing the journal file.  A save of the secrets file only
+   * takes it to start a new journal, so that appending to the journal does
+   * not wait for the whole rewrite.  It is taken after FileUtils.lock when
+   * both are needed.
+   */
+  static final Object lock = new Object();
+
+  // Header and records of the journal file.  A journal record is a frame,
+  // like the segments of the secrets file, holding a sequence of operations.
+  private static final byte[] SIGNATURE_JOURNAL = {0x22, 0x34, 0x56, 0x7B};
+  private static final int JOURNAL_VERSION = 1;
+  private static final int FRAME_JOURNAL = 3;
+  private static final int OP_PUT = 1;
+  private static final int OP_DELETE = 2;
+
+  // The journal is folded into the secrets file once it is larger than both
+  // this size and half the size of the secrets file.
+  private static final long JOURNAL_COMPACT_SIZE = 32 * 1024;
+
+  /**
+   * State of the journal of the main secrets file, or null if the next save
+   * must rewrite the secrets file.  Guarded by lock.
+   */
+  private static Journal journal;
+
+  /**
+   * Records the changes made to the secrets since the last save in the
+   * journal, without rewriting the secrets file.
+   *
+   * The secrets are compared with the state of the journal: any secret that
+   * was added or modified is appended as a PUT operation, and any secret that
+   * is no longer in the list as a DELETE operation.  All the operations go
+   * into one encrypted record, and the journal is synced to disk before
+   * returning, so the cost of a save depends on the number of changed
+   * secrets rather than on the size of the vault.
+   *
+   * This fails if there is no journal state for the main secrets file, for
+   * example if the secrets were loaded from an older format or the password
+   * was changed.  In that case the caller must save the whole file with
+   * FileUtils.saveSecrets(), which also starts a new journal.
+   *
+   * This does not wait for a save of the secrets file in progress, except
+   * while it starts the new journal.
+   *
+   * @param context Activity context in which the save is called.
+   * @param info The key, salt and rounds to use with the file.
+   * @param secrets The collection of secrets to save.
+   * @return True if the changes, if any, are in the journal.
+   */
+  public static boolean append(Context context,
+                               CipherInfo info,
+                               ArrayList<Secret> secrets) {
+    Log.d(LOG_TAG, "JournalStore.append");
+    synchronized (lock) {
+      File file = context.getFileStreamPath(FileUtils.JOURNAL_FILE_NAME);
+      if (null == info || null == journal ||
+          !journal.isValidFor(file, info.key)) {
+        return false;
+      }
+
+      IdentityHashMap<Secret, Boolean> present =
+          new IdentityHashMap<Secret, Boolean>(secrets.size());
+      for (Secret secret : secrets)
+        present.put(secret, Boolean.TRUE);
+
+      RecordWriter plain = new RecordWriter();
+      RecordWriter record = new RecordWriter();
+      plain.writeRawBytes(FrameCodec.PAYLOAD_MAGIC, 0,
+                          FrameCodec.PAYLOAD_MAGIC.length);
+
+      // Deletes are written before puts, since a secret may be replaced by
+      // another one with the same id, for example after a restore.
+      ArrayList<Secret> deleted = new ArrayList<Secret>();
+      for (Secret secret : journal.getSecrets()) {
+        if (!present.containsKey(secret)) {
+          plain.writeRawVarint(OP_DELETE);
+          plain.writeRawVarint(secret.getId());
+          deleted.add(secret);
+        }
+      }
+
+      ArrayList<Secret> changed = new ArrayList<Secret>();
+      ArrayList<Integer> revisions = new ArrayList<Integer>();
+      try {
+        for (Secret secret : secrets) {
+          if (!journal.isPersisted(secret)) {
+            revisions.add(secret.getRevision());
+            record.reset();
+            secret.writeRecord(record, info.key, info.suite, false);
+            plain.writeRawVarint(OP_PUT);
+            plain.writeRawVarint(record.size());
+            plain.writeRawBytes(record);
+            changed.add(secret);
+          }
+        }
+      } catch (IOException ex) {
+        Log.e(LOG_TAG, "append", ex);
+        // The state no longer matches the secrets being saved, so it must not
+        // be used by FileUtils.saveSecrets() either.
+        journal = null;
+        return false;
+      }
+
+      if (deleted.isEmpty() && changed.isEmpty()) {
+        Log.d(LOG_TAG, "JournalStore.append: nothing to do");
+        AccessLogStore.flush(context, info, secrets, false);
+        return true;
+      }
+
+      FileOutputStream output = null;
+      try {
+        ByteArrayOutputStream bytes = new ByteArrayOutputStream();
+        if (0 == journal.getLength())
+          bytes.write(createHeader(info, journal.getBaseId()));
+        FrameCodec.writeFrame(bytes, FRAME_JOURNAL,
+                              FrameCodec.encryptFrame(info, plain, false));
+
+        output = new FileOutputStream(file, true);
+        bytes.writeTo(output);
+        output.flush();
+        output.getFD().sync();
+        journal.setLength(journal.getLength() + bytes.size());
+      } catch (Exception ex) {
+        Log.e(LOG_TAG, "append", ex);
+        // The journal may now end with a partial record.  Force the next save
+        // to rewrite the secrets file, which deletes the journal.
+        journal = null;
+        return false;
+      } finally {
+        try {if (null != output) output.close();} catch (IOException ex) {}
+      }
+
+      for (Secret secret : deleted)
+        journal.remove(secret);
+      for (int i = 0; i < changed.size(); ++i)
+        journal.put(changed.get(i), revisions.get(i));
+
+      Log.d(LOG_TAG, "JournalStore.append: deleted=" + deleted.size() +
+            " changed=" + changed.size() + " length=" + journal.getLength());
+      AccessLogStore.flush(context, info, secrets, false);
+      return true;
+    }
+  }
+
+  /**
+   * Should the journal be folded into the secrets file?  This is true when
+   * the journal has grown large compared to the secrets file, or when there
+   * is no usable journal.
+   *
+   * @param context Activity context in which the save is called.
+   * @return True if the next save should be done with FileUtils.saveSecrets().
+   */
+  public static boolean isFull(Context context) {
+    synchronized (lock) {
+      if (null == journal)
+        return true;
+
+      long base =
+          context.getFileStreamPath(FileUtils.SECRETS_FILE_NAME).length();
+      return journal.getLength() > Math.max(JOURNAL_COMPACT_SIZE, base / 2);
+    }
+  }
+
+  /**
+   * Does the secrets file hold all the saved changes, with an empty journal?
+   *
+   * @param context Activity context in which the save is called.
+   */
+  public static boolean isEmpty(Context context) {
+    synchronized (lock) {
+      return null != journal && 0 == journal.getLength();
+    }
+  }
+
+  /**
+   * Forgets the state of the journal, so that the next save rewrites the
+   * secrets file.
+   */
+  static void reset() {
+    synchronized (lock) {
+      journal = null;
+    }
+  }
+
+  /** Forgets the state of the journal and deletes the journal file. */
+  static void delete(Context context) {
+    synchronized (lock) {
+      journal = null;
+      context.deleteFile(FileUtils.JOURNAL_FILE_NAME);
+    }
+  }
+
+  /**
+   * Applies the journal to the secrets just read from the main secrets file,
+   * and keeps its state for the next appends, see replay().
+   *
+   * @param context Activity context in which the load is called.
+   * @param info The key, salt and rounds of the secrets file.
+   * @param baseId The base id of the secrets file.
+   * @param secrets The secrets read from the secrets file, modified in place.
+   */
+  static void load(Context context,
+                   CipherInfo info,
+                   long baseId,
+                   ArrayList<Secret> secrets) {
+    synchronized (lock) {
+      journal = replay(context, info, baseId, secrets);
+    }
+  }
+
+  /**
+   * Starts a new journal for a secrets file that has just been written.
+   *
+   * The old journal may also hold edits appended since the secrets written
+   * were collected: its state tells which secrets it holds and their
+   * revisions, so appending them to the new journal writes those edits again.
+   * The caller holds lock, taken before the new file replaced the old one, so
+   * that nothing is appended to the old journal in between.
+   *
+   * @param context Activity context in which the save is called.
+   * @param info The key, salt and rounds of the new file.
+   * @param file The journal file.
+   * @param previous The segment index of the file that was replaced, or null
+   *     if the edits of the old journal must not be written again.
+   * @param index The segment index of the new file.
+   */
+  static void restart(Context context,
+                      CipherInfo info,
+                      File file,
+                      SegmentIndex previous,
+                      SegmentIndex index) {
+    Journal appended = journal;
+    boolean replay = null != appended && null != previous &&
+        appended.getBaseId() == previous.getBaseId() &&
+        appended.isValidFor(file, info.key);
+    file.delete();
+    journal = Journal.fromIndex(file, index);
+    if (replay && !append(context, info,
+        new ArrayList<Secret>(appended.getSecrets()))) {
+      // Those edits are now only in memory.  Make sure the next save
+      // writes them, even if nothing else changes.
+      Log.d(LOG_TAG, "JournalStore.restart: could not journal new edits");
+      ChangeTracker.changed();
+    }
+  }
+
+  /** Creates the header of a journal file. */
+  private static byte[] createHeader(CipherInfo info, long baseId)
+      throws IOException {
+    ByteArrayOutputStream bytes = new ByteArrayOutputStream();
+    DataOutputStream header = new DataOutputStream(bytes);
+    header.write(SIGNATURE_JOURNAL);
+    header.write(JOURNAL_VERSION);
+    header.write(info.salt.length);
+    header.write(info.salt);
+    header.write(info.rounds);
+    header.writeLong(baseId);
+    header.flush();
+    return bytes.toByteArray();
+  }
+
+  /**
+   * Applies the journal to the secrets just read from the main secrets file.
+   * A journal that belongs to another version of the secrets file is
+   * deleted, and a partial record at the end of the journal, left behind if
+   * the process died while appending, is truncated away.
+   *
+   * @param context Activity context in which the load is called.
+   * @param info The key, salt and rounds of the secrets file.
+   * @param baseId The base id of the secrets file.
+   * @param secrets The secrets read from the secrets file, modified in place.
+   * @return The state of the journal, or null if the next save must rewrite
+   *     the secrets file.
+   */
+  private static Journal replay(Context context,
+                                CipherInfo info,
+                                long baseId,
+                                ArrayList<Secret> secrets) {
+    File file = context.getFileStreamPath(FileUtils.JOURNAL_FILE_NAME);
+    Journal state = new Journal(file, info.key, baseId);
+
+    if (file.exists()) {
+      RandomAccessFile output = null;
+      try {
+        long length = read(file, info, baseId, secrets);
+        if (0 == length) {
+          if (!file.delete())
+            return null;
+        } else if (length < file.length()) {
+          output = new RandomAccessFile(file, "rw");
+          output.setLength(length);
+        }
+        state.setLength(length);
+      } catch (Exception ex) {
+        Log.e(LOG_TAG, "replay", ex);
+        return null;
+      } finally {
+        try {if (null != output) output.close();} catch (IOException ex) {}
+      }
+    }
+
+    state.putAll(secrets);
+    return state;
+  }
+
+  /**
+   * Reads the records of a journal file and applies them to the secrets.
+   * Reading stops at the first record that is truncated or cannot be
+   * decrypted.
+   *
+   * @return The length of the valid part of the journal, or zero if it does
+   *     not belong to the secrets file with the given base id.
+   * @throws IOException if the file cannot be read.
+   */
+  private static long read(File file,
+                           CipherInfo info,
+                           long baseId,
+                           ArrayList<Secret> secrets)
+      throws IOException {
+    DataInputStream input = new DataInputStream(
+        new BufferedInputStream(new FileInputStream(file)));
+    try {
+      byte[] signature = new byte[SIGNATURE_JOURNAL.length];
+      byte[] salt;
+      int version;
+      int rounds;
+      long id;
+      try {
+        input.readFully(signature);
+        version = input.readUnsignedByte();
+        salt = new byte[input.readUnsignedByte()];
+        input.readFully(salt);
+        rounds = input.readUnsignedByte();
+        id = input.readLong();
+      } catch (EOFException ex) {
+        return 0;
+      }
+
+      if (!Arrays.equals(signature, SIGNATURE_JOURNAL) ||
+          JOURNAL_VERSION != version || !Arrays.equals(salt, info.salt) ||
+          rounds != info.rounds || id != baseId) {
+        Log.d(LOG_TAG, "JournalStore.read: journal is stale");
+        return 0;
+      }
+
+      long length = SIGNATURE_JOURNAL.length + 2 + salt.length + 1 + 8;
+      HashMap<Long, Integer> positions =
+          new HashMap<Long, Integer>(secrets.size() * 2);
+      for (int i = 0; i < secrets.size(); ++i)
+        positions.put(secrets.get(i).getId(), i);
+
+      int records = 0;
+      boolean removed = false;
+      for (;;) {
+        int kind = input.read();
+        if (kind < 0)
+          break;
+
+        // Decode the whole record before applying it, so that a damaged
+        // record is not applied partially.
+        ArrayList<Long> deletes = new ArrayList<Long>();
+        ArrayList<Secret> puts = new ArrayList<Secret>();
+        int frameLength;
+        try {
+          if (FRAME_JOURNAL != kind)
+            throw new IOException("Unknown frame kind " + kind);
+
+          int payloadLength =
+              FrameCodec.readLength(input, FrameCodec.MAX_FRAME_LENGTH);
+          byte[] payload = new byte[payloadLength];
+          input.readFully(payload);
+          frameLength = 1 + RecordWriter.rawVarintSize(payloadLength) +
+              payloadLength;
+
+          RecordReader reader = FrameCodec.decryptFrame(info, payload, false);
+          while (reader.hasMore()) {
+            long op = reader.readRawVarint();
+            if (OP_PUT == op) {
+              puts.add(Secret.fromRecord(reader.readRecord(), info.key));
+            } else if (OP_DELETE == op) {
+              deletes.add(reader.readRawVarint());
+            } else {
+              throw new IOException("Unknown journal operation " + op);
+            }
+          }
+        } catch (IOException ex) {
+          Log.w(LOG_TAG, "JournalStore.read: ignoring damaged record", ex);
+          break;
+        }
+
+        for (Long secretId : deletes) {
+          Integer position = positions.remove(secretId);
+          if (null != position) {
+            secrets.set(position, null);
+            removed = true;
+          }
+        }
+        for (Secret secret : puts) {
+          Integer position = positions.get(secret.getId());
+          if (null != position) {
+            secrets.set(position, secret);
+          } else {
+            positions.put(secret.getId(), secrets.size());
+            secrets.add(secret);
+          }
+        }
+
+        length += frameLength;
+        ++records;
+      }
+
+      if (removed) {
+        int j = 0;
+        for (int i = 0; i < secrets.size(); ++i) {
+          Secret secret = secrets.get(i);
+          if (null != secret)
+            secrets.set(j++, secret);
+        }
+        while (secrets.size() > j)
+          secrets.remove(secrets.size() - 1);
+      }
+
+      Log.d(LOG_TAG, "JournalStore.read: records=" + records);
+      return length;
+    } finally {
+      try {input.close();} catch (IOException ex) {}
+    }
+  }
+}
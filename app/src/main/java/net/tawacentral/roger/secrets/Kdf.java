@@ -0,0 +1,476 @@
+// Copyright (c) 2009, Google Inc.
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//      http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+
+package net.tawacentral.roger.secrets;
+
+import java.nio.charset.StandardCharsets;
+import java.security.GeneralSecurityException;
+import java.util.Arrays;
+
+import javax.crypto.Mac;
+import javax.crypto.spec.SecretKeySpec;
+
+import org.mindrot.jbcrypt.BCrypt;
+
+import android.util.Log;
+
+/**
+ * A key derivation function, which turns the password into the key of the
+ * secrets, together with its fixed parameters.
+ *
+ * The cost of every function is given as a base 2 logarithm, between
+ * MIN_COST and MAX_COST: the rounds of bcrypt, the number of iterations of
+ * PBKDF2, and the CPU and memory cost N of scrypt.  This is the rounds byte
+ * of the file headers, so incrementing it always doubles the time needed to
+ * derive the key, whatever the function.  Files written before functions
+ * were selectable all use BCRYPT.
+ *
+ * Instances are immutable.
+ */
+public class Kdf {
+  /** Id of bcrypt, the function of all files without one in their header. */
+  public static final int BCRYPT = 0;
+  /** Id of PBKDF2 with HMAC-SHA256. */
+  public static final int PBKDF2_SHA256 = 1;
+  /** Id of scrypt, which needs as much memory as time. */
+  public static final int SCRYPT = 2;
+
+  /** Lowest and highest costs. */
+  public static final int MIN_COST = 4;
+  public static final int MAX_COST = 31;
+
+  /** Length of the derived keys, in bytes. */
+  public static final int KEY_LENGTH = 32;
+
+  /** The bcrypt function. */
+  public static final Kdf DEFAULT = new Kdf(BCRYPT, 0, 0);
+
+  /** Tag for logging purposes. */
+  public static final String LOG_TAG = "Kdf";
+
+  // The scrypt block size and parallelization used for new keys.  With
+  // r = 8, scrypt needs 1KB of memory per unit of N.
+  private static final int SCRYPT_R = 8;
+  private static final int SCRYPT_P = 1;
+  private static final int SCRYPT_MAX_R = 32;
+  private static final int SCRYPT_MAX_P = 16;
+
+  // scrypt may use at most this fraction of the heap of the application.
+  private static final int SCRYPT_HEAP_FRACTION = 4;
+
+  private static final String HMAC = "HmacSHA256";
+  private static final int HMAC_LENGTH = 32;
+
+  // Cost at which each function is first timed by calibrate(), fast enough
+  // on slow devices yet long enough to be measurable.
+  private static final int[] CALIBRATION_COST = {4, 12, 10};
+
+  // calibrate() runs the function this many times before timing it, so that
+  // it is compiled, then keeps the median of CALIBRATION_SAMPLES runs.  The
+  // check runs are CHECK_STEPS below the estimated cost, so each takes about
+  // an eighth of the target time.
+  private static final int CALIBRATION_WARMUPS = 3;
+  private static final int CALIBRATION_SAMPLES = 5;
+  private static final int CHECK_SAMPLES = 3;
+  private static final int CHECK_STEPS = 3;
+
+  private static final int[] BCRYPT_PLAINTEXT =
+      {0x155cbf8e, 0x57f57513, 0x3da787b9, 0x71679d82,
+       0x7cf72e93, 0x1ae25274, 0x64b54adc, 0x335cbd0b};
+
+  private final int id;
+  private final int r;
+  private final int p;
+
+  private Kdf(int id, int r, int p) {
+    this.id = id;
+    this.r = r;
+    this.p = p;
+  }
+
+  /**
+   * Returns the function with the given id, with the parameters used for new
+   * keys, or null if the id is unknown.
+   */
+  public static Kdf create(int id) {
+    switch (id) {
+      case BCRYPT:
+        return DEFAULT;
+      case PBKDF2_SHA256:
+        return new Kdf(PBKDF2_SHA256, 0, 0);
+      case SCRYPT:
+        return new Kdf(SCRYPT, SCRYPT_R, SCRYPT_P);
+      default:
+        return null;
+    }
+  }
+
+  /**
+   * Returns the function with the given id and parameters, as read from a
+   * file header, or null if they are unknown or invalid.
+   */
+  public static Kdf decode(int id, byte[] params) {
+    switch (id) {
+      case BCRYPT:
+      case PBKDF2_SHA256:
+        return 0 == params.length ? create(id) : null;
+      case SCRYPT:
+        if (2 != params.length)
+          return null;
+        int r = params[0] & 0xff;
+        int p = params[1] & 0xff;
+        if (r < 1 || r > SCRYPT_MAX_R || p < 1 || p > SCRYPT_MAX_P)
+          return null;
+        return new Kdf(SCRYPT, r, p);
+      default:
+        return null;
+    }
+  }
+
+  /** Returns the id of the function, for example BCRYPT. */
+  public int getId() {
+    return id;
+  }
+
+  /** Returns the parameters of the function, as stored in file headers. */
+  public byte[] getParams() {
+    return SCRYPT == id ? new byte[] {(byte) r, (byte) p} : new byte[0];
+  }
+
+  /**
+   * Returns the highest cost to choose for a new key on this device.  For
+   * scrypt, this is limited by the memory available to the application.
+   * Existing keys may have a higher cost, see deriveKey().
+   */
+  public int getMaxCost() {
+    if (SCRYPT != id)
+      return MAX_COST;
+
+    long limit = Runtime.getRuntime().maxMemory() / SCRYPT_HEAP_FRACTION;
+    int cost = MIN_COST;
+    while (cost < MAX_COST && getScryptMemory(cost + 1) <= limit &&
+           isValidCost(cost + 1))
+      ++cost;
+    return cost;
+  }
+
+  /**
+   * Is the cost in range?  The table of scrypt must also fit in a single
+   * array, whatever the memory of the device.
+   */
+  private boolean isValidCost(int cost) {
+    return cost >= MIN_COST && cost <= MAX_COST &&
+        (SCRYPT != id || getScryptMemory(cost) / 4 < Integer.MAX_VALUE);
+  }
+
+  /**
+   * Does deriving a key at the given cost need more memory than this device
+   * gives the application?  Only scrypt needs much memory.
+   */
+  public boolean exceedsMemory(int cost) {
+    return SCRYPT == id &&
+        getScryptMemory(cost) > Runtime.getRuntime().maxMemory();
+  }
+
+  /** Returns the memory needed by scrypt at the given cost, in bytes. */
+  private long getScryptMemory(int cost) {
+    return 128L * r * (1L << cost);
+  }
+
+  /**
+   * Derives a key from the password.
+   *
+   * @param password The password.
+   * @param salt The salt.
+   * @param cost The cost, between MIN_COST and MAX_COST.  A cost read from
+   *     a file may be higher than getMaxCost(), if the file was written on a
+   *     device with more memory, so it is tried anyway.
+   * @return The key, KEY_LENGTH bytes long.
+   * @throws GeneralSecurityException if the key cannot be derived, for
+   *     example because the cost is out of range or because there is not
+   *     enough memory.
+   */
+  public byte[] deriveKey(String password, byte[] salt, int cost)
+      throws GeneralSecurityException {
+    if (!isValidCost(cost))
+      throw new GeneralSecurityException("Invalid cost " + cost);
+
+    switch (id) {
+      case BCRYPT:
+        // Append a null at the end of the password string to prevent multiple
+        // repetitions of the password from being valid.
+        return new BCrypt().crypt_raw(
+            (password + '\000').getBytes(StandardCharsets.UTF_8), salt, cost,
+            BCRYPT_PLAINTEXT.clone());
+      case PBKDF2_SHA256:
+        return pbkdf2(password.getBytes(StandardCharsets.UTF_8), salt,
+                      1L << cost, KEY_LENGTH);
+      case SCRYPT:
+        return scrypt(password.getBytes(StandardCharsets.UTF_8), salt,
+                      1 << cost);
+      default:
+        throw new GeneralSecurityException("Unknown function " + id);
+    }
+  }
+
+  /**
+   * Determines the highest cost that derives a key within the given time on
+   * this device.  Each increment of the cost doubles the work, and this
+   * assumes that time is proportional to work, so if Tc is the time at cost
+   * c, the time at cost n is:
+   *
+   *   Tn = 2^(n - c) * Tc
+   *
+   * and the best cost is the floor of c + log2(target / Tc).
+   *
+   * The function is first timed at a low cost, after a few warm up runs,
+   * keeping the median of several runs to discard pauses.  Since fixed costs
+   * weigh more at a low cost, the estimate is then checked by timing the
+   * function again at a cost a few steps below it, and the result is
+   * extrapolated from that second time.  This takes about half the target
+   * time, so the result should be cached, see KdfCalibration.
+   *
+   * @param targetMillis The longest time to derive a key, in millisecs.
+   * @return The cost, between MIN_COST and getMaxCost().
+   */
+  public int calibrate(long targetMillis) {
+    long target = targetMillis * 1000000L;
+    byte[] salt = new byte[BCrypt.BCRYPT_SALT_LEN];
+    int low = CALIBRATION_COST[id];
+    try {
+      for (int i = 0; i < CALIBRATION_WARMUPS; ++i)
+        deriveKey("calibration", salt, low);
+      long lowTime = medianTime(salt, low, CALIBRATION_SAMPLES);
+      int estimate = extrapolate(low, lowTime, target);
+
+      int high = estimate - CHECK_STEPS;
+      if (high <= low) {
+        Log.d(LOG_TAG, "calibrate " + this + ": time(" + low + ")=" +
+              lowTime + "ns cost=" + estimate);
+        return estimate;
+      }
+
+      long highTime = medianTime(salt, high, CHECK_SAMPLES);
+      int cost = extrapolate(high, highTime, target);
+      Log.d(LOG_TAG, "calibrate " + this + ": time(" + low + ")=" + lowTime +
+            "ns estimate=" + estimate + " time(" + high + ")=" + highTime +
+            "ns cost=" + cost);
+      return cost;
+    } catch (GeneralSecurityException ex) {
+      Log.d(LOG_TAG, "calibrate " + this, ex);
+      return MIN_COST;
+    }
+  }
+
+  /**
+   * Returns the median of the given number of times to derive a key at the
+   * given cost, in nanosecs.
+   */
+  private long medianTime(byte[] salt, int cost, int samples)
+      throws GeneralSecurityException {
+    long[] times = new long[samples];
+    for (int i = 0; i < samples; ++i) {
+      long start = System.nanoTime();
+      deriveKey("calibration", salt, cost);
+      times[i] = System.nanoTime() - start;
+    }
+    Arrays.sort(times);
+    return times[samples / 2];
+  }
+
+  /**
+   * Returns the highest cost that takes less than target nanosecs, given the
+   * time at the given cost.
+   */
+  private int extrapolate(int cost, long time, long target) {
+    double n = cost + (Math.log(target) - Math.log(Math.max(1, time))) /
+        Math.log(2);
+    return (int) Math.max(MIN_COST, Math.min(getMaxCost(), Math.floor(n)));
+  }
+
+  /**
+   * Computes PBKDF2 with HMAC-SHA256, as defined in RFC 8018.  Implemented
+   * here since SecretKeyFactory only supports it from API level 26.
+   */
+  private static byte[] pbkdf2(byte[] password, byte[] salt, long iterations,
+                               int length) throws GeneralSecurityException {
+    Mac mac = Mac.getInstance(HMAC);
+    // An empty password is not a valid key for the Mac, but it is the same
+    // as a single zero byte, since HMAC pads keys with zeros.
+    mac.init(new SecretKeySpec(0 == password.length ? new byte[1] : password,
+                               HMAC));
+
+    byte[] key = new byte[length];
+    byte[] u = new byte[HMAC_LENGTH];
+    byte[] t = new byte[HMAC_LENGTH];
+    for (int block = 1, offset = 0; offset < length; ++block) {
+      mac.update(salt);
+      mac.update((byte) (block >>> 24));
+      mac.update((byte) (block >>> 16));
+      mac.update((byte) (block >>> 8));
+      mac.update((byte) block);
+      mac.doFinal(u, 0);
+      System.arraycopy(u, 0, t, 0, HMAC_LENGTH);
+      for (long i = 1; i < iterations; ++i) {
+        mac.update(u);
+        mac.doFinal(u, 0);
+        for (int j = 0; j < HMAC_LENGTH; ++j)
+          t[j] ^= u[j];
+      }
+
+      int count = Math.min(HMAC_LENGTH, length - offset);
+      System.arraycopy(t, 0, key, offset, count);
+      offset += count;
+    }
+    Arrays.fill(u, (byte) 0);
+    Arrays.fill(t, (byte) 0);
+    return key;
+  }
+
+  /** Computes scrypt, as defined in RFC 7914, with the parameters r and p. */
+  private byte[] scrypt(byte[] password, byte[] salt, int n)
+      throws GeneralSecurityException {
+    int blockLength = 128 * r;
+    byte[] b = pbkdf2(password, salt, 1, p * blockLength);
+
+    int words = blockLength / 4;
+    int[] x = new int[words];
+    int[] y = new int[words];
+    int[] t = new int[16];
+    int[] v;
+    try {
+      v = new int[words * n];
+    } catch (OutOfMemoryError ex) {
+      throw new GeneralSecurityException("Not enough memory for scrypt: " +
+          (getScryptMemory(Integer.numberOfTrailingZeros(n)) >> 20) +
+          "MB needed, " + (Runtime.getRuntime().maxMemory() >> 20) +
+          "MB available");
+    }
+    for (int i = 0; i < p; ++i) {
+      int offset = i * blockLength;
+      for (int k = 0; k < words; ++k) {
+        int o = offset + k * 4;
+        x[k] = (b[o] & 0xff) | (b[o + 1] & 0xff) << 8 |
+            (b[o + 2] & 0xff) << 16 | (b[o + 3] & 0xff) << 24;
+      }
+
+      // ROMix.
+      for (int k = 0; k < n; ++k) {
+        System.arraycopy(x, 0, v, k * words, words);
+        blockMix(x, y, t);
+      }
+      for (int k = 0; k < n; ++k) {
+        int j = x[words - 16] & (n - 1);
+        for (int m = 0; m < words; ++m)
+          x[m] ^= v[j * words + m];
+        blockMix(x, y, t);
+      }
+
+      for (int k = 0; k < words; ++k) {
+        int o = offset + k * 4;
+        b[o] = (byte) x[k];
+        b[o + 1] = (byte) (x[k] >>> 8);
+        b[o + 2] = (byte) (x[k] >>> 16);
+        b[o + 3] = (byte) (x[k] >>> 24);
+      }
+    }
+    Arrays.fill(v, 0);
+
+    byte[] key = pbkdf2(password, b, 1, KEY_LENGTH);
+    Arrays.fill(b, (byte) 0);
+    return key;
+  }
+
+  /**
+   * The scrypt BlockMix function with Salsa20/8, on the 2 * r blocks of 16
+   * words in b, using y and x as scratch space.
+   */
+  private void blockMix(int[] b, int[] y, int[] x) {
+    System.arraycopy(b, (2 * r - 1) * 16, x, 0, 16);
+    for (int i = 0; i < 2 * r; ++i) {
+      for (int k = 0; k < 16; ++k)
+        x[k] ^= b[i * 16 + k];
+      salsa208(x);
+      // Even blocks go to the first half, odd blocks to the second.
+      int target = (i / 2 + (i % 2) * r) * 16;
+      System.arraycopy(x, 0, y, target, 16);
+    }
+    System.arraycopy(y, 0, b, 0, 32 * r);
+  }
+
+  /** The Salsa20/8 core, applied in place to 16 words. */
+  private static void salsa208(int[] b) {
+    int x0 = b[0], x1 = b[1], x2 = b[2], x3 = b[3];
+    int x4 = b[4], x5 = b[5], x6 = b[6], x7 = b[7];
+    int x8 = b[8], x9 = b[9], x10 = b[10], x11 = b[11];
+    int x12 = b[12], x13 = b[13], x14 = b[14], x15 = b[15];
+    for (int i = 0; i < 8; i += 2) {
+      x4 ^= Integer.rotateLeft(x0 + x12, 7);
+      x8 ^= Integer.rotateLeft(x4 + x0, 9);
+      x12 ^= Integer.rotateLeft(x8 + x4, 13);
+      x0 ^= Integer.rotateLeft(x12 + x8, 18);
+      x9 ^= Integer.rotateLeft(x5 + x1, 7);
+      x13 ^= Integer.rotateLeft(x9 + x5, 9);
+      x1 ^= Integer.rotateLeft(x13 + x9, 13);
+      x5 ^= Integer.rotateLeft(x1 + x13, 18);
+      x14 ^= Integer.rotateLeft(x10 + x6, 7);
+      x2 ^= Integer.rotateLeft(x14 + x10, 9);
+      x6 ^= Integer.rotateLeft(x2 + x14, 13);
+      x10 ^= Integer.rotateLeft(x6 + x2, 18);
+      x3 ^= Integer.rotateLeft(x15 + x11, 7);
+      x7 ^= Integer.rotateLeft(x3 + x15, 9);
+      x11 ^= Integer.rotateLeft(x7 + x3, 13);
+      x15 ^= Integer.rotateLeft(x11 + x7, 18);
+      x1 ^= Integer.rotateLeft(x0 + x3, 7);
+      x2 ^= Integer.rotateLeft(x1 + x0, 9);
+      x3 ^= Integer.rotateLeft(x2 + x1, 13);
+      x0 ^= Integer.rotateLeft(x3 + x2, 18);
+      x6 ^= Integer.rotateLeft(x5 + x4, 7);
+      x7 ^= Integer.rotateLeft(x6 + x5, 9);
+      x4 ^= Integer.rotateLeft(x7 + x6, 13);
+      x5 ^= Integer.rotateLeft(x4 + x7, 18);
+      x11 ^= Integer.rotateLeft(x10 + x9, 7);
+      x8 ^= Integer.rotateLeft(x11 + x10, 9);
+      x9 ^= Integer.rotateLeft(x8 + x11, 13);
+      x10 ^= Integer.rotateLeft(x9 + x8, 18);
+      x12 ^= Integer.rotateLeft(x15 + x14, 7);
+      x13 ^= Integer.rotateLeft(x12 + x15, 9);
+      x14 ^= Integer.rotateLeft(x13 + x12, 13);
+      x15 ^= Integer.rotateLeft(x14 + x13, 18);
+    }
+    b[0] += x0; b[1] += x1; b[2] += x2; b[3] += x3;
+    b[4] += x4; b[5] += x5; b[6] += x6; b[7] += x7;
+    b[8] += x8; b[9] += x9; b[10] += x10; b[11] += x11;
+    b[12] += x12; b[13] += x13; b[14] += x14; b[15] += x15;
+  }
+
+  @Override
+  public boolean equals(Object o) {
+    if (!(o instanceof Kdf))
+      return false;
+    Kdf other = (Kdf) o;
+    return id == other.id && r == other.r && p == other.p;
+  }
+
+  @Override
+  public int hashCode() {
+    return (id * 31 + r) * 31 + p;
+  }
+
+  @Override
+  public String toString() {
+    return SCRYPT == id ? "Kdf(" + id + ", r=" + r + ", p=" + p + ")"
+                        : "Kdf(" + id + ")";
+  }
+}
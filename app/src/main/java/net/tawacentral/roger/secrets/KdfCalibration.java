@@ -0,0 +1,106 @@
+// Copyright (c) 2009, Google Inc.
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//      http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+
+package net.tawacentral.roger.secrets;
+
+import java.util.concurrent.ExecutorService;
+import java.util.concurrent.Executors;
+
+import android.content.Context;
+import android.content.SharedPreferences;
+import android.os.Build;
+import android.util.Log;
+
+/**
+ * Costs of the key derivation functions that derive a key within
+ * SecurityUtils.UNLOCK_TARGET_MS on this device, see Kdf.calibrate().
+ *
+ * Calibrating takes about half a second per function, so the costs are
+ * cached in preferences.  The cache is tied to the build of the device and
+ * the version of the application, since a system update or a new version
+ * of the code may change the speed of the functions, and since preferences
+ * are backed up and may be restored on another device.
+ *
+ * Calibrations are serialized, so that they do not skew each other's times,
+ * and a caller asking for a cost that is being calibrated in the background
+ * waits for the result.
+ */
+public class KdfCalibration {
+  /** Name of the preferences file holding the costs. */
+  public static final String PREFS_FILE_NAME = "calibration";
+
+  /** Tag for logging purposes. */
+  public static final String LOG_TAG = "KdfCalibration";
+
+  // Preference holding the build and version the costs were calibrated on.
+  private static final String PREF_BUILD = "build";
+  // Prefix of the preferences holding the cost of each function.
+  private static final String PREF_COST_PREFIX = "cost_";
+
+  private static final ExecutorService worker =
+      Executors.newSingleThreadExecutor();
+
+  private KdfCalibration() {
+  }
+
+  /**
+   * Returns the cost of the given function on this device, calibrating it
+   * if it is not cached yet.  This may block for about half a second.
+   *
+   * @param context Any context of the application.
+   * @param kdf The key derivation function.
+   * @return The cost, between Kdf.MIN_COST and kdf.getMaxCost().
+   */
+  public static synchronized int getCost(Context context, Kdf kdf) {
+    SharedPreferences prefs = context.getSharedPreferences(PREFS_FILE_NAME, 0);
+    String build = getBuild();
+    String key = PREF_COST_PREFIX + kdf;
+    if (build.equals(prefs.getString(PREF_BUILD, null))) {
+      int cost = prefs.getInt(key, 0);
+      if (cost >= Kdf.MIN_COST && cost <= kdf.getMaxCost())
+        return cost;
+    } else {
+      prefs.edit().clear().putString(PREF_BUILD, build).apply();
+    }
+
+    SecurityUtils.ExecutionTimer timer = new SecurityUtils.ExecutionTimer();
+    int cost = kdf.calibrate(SecurityUtils.UNLOCK_TARGET_MS);
+    timer.logElapsed("Time to calibrate " + kdf + ": ");
+    prefs.edit().putInt(key, cost).apply();
+    return cost;
+  }
+
+  /**
+   * Calibrates the given function on a worker thread, unless its cost is
+   * already cached, so that getCost() returns right away later.
+   *
+   * @param context Any context of the application.
+   * @param kdf The key derivation function.
+   */
+  public static void calibrateInBackground(Context context, final Kdf kdf) {
+    final Context app = context.getApplicationContext();
+    worker.execute(new Runnable() {
+      @Override
+      public void run() {
+        int cost = getCost(app, kdf);
+        Log.d(LOG_TAG, "calibrateInBackground " + kdf + ": cost=" + cost);
+      }
+    });
+  }
+
+  /** Identifies the build of the device and the version of the code. */
+  private static String getBuild() {
+    return Build.FINGERPRINT + "/" + BuildConfig.VERSION_CODE;
+  }
+}
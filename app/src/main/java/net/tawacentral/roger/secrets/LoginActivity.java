@@ -18,6 +18,7 @@ import android.annotation.SuppressLint;
 import android.app.Activity;
 import android.app.AlertDialog;
 import android.app.Dialog;
+import android.app.ProgressDialog;
 import android.content.DialogInterface;
 import android.content.Intent;
 import android.os.Bundle;
@@ -34,12 +35,8 @@ import android.widget.EditText;
 import android.widget.TextView;
 import android.widget.Toast;
 
-import java.io.File;
 import java.text.MessageFormat;
 import java.util.ArrayList;
-import java.util.Collections;
-
-import javax.crypto.Cipher;
 
 /**
  * This activity handles logging into the application.  It prompts the user for
@@ -71,6 +68,39 @@ public class LoginActivity extends Activity implements TextWatcher {
   private boolean isValidatingPassword;
   private String passwordString;
   private Toast toast;
+  private ProgressDialog progressDialog; // progress of the unlock job
+
+  // The unlock running in the background, or finished but not yet reported.
+  // Kept across activities so that the result goes to the current instance
+  // of this activity, even if the one that started it was destroyed, for
+  // example by an orientation change.
+  private static UnlockJob unlockJob;
+
+  private final UnlockJob.Listener unlockListener = new UnlockJob.Listener() {
+    @Override
+    public void onProgress(UnlockJob job, int stage) {
+      if (null != progressDialog && UnlockJob.STAGE_LOADING == stage)
+        progressDialog.setMessage(getText(R.string.unlock_loading));
+    }
+
+    @Override
+    public void onFinished(UnlockJob job) {
+      if (null != progressDialog) {
+        progressDialog.dismiss();
+        progressDialog = null;
+      }
+      if (job == unlockJob)
+        unlockJob = null;
+
+      if (null != job.getSecrets()) {
+        showSecrets(job);
+      } else if (0 != job.getError()) {
+        // TODO(rogerta): need better error message here. There are probably
+        // many reasons that we might not be able to open the file.
+        showToast(job.getError(), Toast.LENGTH_LONG);
+      }
+    }
+  };
 
   /** Called when the activity is first created. */
   @Override
@@ -112,9 +142,32 @@ public class LoginActivity extends Activity implements TextWatcher {
     password.addTextChangedListener(this);
 
     FileUtils.cleanupDataFiles(this);
+
+    // An unlock started by a previous instance of this activity reports to
+    // this one.
+    if (null != unlockJob) {
+      if (!unlockJob.isFinished())
+        showUnlockProgress();
+      unlockJob.setListener(unlockListener);
+    }
+
     Log.d(LOG_TAG, "LoginActivity.onCreate done");
   }
 
+  @Override
+  protected void onDestroy() {
+    // An unlock keeps running, and reports to the next instance of this
+    // activity.
+    if (null != progressDialog) {
+      progressDialog.dismiss();
+      progressDialog = null;
+    }
+    if (null != unlockJob)
+      unlockJob.setListener(null);
+
+    super.onDestroy();
+  }
+
   /**
    * Reset the activity's UI when we come back from any other activity on
    * the phone.
@@ -154,6 +207,10 @@ public class LoginActivity extends Activity implements TextWatcher {
       instructions.setText(R.string.login_instruction_1);
       strength.setVisibility(TextView.VISIBLE);
       updatePasswordStrengthView(password.getText().toString());
+
+      // The cost of the new key is calibrated while the user types their
+      // password, so that creating the key does not take longer.
+      KdfCalibration.calibrateInBackground(this, Kdf.DEFAULT);
     } else {
       instructions.setText("");
       strength.setVisibility(TextView.GONE);
@@ -271,8 +328,9 @@ public class LoginActivity extends Activity implements TextWatcher {
     // since we *will* be entering the program, but with incorrect ciphers.
     // This means that on exit, the secrets will be encrypted with an incorrect
     // "password", making it impossible for the user to login again, since this
-    // "password" will be unknown to the user.
-    if (null != secrets) {
+    // "password" will be unknown to the user.  Likewise, ignore clicks while
+    // the secrets are being unlocked.
+    if (null != secrets || null != unlockJob) {
       Log.d(LOG_TAG, "LoginActivity.handlePasswordClick ignoring");
       return;
     }
@@ -326,66 +384,41 @@ public class LoginActivity extends Activity implements TextWatcher {
 
     passwordView.setText("");
 
-    // Lets not save the password in memory anywhere.  Create all the ciphers
-    // we will need based on the password and save those.  First get the salt
-    // that is unique for this device.  If we can't find one, null is returned.
-    FileUtils.SaltAndRounds pair = FileUtils.getSaltAndRounds(this,
-        FileUtils.SECRETS_FILE_NAME);
-    SecurityUtils.saveCiphers(SecurityUtils.createCiphers(passwordString,
-                                                          pair.salt,
-                                                          pair.rounds));
-
-    ArrayList<Secret> loadedSecrets = null;
+    // Lets not save the password in memory anywhere.  The job creates all the
+    // ciphers we will need based on the password and saves those, then loads
+    // the secrets, on a worker thread.
+    unlockJob = UnlockJob.start(this, passwordString, isFirstRun,
+                                unlockListener);
+    this.passwordString = null;
+    showUnlockProgress();
+    Log.d(LOG_TAG, "LoginActivity.handlePasswordClick done");
+  }
 
-    if (isFirstRun) {
-      loadedSecrets = new ArrayList<Secret>();
-
-      // Immediately save an empty file to hold the secrets.
-      Cipher cipher = SecurityUtils.getEncryptionCipher();
-      File file = getFileStreamPath(FileUtils.SECRETS_FILE_NAME);
-      byte[] salt = SecurityUtils.getSalt();
-      int rounds = SecurityUtils.getRounds();
-      int err = FileUtils.saveSecrets(this, file, cipher, salt, rounds,
-                                      loadedSecrets);
-      if (0 != err) {
-        showToast(err, Toast.LENGTH_LONG);
-        return;
-      }
-    } else {
-      loadedSecrets = FileUtils.loadSecrets(this);
-      if (null == loadedSecrets) {
-        // Loading failed. Try the old object format using same cipher
-        loadedSecrets = FileUtils.loadSecretsV3(this);
-        if (null == loadedSecrets) {
-          // Loading the secrets failed again. Try loading with the old
-          // encryption algorithm in case were are reading an older file.
-          Cipher cipher2 = SecurityUtils.createDecryptionCipherV2(
-              passwordString, pair.salt, pair.rounds);
-          if (null != cipher2) {
-            loadedSecrets = FileUtils.loadSecretsV2(this, cipher2, pair.salt,
-                                                 pair.rounds);
+  /** Shows the progress of the unlock job, which can be cancelled. */
+  private void showUnlockProgress() {
+    final UnlockJob job = unlockJob;
+    progressDialog = new ProgressDialog(this);
+    progressDialog.setIndeterminate(true);
+    progressDialog.setMessage(getText(
+        UnlockJob.STAGE_LOADING == job.getStage()
+            ? R.string.unlock_loading : R.string.unlock_deriving_key));
+    progressDialog.setCancelable(false);
+    progressDialog.setButton(DialogInterface.BUTTON_NEGATIVE,
+        getText(android.R.string.cancel),
+        new DialogInterface.OnClickListener() {
+          @Override
+          public void onClick(DialogInterface dialog, int which) {
+            job.cancel();
           }
-        }
-        if (null == loadedSecrets) {
-          // Loading the secrets failed again. Try an even older encryption
-          // algorithm.
-          Cipher cipher1 =
-              SecurityUtils.createDecryptionCipherV1(passwordString);
-          if (null != cipher1)
-            loadedSecrets = FileUtils.loadSecretsV1(this, cipher1);
-        }
-        if (null == loadedSecrets) {
-          // TODO(rogerta): need better error message here. There are probably
-          // many reasons that we might not be able to open the file.
-          showToast(R.string.invalid_password, Toast.LENGTH_LONG);
-          return;
-        }
-
-        // previous versions were case-sensitive and may need to be sorted
-        Collections.sort(loadedSecrets);
-      }
-    }
+        });
+    progressDialog.show();
+  }
 
+  /**
+   * Makes the secrets unlocked by the job the global list of secrets, and
+   * shows them.
+   */
+  private void showSecrets(UnlockJob job) {
     // Ensure the globals array are allocated.
     if (secrets == null)
       secrets = new ArrayList<Secret>();
@@ -394,12 +427,14 @@ public class LoginActivity extends Activity implements TextWatcher {
       deletedSecrets = new ArrayList<Secret>();
 
     // extract the deleted secrets from the global secrets list
-    replaceSecrets(loadedSecrets);
+    replaceSecrets(job.getSecrets());
+    if (job.isCurrent()) {
+      SaveService.setLoaded(this, SecurityUtils.getCipherInfo(),
+                            ChangeTracker.getGeneration());
+    }
 
-    passwordString = null;
     Intent intent = new Intent(LoginActivity.this, SecretsListActivity.class);
     startActivity(intent);
-    Log.d(LOG_TAG, "LoginActivity.handlePasswordClick done");
   }
 
   /**
@@ -481,6 +516,7 @@ public class LoginActivity extends Activity implements TextWatcher {
         secrets.add(secret);
       }
     }
+    ChangeTracker.changed();
   }
 
   /**
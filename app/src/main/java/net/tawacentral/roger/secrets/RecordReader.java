@@ -0,0 +1,186 @@
+// Copyright (c) 2009, Google Inc.
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//      http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+
+package net.tawacentral.roger.secrets;
+
+import java.io.EOFException;
+import java.io.IOException;
+import java.io.InputStream;
+import java.nio.ByteBuffer;
+import java.nio.charset.StandardCharsets;
+import java.util.Arrays;
+
+/**
+ * Decodes records of the binary vault format written by RecordWriter.  See
+ * that class for a description of the encoding.
+ *
+ * The reader works over a slice of a byte array and never copies it, except
+ * to create strings and byte arrays that are returned to the caller.  All
+ * lengths are checked against the end of the slice, so corrupt data results
+ * in an IOException rather than an out of bounds exception.
+ */
+public class RecordReader {
+  private final byte[] buffer;
+  private final int limit;
+  private int position;
+
+  /** Creates a reader over a whole byte array. */
+  public RecordReader(byte[] buffer) {
+    this(buffer, 0, buffer.length);
+  }
+
+  /**
+   * Creates a reader over a slice of a byte array.
+   *
+   * @param buffer Array holding the record.
+   * @param offset Offset of the first byte of the record.
+   * @param length Length of the record.
+   */
+  public RecordReader(byte[] buffer, int offset, int length) {
+    this.buffer = buffer;
+    this.position = offset;
+    this.limit = offset + length;
+  }
+
+  /** Returns true if there are more bytes to read in this record. */
+  public boolean hasMore() {
+    return position < limit;
+  }
+
+  /** Reads the tag of the next field. */
+  public int readTag() throws IOException {
+    long tag = readRawVarint();
+    if (tag < 0 || tag > Integer.MAX_VALUE)
+      throw new IOException("Malformed record tag");
+    return (int) tag;
+  }
+
+  /** Reads an unsigned varint. */
+  public long readRawVarint() throws IOException {
+    long value = 0;
+    for (int shift = 0; shift < 64; shift += 7) {
+      if (position >= limit)
+        throw new EOFException("Truncated record");
+      byte b = buffer[position++];
+      value |= (long) (b & 0x7F) << shift;
+      if ((b & 0x80) == 0)
+        return value;
+    }
+    throw new IOException("Malformed varint");
+  }
+
+  /** Reads a zigzag encoded signed varint. */
+  public long readSignedRawVarint() throws IOException {
+    long value = readRawVarint();
+    return (value >>> 1) ^ -(value & 1);
+  }
+
+  /** Reads the value of a WIRE_VARINT field as a boolean. */
+  public boolean readBoolean() throws IOException {
+    return readRawVarint() != 0;
+  }
+
+  /** Reads the value of a WIRE_BYTES field as a UTF-8 string. */
+  public String readString() throws IOException {
+    int length = readLength();
+    String value = new String(buffer, position, length, StandardCharsets.UTF_8);
+    position += length;
+    return value;
+  }
+
+  /** Reads the value of a WIRE_BYTES field as a byte array. */
+  public byte[] readBytes() throws IOException {
+    int length = readLength();
+    byte[] value = Arrays.copyOfRange(buffer, position, position + length);
+    position += length;
+    return value;
+  }
+
+  /** Reads the given number of bytes, without a tag or length. */
+  public byte[] readRawBytes(int length) throws IOException {
+    if (length < 0 || length > limit - position)
+      throw new EOFException("Truncated record");
+    byte[] value = Arrays.copyOfRange(buffer, position, position + length);
+    position += length;
+    return value;
+  }
+
+  /**
+   * Reads the value of a WIRE_BYTES field as a nested record.  The returned
+   * reader shares the buffer of this one.
+   */
+  public RecordReader readRecord() throws IOException {
+    int length = readLength();
+    RecordReader nested = new RecordReader(buffer, position, length);
+    position += length;
+    return nested;
+  }
+
+  /** Skips the value of a field with the given tag. */
+  public void skip(int tag) throws IOException {
+    switch (tag & 0x7) {
+      case RecordWriter.WIRE_VARINT:
+        readRawVarint();
+        break;
+      case RecordWriter.WIRE_BYTES:
+        position += readLength();
+        break;
+      default:
+        throw new IOException("Unknown wire type in tag " + tag);
+    }
+  }
+
+  private int readLength() throws IOException {
+    long length = readRawVarint();
+    if (length < 0 || length > limit - position)
+      throw new EOFException("Truncated record");
+    return (int) length;
+  }
+
+  /**
+   * Reads an unsigned varint directly from a stream.
+   *
+   * @throws EOFException if the stream ends before the varint does.
+   */
+  public static long readRawVarint(InputStream input) throws IOException {
+    long value = 0;
+    for (int shift = 0; shift < 64; shift += 7) {
+      int b = input.read();
+      if (b < 0)
+        throw new EOFException("Truncated varint");
+      value |= (long) (b & 0x7F) << shift;
+      if ((b & 0x80) == 0)
+        return value;
+    }
+    throw new IOException("Malformed varint");
+  }
+
+  /**
+   * Reads an unsigned varint directly from a buffer, at its position.
+   *
+   * @throws EOFException if the buffer ends before the varint does.
+   */
+  public static long readRawVarint(ByteBuffer buffer) throws IOException {
+    long value = 0;
+    for (int shift = 0; shift < 64; shift += 7) {
+      if (!buffer.hasRemaining())
+        throw new EOFException("Truncated varint");
+      int b = buffer.get();
+      value |= (long) (b & 0x7F) << shift;
+      if ((b & 0x80) == 0)
+        return value;
+    }
+    throw new IOException("Malformed varint");
+  }
+}
@@ -0,0 +1,169 @@
+// Copyright (c) 2009, Google Inc.
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//      http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+
+package net.tawacentral.roger.secrets;
+
+import java.io.IOException;
+import java.io.OutputStream;
+import java.nio.charset.StandardCharsets;
+import java.util.Arrays;
+
+/**
+ * Encodes records of the binary vault format into a growable byte buffer.
+ *
+ * A record is a sequence of fields.  Each field starts with a varint tag
+ * made of the field number and a wire type, (field << 3) | wire.  A
+ * WIRE_VARINT field is followed by one varint, and a WIRE_BYTES field is
+ * followed by a varint length and that many bytes.  Strings are stored as
+ * UTF-8 bytes.  Because every field carries its own wire type, readers can
+ * skip fields they do not know, which allows fields to be added later.
+ *
+ * A writer can be reset and reused to avoid allocating a buffer per record.
+ */
+public class RecordWriter {
+  /** Wire type of fields whose value is a single varint. */
+  public static final int WIRE_VARINT = 0;
+
+  /** Wire type of fields whose value is length prefixed bytes. */
+  public static final int WIRE_BYTES = 2;
+
+  private byte[] buffer;
+  private int size;
+
+  /** Creates a writer with a default initial capacity. */
+  public RecordWriter() {
+    this(256);
+  }
+
+  /**
+   * Creates a writer with the given initial capacity.
+   *
+   * @param capacity Initial size of the buffer, in bytes.
+   */
+  public RecordWriter(int capacity) {
+    buffer = new byte[Math.max(capacity, 16)];
+  }
+
+  /** Returns the tag for the given field number and wire type. */
+  public static int tag(int field, int wire) {
+    return (field << 3) | wire;
+  }
+
+  /** Discards everything written so far, keeping the buffer. */
+  public void reset() {
+    size = 0;
+  }
+
+  /** Returns the number of bytes written so far. */
+  public int size() {
+    return size;
+  }
+
+  /** Returns a copy of the bytes written so far. */
+  public byte[] toByteArray() {
+    return Arrays.copyOf(buffer, size);
+  }
+
+  /** Writes the bytes written so far to the given stream. */
+  public void writeTo(OutputStream output) throws IOException {
+    output.write(buffer, 0, size);
+  }
+
+  /** Appends an unsigned varint, without a tag. */
+  public void writeRawVarint(long value) {
+    ensureCapacity(10);
+    while ((value & ~0x7FL) != 0) {
+      buffer[size++] = (byte) ((value & 0x7F) | 0x80);
+      value >>>= 7;
+    }
+    buffer[size++] = (byte) value;
+  }
+
+  /**
+   * Appends a signed varint, without a tag.  Values are zigzag encoded so that
+   * small negative numbers stay short.
+   */
+  public void writeSignedRawVarint(long value) {
+    writeRawVarint((value << 1) ^ (value >> 63));
+  }
+
+  /** Appends raw bytes, without a tag or length. */
+  public void writeRawBytes(byte[] bytes, int offset, int length) {
+    ensureCapacity(length);
+    System.arraycopy(bytes, offset, buffer, size, length);
+    size += length;
+  }
+
+  /** Appends the bytes written to another writer, without a tag or length. */
+  public void writeRawBytes(RecordWriter other) {
+    writeRawBytes(other.buffer, 0, other.size);
+  }
+
+  /** Writes a varint field. */
+  public void writeVarint(int field, long value) {
+    writeRawVarint(tag(field, WIRE_VARINT));
+    writeRawVarint(value);
+  }
+
+  /** Writes a boolean field.  False values are not written at all. */
+  public void writeBoolean(int field, boolean value) {
+    if (value)
+      writeVarint(field, 1);
+  }
+
+  /** Writes a string field.  Null values are not written at all. */
+  public void writeString(int field, String value) {
+    if (null != value) {
+      byte[] bytes = value.getBytes(StandardCharsets.UTF_8);
+      writeBytes(field, bytes, 0, bytes.length);
+    }
+  }
+
+  /** Writes a bytes field. */
+  public void writeBytes(int field, byte[] bytes, int offset, int length) {
+    writeRawVarint(tag(field, WIRE_BYTES));
+    writeRawVarint(length);
+    writeRawBytes(bytes, offset, length);
+  }
+
+  /** Writes the contents of another writer as a nested bytes field. */
+  public void writeBytes(int field, RecordWriter nested) {
+    writeBytes(field, nested.buffer, 0, nested.size);
+  }
+
+  /** Writes an unsigned varint directly to a stream. */
+  public static void writeRawVarint(OutputStream output, long value)
+      throws IOException {
+    while ((value & ~0x7FL) != 0) {
+      output.write((int) ((value & 0x7F) | 0x80));
+      value >>>= 7;
+    }
+    output.write((int) value);
+  }
+
+  /** Returns the number of bytes needed to encode the given unsigned varint. */
+  public static int rawVarintSize(long value) {
+    int size = 1;
+    while ((value & ~0x7FL) != 0) {
+      ++size;
+      value >>>= 7;
+    }
+    return size;
+  }
+
+  private void ensureCapacity(int extra) {
+    if (size + extra > buffer.length)
+      buffer = Arrays.copyOf(buffer, Math.max(buffer.length * 2, size + extra));
+  }
+}
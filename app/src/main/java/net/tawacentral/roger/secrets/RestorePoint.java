@@ -0,0 +1,130 @@
+// Copyright (c) 2009, Google Inc.
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//      http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+
+package net.tawacentral.roger.secrets;
+
+/**
+ * Describes one version of the secrets file, as recorded in the restore point
+ * manifest: either the current secrets file or one of the automatic restore
+ * points left behind by previous saves.  See FileUtils.getRestorePoints().
+ *
+ * Restore points made before the manifest existed, or whose metadata was
+ * lost, only have a name, time and size.  Their count is -1 and their salt
+ * and content hash are null.
+ *
+ * A restore point is either a full copy of a secrets file, or a delta that
+ * only holds the segments that differ from a full restore point, its base.
+ */
+public class RestorePoint {
+  private final String name;
+  private final long time;
+  private final int count;
+  private final byte[] salt;
+  private final int rounds;
+  private final long size;
+  private final byte[] contentHash;
+  private final byte[] segmentDigests;
+  private final String base;
+
+  /**
+   * Creates the description of a restore point.
+   *
+   * @param name Name of the file in the application's data directory.
+   * @param time Time the file was written, in millisecs since epoch.
+   * @param count Number of secrets in the file, or -1 if unknown.
+   * @param salt Salt of the file, or null if unknown.
+   * @param rounds Rounds of the file, or 0 if unknown.
+   * @param size Length of the file, in bytes.
+   * @param contentHash Digest of the decrypted contents, or null if unknown.
+   * @param segmentDigests Digests of the decrypted segments of a full copy,
+   *     or null if unknown.
+   * @param base Name of the full restore point of a delta, an empty string
+   *     for a delta whose base is unknown, or null.
+   */
+  RestorePoint(String name, long time, int count, byte[] salt, int rounds,
+               long size, byte[] contentHash, byte[] segmentDigests,
+               String base) {
+    this.name = name;
+    this.time = time;
+    this.count = count;
+    this.salt = salt;
+    this.rounds = rounds;
+    this.size = size;
+    this.contentHash = contentHash;
+    this.segmentDigests = segmentDigests;
+    this.base = base;
+  }
+
+  /** Returns a copy of this description for a file renamed to name. */
+  RestorePoint rename(String name) {
+    return new RestorePoint(name, time, count, salt, rounds, size,
+                            contentHash, segmentDigests, base);
+  }
+
+  /** Returns the name of the file. */
+  public String getName() {
+    return name;
+  }
+
+  /** Returns the time the file was written, in millisecs since epoch. */
+  public long getTime() {
+    return time;
+  }
+
+  /** Returns the number of secrets in the file, or -1 if unknown. */
+  public int getCount() {
+    return count;
+  }
+
+  /** Returns the salt of the file, or null if unknown. */
+  public byte[] getSalt() {
+    return salt;
+  }
+
+  /** Returns the rounds of the file, or 0 if unknown. */
+  public int getRounds() {
+    return rounds;
+  }
+
+  /** Returns the length of the file, in bytes. */
+  public long getSize() {
+    return size;
+  }
+
+  /**
+   * Returns a digest of the decrypted contents of the file, which is the same
+   * for two files holding the same secrets, or null if unknown.
+   */
+  public byte[] getContentHash() {
+    return contentHash;
+  }
+
+  /**
+   * Returns the digests of the decrypted segments of a full copy, one after
+   * the other, which a delta can refer to instead of copying the segments.
+   * Null if unknown or if this is a delta.
+   */
+  byte[] getSegmentDigests() {
+    return segmentDigests;
+  }
+
+  /**
+   * Returns the name of the full restore point this delta needs to be
+   * restored, an empty string if it is unknown, or null if this is a full
+   * copy.
+   */
+  public String getBase() {
+    return base;
+  }
+}
@@ -0,0 +1,338 @@
+// Copyright (c) 2009, Google Inc.
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//      http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+
+package net.tawacentral.roger.secrets;
+
+import android.content.Context;
+import android.util.Log;
+
+import net.tawacentral.roger.secrets.SecurityUtils.CipherInfo;
+
+import java.io.BufferedOutputStream;
+import java.io.DataInputStream;
+import java.io.EOFException;
+import java.io.File;
+import java.io.FileOutputStream;
+import java.io.IOException;
+import java.io.InputStream;
+import java.io.OutputStream;
+import java.io.RandomAccessFile;
+import java.nio.ByteBuffer;
+import java.nio.charset.StandardCharsets;
+import java.security.MessageDigest;
+import java.util.ArrayList;
+import java.util.Arrays;
+import java.util.HashMap;
+import java.util.List;
+
+/**
+ * Delta restore points, which hold only the segments of a secrets file that
+ * are not in an older full restore point, their base, see write().
+ */
+class RestorePointDeltas {
+  /** Tag for logging purposes. */
+  public static final String LOG_TAG = "RestorePointDeltas";
+
+  // Header and last frame of a delta restore point.  The header is the same
+  // as that of the secrets file it was made from.  It is followed by the
+  // FRAME_SEGMENT frames that are not in its base, copied as is, and a
+  // FRAME_DELTA holding the name of the base and, for each segment of the
+  // file, where to find it.
+  static final byte[] SIGNATURE_DELTA = {0x22, 0x34, 0x56, 0x7E};
+  static final int DELTA_VERSION = 1;
+  private static final int FRAME_DELTA = 6;
+
+  // Number of deltas written for each full restore point, see write().
+  private static final int DELTAS_PER_BASE = 20;
+
+  /**
+   * Writes the existing secrets file as a delta of the most recent full
+   * restore point, holding only the segments of the file whose decrypted
+   * contents are not in the base.  The segments are copied as is, so nothing
+   * is encrypted again except the small FRAME_DELTA.  The caller must hold
+   * the lock of FileUtils.
+   *
+   * After DELTAS_PER_BASE deltas, or when most of the file changed since
+   * the base, no delta is written, so that the caller makes a full copy which
+   * becomes the next base.
+   *
+   * @param context Activity context in which the save is called.
+   * @param info The key, salt and rounds of the secrets file.
+   * @param existing The secrets file.
+   * @param previous The segments of the secrets file, or null if unknown.
+   * @param file The restore point file to write.
+   * @return The entry of the restore point for the manifest, or null if no
+   *     delta was written.
+   */
+  static RestorePoint write(Context context,
+                            CipherInfo info,
+                            File existing,
+                            SegmentIndex previous,
+                            File file) {
+    if (!existing.exists() || null == previous ||
+        !previous.isValidFor(existing, info.key)) {
+      return null;
+    }
+
+    RestorePoint current = null;
+    RestorePoint base = null;
+    int deltas = 0;
+    for (RestorePoint point : RestorePointManifest.read(context, info)) {
+      if (FileUtils.SECRETS_FILE_NAME.equals(point.getName())) {
+        current = point;
+      } else if (point.getName().startsWith(FileUtils.RP_PREFIX)) {
+        if (null == point.getBase()) {
+          base = point;
+          break;
+        }
+        ++deltas;
+      }
+    }
+    // The segment digests are only recorded for files written with the key
+    // of the manifest, so the base can be decrypted with the same key.
+    if (null == base || null == base.getSegmentDigests() ||
+        deltas >= DELTAS_PER_BASE ||
+        !Arrays.equals(base.getSalt(), info.salt) ||
+        base.getRounds() != info.rounds) {
+      return null;
+    }
+
+    HashMap<ByteBuffer, Integer> baseSegments =
+        new HashMap<ByteBuffer, Integer>();
+    byte[] digests = base.getSegmentDigests();
+    for (int i = 0; i + FrameCodec.DIGEST_LENGTH <= digests.length;
+         i += FrameCodec.DIGEST_LENGTH) {
+      ByteBuffer key = ByteBuffer.wrap(
+          Arrays.copyOfRange(digests, i, i + FrameCodec.DIGEST_LENGTH));
+      if (!baseSegments.containsKey(key))
+        baseSegments.put(key, i / FrameCodec.DIGEST_LENGTH);
+    }
+
+    // References are 1 + the number of the segment in the base, or 0 for a
+    // segment copied in the delta.
+    List<SegmentIndex.Segment> segments = previous.getSegments();
+    int[] refs = new int[segments.size()];
+    long copied = 0;
+    int count = 0;
+    for (int i = 0; i < refs.length; ++i) {
+      SegmentIndex.Segment segment = segments.get(i);
+      Integer ref = baseSegments.get(ByteBuffer.wrap(segment.contentDigest));
+      refs[i] = null == ref ? 0 : ref + 1;
+      if (null == ref)
+        copied += segment.length;
+      count += segment.secrets.length;
+    }
+    if (copied * 2 > existing.length())
+      return null;
+
+    FileOutputStream fos = null;
+    RandomAccessFile source = null;
+    try {
+      RecordWriter plain = new RecordWriter();
+      plain.writeRawBytes(FrameCodec.PAYLOAD_MAGIC, 0,
+                          FrameCodec.PAYLOAD_MAGIC.length);
+      byte[] name = base.getName().getBytes(StandardCharsets.UTF_8);
+      plain.writeRawVarint(name.length);
+      plain.writeRawBytes(name, 0, name.length);
+      plain.writeRawVarint(refs.length);
+      for (int i = 0; i < refs.length; ++i) {
+        SegmentIndex.Segment segment = segments.get(i);
+        plain.writeRawVarint(refs[i]);
+        plain.writeRawVarint(segment.secrets.length);
+        plain.writeRawBytes(segment.contentDigest, 0, FrameCodec.DIGEST_LENGTH);
+      }
+
+      source = new RandomAccessFile(existing, "r");
+      fos = new FileOutputStream(file);
+      OutputStream bos = new BufferedOutputStream(fos, 16 * 1024);
+      bos.write(FileUtils.createHeader(SIGNATURE_DELTA, DELTA_VERSION, info,
+                             previous.getFlags()));
+      for (int i = 0; i < refs.length; ++i) {
+        if (0 != refs[i])
+          continue;
+        SegmentIndex.Segment segment = segments.get(i);
+        byte[] frame = new byte[segment.length];
+        source.seek(segment.offset);
+        source.readFully(frame);
+        bos.write(frame);
+      }
+      FrameCodec.writeFrame(bos, FRAME_DELTA,
+                            FrameCodec.encryptFrame(info, plain, false));
+      bos.flush();
+      fos.getFD().sync();
+    } catch (Exception ex) {
+      Log.e(LOG_TAG, "write", ex);
+      // NOTE: this delete() works, even though the file is still open.
+      file.delete();
+      return null;
+    } finally {
+      try {if (null != fos) fos.close();} catch (IOException ex) {}
+      try {if (null != source) source.close();} catch (IOException ex) {}
+    }
+
+    byte[] hash = null;
+    try {
+      hash = RestorePointManifest.contentHash(previous);
+    } catch (IOException ex) {
+      Log.e(LOG_TAG, "write", ex);
+    }
+    long time = null != current && current.getSize() == existing.length()
+        ? current.getTime() : existing.lastModified();
+    Log.d(LOG_TAG, "RestorePointDeltas.write: segments=" +
+          refs.length + " copied=" + copied + " base=" + base.getName());
+    return new RestorePoint(file.getName(), time, count, info.salt,
+                            info.rounds, file.length(), hash, null,
+                            base.getName());
+  }
+
+  /** Is the given file a delta restore point? */
+  static boolean isDelta(File file) {
+    VaultFile vault = null;
+    try {
+      vault = VaultFile.open(file);
+      return vault.getSaltAndRounds().delta;
+    } catch (IOException ex) {
+      return false;
+    } finally {
+      if (null != vault)
+        vault.close();
+    }
+  }
+
+  /**
+   * Reads a delta restore point, written by write(),
+   * taking the segments it does not hold from its base.  The decrypted
+   * contents of every segment are checked against the digest recorded in the
+   * delta.  The input stream is closed before returning.
+   *
+   * @param context Activity context in which the load is called.
+   * @param pair The header of the delta.
+   * @param input The input stream of the delta, positioned after the header.
+   * @param info The key, salt and rounds to decrypt the secrets with.
+   * @return The secrets of the restore point, or null if it was not written
+   *     with the given salt and rounds.
+   * @throws IOException if the delta or its base is missing or corrupt, or
+   *     the key is wrong.
+   */
+  static ArrayList<Secret> read(Context context,
+                                FileUtils.SaltAndRounds pair,
+                                InputStream input,
+                                CipherInfo info)
+      throws IOException {
+    ArrayList<byte[]> frames = new ArrayList<byte[]>();
+    RecordReader reader = null;
+    int flags = pair.flags;
+    DataInputStream data = new DataInputStream(input);
+    try {
+      if (!Arrays.equals(pair.salt, info.salt) || pair.rounds != info.rounds ||
+          !pair.kdf.equals(info.kdf))
+        return null;
+      info = FileUtils.withSuite(info, pair);
+      while (null == reader) {
+        int kind = data.read();
+        if (kind < 0)
+          throw new EOFException("Missing delta frame");
+
+        byte[] payload = new byte[FrameCodec.readLength(
+            data, FrameCodec.MAX_FRAME_LENGTH)];
+        data.readFully(payload);
+        if (FileUtils.FRAME_SEGMENT == kind)
+          frames.add(payload);
+        else if (FRAME_DELTA == kind)
+          reader = FrameCodec.decryptFrame(info, payload, false);
+        else
+          throw new IOException("Unknown frame kind " + kind);
+      }
+      if (-1 != data.read())
+        throw new IOException("Unexpected data after delta");
+    } finally {
+      try {data.close();} catch (IOException ex) {}
+    }
+
+    String baseName = reader.readString();
+    int count = FrameCodec.readCount(reader);
+    int[] refs = new int[count];
+    int[] counts = new int[count];
+    byte[][] digests = new byte[count][];
+    boolean needsBase = false;
+    for (int i = 0; i < count; ++i) {
+      refs[i] = FrameCodec.readCount(reader);
+      counts[i] = FrameCodec.readCount(reader);
+      digests[i] = reader.readRawBytes(FrameCodec.DIGEST_LENGTH);
+      needsBase |= 0 != refs[i];
+    }
+
+    ArrayList<byte[]> baseFrames = new ArrayList<byte[]>();
+    int baseFlags = 0;
+    if (needsBase) {
+      if (baseName.contains("/") || !baseName.startsWith(FileUtils.RP_PREFIX))
+        throw new IOException("Invalid base " + baseName);
+      VaultFile base = VaultFile.open(context.getFileStreamPath(baseName));
+      try {
+        FileUtils.SaltAndRounds basePair = base.getSaltAndRounds();
+        if (!FileUtils.isSegmented(basePair) || basePair.suite != pair.suite ||
+            !basePair.kdf.equals(pair.kdf))
+          throw new IOException("Base is not a segmented file");
+        baseFlags = basePair.flags;
+        data = new DataInputStream(base.openBody());
+        for (;;) {
+          int kind = data.read();
+          if (kind < 0 || FileUtils.FRAME_INDEX == kind)
+            break;
+          byte[] payload = new byte[FrameCodec.readLength(
+              data, FrameCodec.MAX_FRAME_LENGTH)];
+          data.readFully(payload);
+          if (FileUtils.FRAME_SEGMENT != kind)
+            throw new IOException("Unknown frame kind " + kind);
+          baseFrames.add(payload);
+        }
+      } finally {
+        base.close();
+      }
+    }
+
+    MessageDigest digester = FrameCodec.createDigest();
+    ArrayList<Secret> secrets = new ArrayList<Secret>();
+    int next = 0;
+    for (int i = 0; i < count; ++i) {
+      byte[] plain;
+      if (0 == refs[i]) {
+        if (next >= frames.size())
+          throw new IOException("Missing segment in delta");
+        plain = FrameCodec.decryptFrameData(
+            info, frames.get(next++), 0 != (flags & FileUtils.FLAG_DEFLATE));
+      } else {
+        if (refs[i] > baseFrames.size())
+          throw new IOException("Missing segment in base");
+        plain = FrameCodec.decryptFrameData(
+            info, baseFrames.get(refs[i] - 1),
+            0 != (baseFlags & FileUtils.FLAG_DEFLATE));
+      }
+      if (!Arrays.equals(FrameCodec.digest(digester, plain), digests[i]))
+        throw new IOException("Segment does not match delta");
+
+      RecordReader segment = new RecordReader(
+          plain, FrameCodec.PAYLOAD_MAGIC.length,
+          plain.length - FrameCodec.PAYLOAD_MAGIC.length);
+      if (FrameCodec.readCount(segment) != counts[i])
+        throw new IOException("Segment count mismatch");
+      for (int j = 0; j < counts[i]; ++j)
+        secrets.add(Secret.fromRecord(segment.readRecord(), info.key));
+    }
+    if (next != frames.size())
+      throw new IOException("Unexpected segment in delta");
+
+    return secrets;
+  }
+}
@@ -0,0 +1,522 @@
+// Copyright (c) 2009, Google Inc.
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//      http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+
+package net.tawacentral.roger.secrets;
+
+import android.content.Context;
+import android.util.Log;
+
+import net.tawacentral.roger.secrets.SecurityUtils.CipherInfo;
+
+import java.io.BufferedInputStream;
+import java.io.ByteArrayOutputStream;
+import java.io.DataInputStream;
+import java.io.File;
+import java.io.FileInputStream;
+import java.io.FileOutputStream;
+import java.io.IOException;
+import java.security.MessageDigest;
+import java.util.ArrayList;
+import java.util.Arrays;
+import java.util.Collections;
+import java.util.Comparator;
+import java.util.HashMap;
+import java.util.HashSet;
+import java.util.List;
+
+/**
+ * The restore point manifest, which describes the secrets file and the restore
+ * points next to it, see read().  The manifest file is a header followed by
+ * one encrypted frame holding a record per file.  Its entries are kept in
+ * memory, guarded by the lock of FileUtils.
+ */
+class RestorePointManifest {
+  /** Tag for logging purposes. */
+  public static final String LOG_TAG = "RestorePointManifest";
+
+  // Header and frame of the restore point manifest.  The single frame holds
+  // a count followed by one length-prefixed record per restore point.
+  private static final byte[] SIGNATURE_MANIFEST = {0x22, 0x34, 0x56, 0x7D};
+  private static final int MANIFEST_VERSION = 1;
+  private static final int FRAME_MANIFEST = 5;
+
+  // Field numbers of the records of the manifest.
+  private static final int FIELD_RP_NAME = 1;
+  private static final int FIELD_RP_TIME = 2;
+  private static final int FIELD_RP_COUNT = 3;
+  private static final int FIELD_RP_SALT = 4;
+  private static final int FIELD_RP_ROUNDS = 5;
+  private static final int FIELD_RP_SIZE = 6;
+  private static final int FIELD_RP_HASH = 7;
+  private static final int FIELD_RP_SEGMENTS = 8;
+  private static final int FIELD_RP_BASE = 9;
+
+  // Number of restore points kept by applyRetention(), unless they are
+  // younger than two days.  Only a few of them are full copies, the others
+  // are deltas written by RestorePointDeltas.write(), a few for each full
+  // copy.
+  private static final int MAX_RESTORE_POINTS = 60;
+  private static final int MAX_FULL_RESTORE_POINTS = 3;
+
+  // Base of the manifest entry of a delta restore point that was found
+  // without its entry, see unknownRestorePoint().
+  private static final String UNKNOWN_BASE = "";
+
+  /**
+   * The entries of the restore point manifest, most recent first, or null if
+   * not read yet.  Guarded by the lock.
+   */
+  private static ArrayList<RestorePoint> manifest;
+
+  /**
+   * Forgets the entries of the manifest, so that the next read() reads the
+   * file again.  The caller must hold the lock.
+   */
+  static void reset() {
+    manifest = null;
+  }
+
+  /** Is the restore point too old? */
+  private static boolean isTooOld(RestorePoint point) {
+    long now = System.currentTimeMillis();
+    long twoDays = 2 * 24 * 60 * 60 * 1000;  // 2 days.
+
+    return (now - point.getTime()) > twoDays;
+  }
+
+  /**
+   * Records a save of the secrets file in the restore point manifest.  The
+   * entry of the previous secrets file, if it was moved to a restore point,
+   * is renamed to that restore point, and an entry is added for the new
+   * secrets file.  Extra restore points are then deleted, and the manifest
+   * is written.  The caller must hold the lock.
+   *
+   * @param context Activity context in which the save is called.
+   * @param info The key, salt and rounds of the new secrets file.
+   * @param file The new secrets file.
+   * @param restorePoint The restore point the previous secrets file was
+   *     moved to, which may not exist.
+   * @param delta The entry of the restore point if it was written as a
+   *     delta, or null.
+   * @param index The segments of the new secrets file.
+   * @param count The number of secrets in the new secrets file.
+   */
+  static void update(Context context,
+                     CipherInfo info,
+                     File file,
+                     File restorePoint,
+                     RestorePoint delta,
+                     SegmentIndex index,
+                     int count) {
+    ArrayList<RestorePoint> points = read(context, info);
+    RestorePoint current = null;
+    for (int i = 0; i < points.size(); ++i) {
+      if (FileUtils.SECRETS_FILE_NAME.equals(points.get(i).getName())) {
+        current = points.remove(i);
+        break;
+      }
+    }
+
+    if (null != delta) {
+      points.add(delta);
+    } else if (restorePoint.exists()) {
+      // The entry of the previous file only applies if it is still the file
+      // that was described.
+      long size = restorePoint.length();
+      if (null != current && current.getSize() == size) {
+        points.add(current.rename(restorePoint.getName()));
+      } else {
+        points.add(unknownRestorePoint(restorePoint));
+      }
+    }
+
+    byte[] hash = null;
+    try {
+      hash = contentHash(index);
+    } catch (IOException ex) {
+      Log.e(LOG_TAG, "update", ex);
+    }
+    points.add(new RestorePoint(FileUtils.SECRETS_FILE_NAME,
+                                file.lastModified(), count, info.salt,
+                                info.rounds, file.length(), hash,
+                                segmentDigests(index), null));
+
+    sort(points);
+    applyRetention(context, points);
+    write(context, info, points);
+  }
+
+  /**
+   * Does the given secrets file hold the same secrets as the most recent
+   * restore point, according to their content hashes in the manifest?  The
+   * caller must hold the lock.
+   *
+   * @param context Activity context in which the save is called.
+   * @param info The key, salt and rounds of the secrets file.
+   * @param file The secrets file.
+   */
+  static boolean isDuplicate(Context context,
+                             CipherInfo info,
+                             File file) {
+    if (!file.exists())
+      return false;
+
+    RestorePoint current = null;
+    RestorePoint latest = null;
+    for (RestorePoint point : read(context, info)) {
+      if (FileUtils.SECRETS_FILE_NAME.equals(point.getName()))
+        current = point;
+      else if (null == latest &&
+               point.getName().startsWith(FileUtils.RP_PREFIX))
+        latest = point;
+    }
+
+    // The entry of the secrets file only applies if it is still the file
+    // that was described.
+    return null != current && null != latest &&
+        null != current.getContentHash() &&
+        current.getSize() == file.length() &&
+        Arrays.equals(current.getContentHash(), latest.getContentHash());
+  }
+
+  /**
+   * Deletes the oldest restore points when there are more than
+   * MAX_RESTORE_POINTS of them, or more than MAX_FULL_RESTORE_POINTS full
+   * copies, except those that are less than two days old, and removes them
+   * from the given entries.  A full copy is kept as long as a delta that is
+   * kept needs it, and a delta whose base is gone is deleted.  Since the
+   * base of a delta found without its manifest entry is not known, all the
+   * full copies older than such a delta are kept as long as it is.
+   *
+   * @param context Activity context in which the save is called.
+   * @param points The entries of the manifest, most recent first.
+   */
+  private static void applyRetention(Context context,
+                                     ArrayList<RestorePoint> points) {
+    HashSet<String> names = new HashSet<String>();
+    for (RestorePoint point : points)
+      names.add(point.getName());
+
+    // A base is always older than its deltas, so it is seen after them.
+    HashSet<String> needed = new HashSet<String>();
+    boolean unknownBase = false;
+    int kept = 0;
+    int full = 0;
+    for (int i = 0; i < points.size(); ++i) {
+      RestorePoint point = points.get(i);
+      String name = point.getName();
+      if (!name.startsWith(FileUtils.RP_PREFIX))
+        continue;
+
+      boolean delete;
+      String base = point.getBase();
+      if (UNKNOWN_BASE.equals(base)) {
+        delete = kept >= MAX_RESTORE_POINTS && isTooOld(point);
+        if (!delete)
+          unknownBase = true;
+      } else if (null != base) {
+        delete = !names.contains(base) ||
+            (kept >= MAX_RESTORE_POINTS && isTooOld(point));
+        if (!delete)
+          needed.add(base);
+      } else {
+        delete = !unknownBase && !needed.contains(name) &&
+            (kept >= MAX_RESTORE_POINTS || full >= MAX_FULL_RESTORE_POINTS) &&
+            isTooOld(point);
+        if (!delete)
+          ++full;
+      }
+
+      if (delete) {
+        context.deleteFile(name);
+        points.remove(i--);
+      } else {
+        ++kept;
+      }
+    }
+  }
+
+  /** Sorts the entries of the manifest, most recent first. */
+  private static void sort(ArrayList<RestorePoint> points) {
+    Collections.sort(points, new Comparator<RestorePoint>() {
+      @Override
+      public int compare(RestorePoint a, RestorePoint b) {
+        return a.getTime() < b.getTime() ? 1
+            : (a.getTime() > b.getTime() ? -1 : 0);
+      }
+    });
+  }
+
+  /**
+   * Returns the entries of the restore point manifest, most recent first.
+   * The manifest is only read once, and then kept up to date by
+   * saveSecrets(), whatever the key it is written with.  Files of the
+   * application's data directory that are missing from it, for example
+   * restore points made by older versions or all of them when the manifest
+   * is missing or cannot be decrypted, get entries from
+   * unknownRestorePoint().  The manifest is then written again with those
+   * entries, so that the files are only opened once.  Entries for files
+   * that no longer exist are dropped.  The caller must hold the lock.
+   *
+   * @param context Activity context.
+   * @param info The key, salt and rounds of the secrets file.
+   * @return The entries, which the caller may modify.
+   */
+  static ArrayList<RestorePoint> read(Context context,
+                                      CipherInfo info) {
+    if (null != manifest)
+      return manifest;
+
+    HashMap<String, RestorePoint> entries = new HashMap<String, RestorePoint>();
+    File file = context.getFileStreamPath(FileUtils.MANIFEST_FILE_NAME);
+    if (file.exists()) {
+      try {
+        for (RestorePoint point : readFile(file, info))
+          entries.put(point.getName(), point);
+      } catch (Exception ex) {
+        Log.d(LOG_TAG, "RestorePointManifest.read: cannot read manifest", ex);
+      }
+    }
+
+    ArrayList<RestorePoint> points = new ArrayList<RestorePoint>();
+    boolean rebuilt = false;
+    for (String filename : context.fileList()) {
+      if (!FileUtils.SECRETS_FILE_NAME.equals(filename) &&
+          !filename.startsWith(FileUtils.RP_PREFIX)) {
+        continue;
+      }
+
+      RestorePoint point = entries.get(filename);
+      if (null == point) {
+        point = unknownRestorePoint(context.getFileStreamPath(filename));
+        rebuilt = true;
+      }
+      points.add(point);
+    }
+
+    sort(points);
+    if (rebuilt) {
+      Log.d(LOG_TAG, "RestorePointManifest.read: rebuilt manifest");
+      write(context, info, points);
+    } else {
+      manifest = points;
+    }
+    return points;
+  }
+
+  /**
+   * Returns the entry of a file missing from the manifest, with only a time
+   * and size.  A delta is told by its header, and gets UNKNOWN_BASE as base
+   * since the name of its base is encrypted, possibly with another key, so
+   * that applyRetention() does not delete the full copy it needs.
+   */
+  private static RestorePoint unknownRestorePoint(File file) {
+    return new RestorePoint(file.getName(), file.lastModified(), -1, null, 0,
+                            file.length(), null, null,
+                            RestorePointDeltas.isDelta(file)
+                                ? UNKNOWN_BASE : null);
+  }
+
+  /**
+   * Reads the entries of a manifest file.
+   *
+   * @throws IOException if the file is corrupt or was not written with the
+   *     given key.
+   */
+  private static ArrayList<RestorePoint> readFile(File file,
+                                                  CipherInfo info)
+      throws IOException {
+    DataInputStream input = new DataInputStream(
+        new BufferedInputStream(new FileInputStream(file)));
+    try {
+      byte[] signature = new byte[SIGNATURE_MANIFEST.length];
+      input.readFully(signature);
+      int version = input.readUnsignedByte();
+      byte[] salt = new byte[input.readUnsignedByte()];
+      input.readFully(salt);
+      int rounds = input.readUnsignedByte();
+      if (!Arrays.equals(signature, SIGNATURE_MANIFEST) ||
+          MANIFEST_VERSION != version || !Arrays.equals(salt, info.salt) ||
+          rounds != info.rounds) {
+        throw new IOException("Manifest does not match secrets file");
+      }
+
+      if (FRAME_MANIFEST != input.read())
+        throw new IOException("Missing manifest frame");
+      byte[] payload = new byte[FrameCodec.readLength(
+          input, FrameCodec.MAX_FRAME_LENGTH)];
+      input.readFully(payload);
+      RecordReader reader = FrameCodec.decryptFrame(info, payload, false);
+
+      int count = FrameCodec.readCount(reader);
+      ArrayList<RestorePoint> points = new ArrayList<RestorePoint>(count);
+      for (int i = 0; i < count; ++i)
+        points.add(readRestorePoint(reader.readRecord()));
+      return points;
+    } finally {
+      try {input.close();} catch (IOException ex) {}
+    }
+  }
+
+  /** Reads one record of the manifest. */
+  private static RestorePoint readRestorePoint(RecordReader reader)
+      throws IOException {
+    String name = null;
+    long time = 0;
+    int count = -1;
+    byte[] salt = null;
+    int rounds = 0;
+    long size = 0;
+    byte[] hash = null;
+    byte[] segments = null;
+    String base = null;
+    while (reader.hasMore()) {
+      int tag = reader.readTag();
+      switch (tag) {
+        case (FIELD_RP_NAME << 3) | RecordWriter.WIRE_BYTES:
+          name = reader.readString();
+          break;
+        case (FIELD_RP_TIME << 3) | RecordWriter.WIRE_VARINT:
+          time = reader.readRawVarint();
+          break;
+        case (FIELD_RP_COUNT << 3) | RecordWriter.WIRE_VARINT:
+          count = (int) reader.readRawVarint();
+          break;
+        case (FIELD_RP_SALT << 3) | RecordWriter.WIRE_BYTES:
+          salt = reader.readBytes();
+          break;
+        case (FIELD_RP_ROUNDS << 3) | RecordWriter.WIRE_VARINT:
+          rounds = (int) reader.readRawVarint();
+          break;
+        case (FIELD_RP_SIZE << 3) | RecordWriter.WIRE_VARINT:
+          size = reader.readRawVarint();
+          break;
+        case (FIELD_RP_HASH << 3) | RecordWriter.WIRE_BYTES:
+          hash = reader.readBytes();
+          break;
+        case (FIELD_RP_SEGMENTS << 3) | RecordWriter.WIRE_BYTES:
+          segments = reader.readBytes();
+          break;
+        case (FIELD_RP_BASE << 3) | RecordWriter.WIRE_BYTES:
+          base = reader.readString();
+          break;
+        default:
+          reader.skip(tag);
+          break;
+      }
+    }
+
+    if (null == name)
+      throw new IOException("Manifest record without name");
+    return new RestorePoint(name, time, count, salt, rounds, size, hash,
+                            segments, base);
+  }
+
+  /**
+   * Writes the restore point manifest, through a temporary file, and keeps
+   * its entries for the next read().  A failure only loses the
+   * metadata, so it is not reported.  The caller must hold the lock.
+   */
+  static void write(Context context,
+                    CipherInfo info,
+                    ArrayList<RestorePoint> points) {
+    manifest = points;
+
+    File file = context.getFileStreamPath(FileUtils.MANIFEST_FILE_NAME);
+    File temp =
+        new File(file.getParentFile(), "new" + FileUtils.MANIFEST_FILE_NAME);
+    FileOutputStream output = null;
+    try {
+      RecordWriter plain = new RecordWriter();
+      RecordWriter record = new RecordWriter();
+      plain.writeRawBytes(FrameCodec.PAYLOAD_MAGIC, 0,
+                          FrameCodec.PAYLOAD_MAGIC.length);
+      plain.writeRawVarint(points.size());
+      for (RestorePoint point : points) {
+        record.reset();
+        record.writeString(FIELD_RP_NAME, point.getName());
+        record.writeVarint(FIELD_RP_TIME, point.getTime());
+        if (point.getCount() >= 0)
+          record.writeVarint(FIELD_RP_COUNT, point.getCount());
+        if (null != point.getSalt()) {
+          record.writeBytes(FIELD_RP_SALT, point.getSalt(), 0,
+                            point.getSalt().length);
+          record.writeVarint(FIELD_RP_ROUNDS, point.getRounds());
+        }
+        record.writeVarint(FIELD_RP_SIZE, point.getSize());
+        if (null != point.getContentHash()) {
+          record.writeBytes(FIELD_RP_HASH, point.getContentHash(), 0,
+                            point.getContentHash().length);
+        }
+        if (null != point.getSegmentDigests()) {
+          record.writeBytes(FIELD_RP_SEGMENTS, point.getSegmentDigests(), 0,
+                            point.getSegmentDigests().length);
+        }
+        if (null != point.getBase())
+          record.writeString(FIELD_RP_BASE, point.getBase());
+        plain.writeRawVarint(record.size());
+        plain.writeRawBytes(record);
+      }
+
+      ByteArrayOutputStream bytes = new ByteArrayOutputStream();
+      bytes.write(SIGNATURE_MANIFEST);
+      bytes.write(MANIFEST_VERSION);
+      bytes.write(info.salt.length);
+      bytes.write(info.salt);
+      bytes.write(info.rounds);
+      FrameCodec.writeFrame(bytes, FRAME_MANIFEST,
+                            FrameCodec.encryptFrame(info, plain, false));
+
+      output = new FileOutputStream(temp);
+      bytes.writeTo(output);
+      output.flush();
+      output.getFD().sync();
+      output.close();
+      output = null;
+      if (!temp.renameTo(file))
+        throw new IOException("Cannot move new manifest");
+    } catch (Exception ex) {
+      Log.e(LOG_TAG, "write", ex);
+      temp.delete();
+    } finally {
+      try {if (null != output) output.close();} catch (IOException ex) {}
+    }
+  }
+
+  /**
+   * Returns a digest of the decrypted contents of a secrets file, computed
+   * from the digests of its segments.  Two files holding the same records
+   * have the same digest, even though their encrypted bytes differ.
+   */
+  static byte[] contentHash(SegmentIndex index) throws IOException {
+    MessageDigest digester = FrameCodec.createDigest();
+    for (SegmentIndex.Segment segment : index.getSegments())
+      digester.update(segment.contentDigest);
+    return Arrays.copyOf(digester.digest(), FrameCodec.DIGEST_LENGTH);
+  }
+
+  /**
+   * Returns the digests of the decrypted segments of a secrets file, one
+   * after the other, for the manifest.
+   */
+  private static byte[] segmentDigests(SegmentIndex index) {
+    List<SegmentIndex.Segment> segments = index.getSegments();
+    byte[] digests = new byte[segments.size() * FrameCodec.DIGEST_LENGTH];
+    for (int i = 0; i < segments.size(); ++i) {
+      System.arraycopy(segments.get(i).contentDigest, 0, digests,
+                       i * FrameCodec.DIGEST_LENGTH, FrameCodec.DIGEST_LENGTH);
+    }
+    return digests;
+  }
+}
@@ -16,19 +16,45 @@ package net.tawacentral.roger.secrets;
 
 import java.io.File;
 import java.util.ArrayList;
+import java.util.concurrent.ExecutorService;
+import java.util.concurrent.Executors;
+import java.util.concurrent.atomic.AtomicInteger;
 
-import javax.crypto.Cipher;
+import javax.crypto.SecretKey;
 
 import android.app.Service;
 import android.app.backup.BackupManager;
 import android.content.Context;
 import android.content.Intent;
+import android.os.Handler;
 import android.os.IBinder;
+import android.os.SystemClock;
+import android.util.Log;
+
+import net.tawacentral.roger.secrets.SecurityUtils.CipherInfo;
 
 /**
  * A background service to save the secrets to a file.  This is done as a
  * service to that the OS keeps the process around until the save is completed.
  *
+ * Most saves only append the changes to the journal, which is done right
+ * away by a dedicated thread, so that execute() returns without any I/O.
+ * The service then folds the journal into the secrets file, either
+ * immediately if the journal is full or could not be appended to, or once no
+ * other save has been requested for a while.
+ *
+ * Saves are skipped altogether when the secrets did not change since they
+ * were last saved, as told by ChangeTracker, so that switching apps briefly
+ * does not write any file, create a restore point or schedule a backup.
+ * Secrets that were only viewed or exported since just get their new access
+ * log entries appended to the access log file.
+ *
+ * The secrets file is rewritten by a single worker thread, so saves never
+ * overlap.  Only the most recent request waiting for the worker is kept: a
+ * new request replaces it, and a short debounce delay lets a burst of
+ * requests collapse into one write.  Requests are numbered so that a save of
+ * an older snapshot never follows a save of a newer one.
+ *
  * Note that a service runs in the main thread of the process, just like the
  * UI activities, so any lengthy task still needs to be performed in a
  * separate thread.
@@ -36,36 +62,256 @@ import android.os.IBinder;
  * @author rogerta
  */
 public class SaveService extends Service {
-  private static ArrayList<Secret> secrets;
-  private static Cipher cipher;
-  private static byte[] salt;
-  private static int rounds;
+  // Delay after the last save before the journal is folded into the secrets
+  // file, if it did not need to be done sooner.
+  private static final long COMPACT_DELAY_MS = 60 * 1000;
+
+  // Delay before a save that cannot wait for the journal to be folded, so
+  // that a burst of requests results in a single write.
+  private static final long DEBOUNCE_MS = 500;
+
+  /** Tag for logging purposes. */
+  public static final String LOG_TAG = "SaveService";
+
+  /** A snapshot of the secrets to write to the secrets file. */
+  private static class SaveRequest {
+    final ArrayList<Secret> secrets;
+    final CipherInfo info;
+    final long generation;
+    final long sequence;
+
+    SaveRequest(ArrayList<Secret> secrets, CipherInfo info, long generation,
+                long sequence) {
+      this.secrets = secrets;
+      this.info = info;
+      this.generation = generation;
+      this.sequence = sequence;
+    }
+  }
+
+  // The latest request not yet taken by the worker, and whether it must be
+  // written soon.  Guarded by the class lock, like all the fields below.
+  private static SaveRequest pending;
+  private static boolean compactNow;
+
+  // Sequence number of the last request, and of the last request written.
+  private static long sequence;
+  private static long savedSequence;
+
+  // Is a task queued on the worker that has not started yet?
+  private static boolean workerQueued;
+
+  private static final ExecutorService worker =
+      Executors.newSingleThreadExecutor();
+
+  // Appends to the journal, in the order of the requests.  This is separate
+  // from the worker so that an append never waits for a rewrite.
+  private static final ExecutorService journaler =
+      Executors.newSingleThreadExecutor();
+
+  // Diagnostics: number of worker tasks queued or running, and how long the
+  // saves took, in milliseconds.
+  private static final AtomicInteger queueDepth = new AtomicInteger();
+  private static volatile long lastSaveLatency = -1;
+  private static volatile long totalSaveLatency;
+  private static volatile int saveCount;
+
+  // Generations of the secrets that are in the journal or the secrets file,
+  // and in the secrets file alone, or -1 if unknown.  Both were saved with
+  // persistedKey.
+  private static long journaledGeneration = -1;
+  private static long savedGeneration = -1;
+  private static SecretKey persistedKey;
+
+  // Number of access log entries, as counted by ChangeTracker, that were
+  // last handed to a save.
+  private static long loggedAccesses;
 
   private BackupManager backupManager;
+  private Handler handler;
+  private int lastStartId;
+
+  private final Runnable compactTask = new Runnable() {
+    @Override
+    public void run() {
+      synchronized (SaveService.class) {
+        compact(lastStartId);
+      }
+    }
+  };
 
   /**
-   * Queue a background save of the secrets.
+   * Save the secrets.  The changes since the last save are appended to the
+   * journal on a dedicated thread, and the service is started once they are
+   * so that it folds them into the secrets file.  The secrets file itself is
+   * rewritten in the background, and appending to the journal does not wait
+   * for a rewrite in progress.  Nothing is done if the secrets did not
+   * change since the last save.
    *
    * @param context The activity requesting the save.
-   * @param secrets The collection of secrets to save.
-   * @param cipher The encryption cipher.
-   * @param salt The salt used to create the cipher.
-   * @param rounds The number of rounds for bcrypt.
+   * @param secrets The collection of secrets to save.  It is kept by the
+   *     request, so it must be a copy that the caller does not modify, see
+   *     SecretsListAdapter.getAllAndDeletedSecrets().
+   * @param info The key, salt and rounds to save with.
    */
   public static synchronized void execute(Context context,
                                           ArrayList<Secret> secrets,
-                                          Cipher cipher,
-                                          byte[] salt,
-                                          int rounds) {
-    SaveService.secrets = secrets;
-    SaveService.cipher = cipher;
-    SaveService.salt = salt;
-    SaveService.rounds = rounds;
+                                          CipherInfo info) {
+    long generation = ChangeTracker.getGeneration();
+    long accesses = ChangeTracker.getAccesses();
+    if (isPersisted(generation, journaledGeneration, info)) {
+      if (accesses != loggedAccesses) {
+        loggedAccesses = accesses;
+        saveAccessLog(context, info, secrets);
+      } else {
+        Log.d(LOG_TAG, "SaveService.execute: nothing changed");
+      }
+      return;
+    }
+
+    // The journal append or the save flushes the access log as well.
+    loggedAccesses = accesses;
+
+    // A newer snapshot replaces one still waiting for the worker.
+    final SaveRequest request =
+        new SaveRequest(secrets, info, generation, ++sequence);
+    pending = request;
+
+    final Context app = context.getApplicationContext();
+    journaler.execute(new Runnable() {
+      @Override
+      public void run() {
+        journal(app, request);
+      }
+    });
+  }
+
+  /**
+   * Appends the changes of a request to the journal, and starts the service
+   * to fold the journal into the secrets file.  Runs on the journaler.
+   */
+  private static void journal(Context context, SaveRequest request) {
+    boolean journaled = null != request.info &&
+        JournalStore.append(context, request.info, request.secrets);
+    boolean full = JournalStore.isFull(context);
+    synchronized (SaveService.class) {
+      if (journaled) {
+        journaledGeneration = request.generation;
+        persistedKey = request.info.key;
+      }
+      // A request that needed to be written soon still does, even if a newer
+      // one replaced it.
+      compactNow |= !journaled || full;
+    }
 
     Intent intent = new Intent(context, SaveService.class);
     context.startService(intent);
   }
 
+  /**
+   * Appends the new access log entries of the secrets to the access log file,
+   * on the worker.  Must be called with the class lock held.
+   */
+  private static void saveAccessLog(Context context,
+                                    final CipherInfo info,
+                                    final ArrayList<Secret> secrets) {
+    final Context app = context.getApplicationContext();
+    worker.execute(new Runnable() {
+      @Override
+      public void run() {
+        AccessLogStore.save(app, info, secrets);
+      }
+    });
+  }
+
+  /**
+   * Rewrites the restore point manifest with a new key when the password
+   * changes, see FileUtils.rewriteManifest().  This is done on the worker,
+   * so that it comes before any save of the secrets file with the new key,
+   * which could not read the manifest otherwise.
+   *
+   * @param context The activity changing the password.
+   * @param previous The key, salt and rounds of the current secrets file.
+   * @param info The new key, salt and rounds.
+   */
+  public static void changeKey(Context context,
+                               final CipherInfo previous,
+                               final CipherInfo info) {
+    final Context app = context.getApplicationContext();
+    worker.execute(new Runnable() {
+      @Override
+      public void run() {
+        FileUtils.rewriteManifest(app, previous, info);
+      }
+    });
+  }
+
+  /**
+   * Records that the secrets just loaded from the secrets file and its
+   * journal are what the files hold, so that they are not saved again until
+   * they change.  This is not the case if they were loaded from an older
+   * format, or had to be modified while loading.
+   *
+   * @param context The activity that loaded the secrets.
+   * @param info The key, salt and rounds the secrets were loaded with.
+   * @param generation The generation of the secrets when loaded.
+   */
+  public static synchronized void setLoaded(Context context,
+                                            CipherInfo info,
+                                            long generation) {
+    if (null == info || JournalStore.isFull(context))
+      return;
+
+    journaledGeneration = generation;
+    savedGeneration = JournalStore.isEmpty(context) ? generation : -1;
+    persistedKey = info.key;
+  }
+
+  /**
+   * Are the secrets of the given generation already saved with the given
+   * key?  Must be called with the class lock held.
+   */
+  private static boolean isPersisted(long generation, long persisted,
+                                     CipherInfo info) {
+    return null != info && generation == persisted &&
+        info.key.equals(persistedKey);
+  }
+
+  /**
+   * Records that the secrets file holds the secrets of the given request.
+   */
+  private static synchronized void setSaved(SaveRequest request) {
+    savedSequence = request.sequence;
+    savedGeneration = request.generation;
+    journaledGeneration = Math.max(journaledGeneration, request.generation);
+    persistedKey = request.info.key;
+  }
+
+  /**
+   * Returns the number of saves of the secrets file that are queued or
+   * running.
+   */
+  public static int getQueueDepth() {
+    return queueDepth.get();
+  }
+
+  /**
+   * Returns how long the last save of the secrets file took, in
+   * milliseconds, or -1 if there was none yet.
+   */
+  public static long getLastSaveLatency() {
+    return lastSaveLatency;
+  }
+
+  /**
+   * Returns how long the saves of the secrets file took on average, in
+   * milliseconds, or -1 if there was none yet.
+   */
+  public static long getAverageSaveLatency() {
+    int count = saveCount;
+    return 0 == count ? -1 : totalSaveLatency / count;
+  }
+
   /**
    * Constructor
    */
@@ -80,44 +326,94 @@ public class SaveService extends Service {
   public void onCreate() {
     super.onCreate();
     backupManager = new BackupManager(this);
+    handler = new Handler();
   }
 
   @Override
   public void onDestroy() {
+    handler.removeCallbacks(compactTask);
     super.onDestroy();
   }
 
   @Override
   public int onStartCommand(Intent intent, int flags, final int startId) {
     synchronized (SaveService.class) {
-      final ArrayList<Secret> secrets = SaveService.secrets;
-      final Cipher cipher = SaveService.cipher;
-      final File file = getFileStreamPath(FileUtils.SECRETS_FILE_NAME);
-      final byte[] salt = SaveService.salt;
-      final int rounds = SaveService.rounds;
-
-      SaveService.secrets = null;
-      SaveService.cipher = null;
-      SaveService.salt = null;
-      SaveService.rounds = 0;
-
-      if (null != secrets && null != cipher) {
-        new Thread(new Runnable() {
-          @Override
-          public void run() {
-            int r = FileUtils.saveSecrets(SaveService.this, file, cipher,
-                                          salt, rounds, secrets);
-
-            // If the save was successful, schedule a backup.
-            if (0 == r)
-              backupManager.dataChanged();
-
-            stopSelf(startId);
-          }}, "saveSecrets").start();
-      } else {
+      handler.removeCallbacks(compactTask);
+      lastStartId = startId;
+
+      if (null == pending || null == pending.info) {
+        pending = null;
         stopSelf(startId);
+      } else if (compactNow) {
+        handler.postDelayed(compactTask, DEBOUNCE_MS);
+      } else {
+        // The journal holds the changes, let the backup agent pick them up
+        // and fold them into the secrets file once the app goes idle.
+        backupManager.dataChanged();
+        handler.postDelayed(compactTask, COMPACT_DELAY_MS);
       }
     }
     return START_STICKY;
   }
+
+  /**
+   * Queues the rewrite of the secrets file on the worker thread, folding the
+   * journal into it.  Nothing is queued if the worker has not started the
+   * previous rewrite yet, since it will write the latest request anyway.
+   * Must be called with the class lock held.
+   */
+  private void compact(int startId) {
+    if (null == pending) {
+      stopSelf(startId);
+      return;
+    }
+
+    if (!workerQueued) {
+      workerQueued = true;
+      queueDepth.incrementAndGet();
+      worker.execute(new Runnable() {
+        @Override
+        public void run() {
+          save();
+        }});
+    }
+  }
+
+  /** Writes the latest request to the secrets file.  Runs on the worker. */
+  private void save() {
+    SaveRequest request;
+    boolean skip;
+    synchronized (SaveService.class) {
+      workerQueued = false;
+      request = pending;
+      pending = null;
+      compactNow = false;
+      skip = null == request || request.sequence <= savedSequence ||
+          isPersisted(request.generation, savedGeneration, request.info);
+    }
+
+    if (!skip) {
+      File file = getFileStreamPath(FileUtils.SECRETS_FILE_NAME);
+      long start = SystemClock.elapsedRealtime();
+      int r = FileUtils.saveSecrets(this, file, request.info, request.secrets);
+      long latency = SystemClock.elapsedRealtime() - start;
+      lastSaveLatency = latency;
+      totalSaveLatency += latency;
+      ++saveCount;
+      Log.d(LOG_TAG, "SaveService.save: sequence=" + request.sequence +
+            " latency=" + latency + "ms queue=" + queueDepth.get());
+
+      // If the save was successful, schedule a backup.
+      if (0 == r) {
+        setSaved(request);
+        backupManager.dataChanged();
+      }
+    }
+
+    queueDepth.decrementAndGet();
+    synchronized (SaveService.class) {
+      if (null == pending)
+        stopSelf(lastStartId);
+    }
+  }
 }
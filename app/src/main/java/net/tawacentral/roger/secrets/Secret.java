@@ -16,15 +16,24 @@ package net.tawacentral.roger.secrets;
 
 import java.io.IOException;
 import java.io.ObjectInputStream;
+import java.io.ObjectOutputStream;
 import java.io.Serializable;
+import java.security.GeneralSecurityException;
+import java.security.SecureRandom;
 import java.util.ArrayList;
+import java.util.Arrays;
 import java.util.Collections;
 import java.util.List;
+import java.util.zip.Deflater;
+
+import javax.crypto.Cipher;
+import javax.crypto.SecretKey;
 
 import org.json.JSONArray;
 import org.json.JSONException;
 import org.json.JSONObject;
 
+import android.util.JsonReader;
 import android.util.Log;
 
 /**
@@ -32,6 +41,19 @@ import android.util.Log;
  * uses a combination of username/password, and may require a separate email
  * address for management purposes.  Finally, an arbitrary note can be attached.
  *
+ * A secret read from the binary format is sealed: its password and note
+ * stay encrypted in memory until one of them is needed, and only the fields
+ * shown in the list are decrypted when the vault is loaded.  A bounded number
+ * of sealed secrets are kept open at any time, the least recently used one
+ * being closed again when the limit is reached.
+ *
+ * The access log of a secret read from the main secrets file lives in the
+ * access log file, see AccessLogStore.flush().  Only its most recent
+ * change and the last changed time are kept in the record; the whole log is
+ * loaded the first time it is needed.  New entries are kept aside until they
+ * are appended to the access log file.  Viewing or exporting a secret does
+ * not modify its record, so it does not cause the secrets to be saved.
+ *
  * @author rogerta
  */
 
@@ -41,6 +63,9 @@ public class Secret implements Comparable<Secret>, Serializable {
   private static final int THRESHOLD_MS = 60 * 1000;
   private static final int MAX_LOG_SIZE = 100;
 
+  // Maximum number of sealed secrets that are open at the same time.
+  private static final int MAX_OPEN_SECRETS = 32;
+
   // Tag for logging purposes
   public static final String LOG_TAG = "Secret";
 
@@ -54,7 +79,65 @@ public class Secret implements Comparable<Secret>, Serializable {
   private static final String SECRET_TIMESTAMP = "timestamp";
   private static final String SECRET_DELETED = "deleted";
 
-  // Secret fields
+  // Field numbers of the binary record format, see writeRecord().
+  private static final int FIELD_DESCRIPTION = 1;
+  private static final int FIELD_USERNAME = 2;
+  private static final int FIELD_PASSWORD = 3;
+  private static final int FIELD_EMAIL = 4;
+  private static final int FIELD_NOTE = 5;
+  private static final int FIELD_DELETED = 6;
+  private static final int FIELD_ACCESS_LOG = 7;
+  private static final int FIELD_ID = 8;
+  private static final int FIELD_RECENT_ACCESS = 9;
+  private static final int FIELD_LAST_CHANGED = 10;
+  private static final int FIELD_SEALED_WITH_LOG = 11;
+  private static final int FIELD_SEALED_WITH_LOG_DEFLATED = 12;
+  private static final int FIELD_SEALED = 13;
+  private static final int FIELD_SEALED_DEFLATED = 14;
+  private static final int FIELD_SEAL_SUITE = 15;
+
+  // Tags of the fields, as read back by fromRecord().
+  private static final int TAG_DESCRIPTION =
+      (FIELD_DESCRIPTION << 3) | RecordWriter.WIRE_BYTES;
+  private static final int TAG_USERNAME =
+      (FIELD_USERNAME << 3) | RecordWriter.WIRE_BYTES;
+  private static final int TAG_PASSWORD =
+      (FIELD_PASSWORD << 3) | RecordWriter.WIRE_BYTES;
+  private static final int TAG_EMAIL =
+      (FIELD_EMAIL << 3) | RecordWriter.WIRE_BYTES;
+  private static final int TAG_NOTE =
+      (FIELD_NOTE << 3) | RecordWriter.WIRE_BYTES;
+  private static final int TAG_DELETED =
+      (FIELD_DELETED << 3) | RecordWriter.WIRE_VARINT;
+  private static final int TAG_ACCESS_LOG =
+      (FIELD_ACCESS_LOG << 3) | RecordWriter.WIRE_BYTES;
+  private static final int TAG_ID =
+      (FIELD_ID << 3) | RecordWriter.WIRE_VARINT;
+  private static final int TAG_RECENT_ACCESS =
+      (FIELD_RECENT_ACCESS << 3) | RecordWriter.WIRE_BYTES;
+  private static final int TAG_LAST_CHANGED =
+      (FIELD_LAST_CHANGED << 3) | RecordWriter.WIRE_VARINT;
+  private static final int TAG_SEALED_WITH_LOG =
+      (FIELD_SEALED_WITH_LOG << 3) | RecordWriter.WIRE_BYTES;
+  private static final int TAG_SEALED_WITH_LOG_DEFLATED =
+      (FIELD_SEALED_WITH_LOG_DEFLATED << 3) | RecordWriter.WIRE_BYTES;
+  private static final int TAG_SEALED =
+      (FIELD_SEALED << 3) | RecordWriter.WIRE_BYTES;
+  private static final int TAG_SEALED_DEFLATED =
+      (FIELD_SEALED_DEFLATED << 3) | RecordWriter.WIRE_BYTES;
+  private static final int TAG_SEAL_SUITE =
+      (FIELD_SEAL_SUITE << 3) | RecordWriter.WIRE_VARINT;
+
+  private static final SecureRandom random = new SecureRandom();
+
+  // The sealed secrets that are currently open, least recently used first.
+  private static final ArrayList<Secret> openSecrets =
+      new ArrayList<Secret>(MAX_OPEN_SECRETS + 1);
+
+  // Secret fields.  While the secret is sealed and not open, password and
+  // note are null.  They must only be accessed with the lock on this secret
+  // held, after calling unseal().  The access_log is null until loaded, see
+  // loadAccessLog(), and must only be accessed with the lock held.
   private String description;
   private String username;
   private String password;
@@ -65,6 +148,44 @@ public class Secret implements Comparable<Secret>, Serializable {
   /* soft deletion indicator */
   private boolean deleted;
 
+  // Incremented each time the secret is modified.  This is not persisted, it
+  // only allows the save code to find the secrets that changed since the
+  // vault was last read or written.
+  private transient int revision;
+
+  // Identifies this secret across saves, independently of its description,
+  // so that journal records can refer to it.  It is stored in the binary
+  // format only; secrets read from older formats get a new random id.
+  private transient long id;
+
+  // The password and note of a sealed secret, encrypted with sealKey and the
+  // cipher suite sealSuite: a random IV followed by the encrypted record
+  // holding them.  Null if the secret was never sealed.  If sealedDeflated is
+  // true, the record was compressed before being encrypted.  If sealStale is
+  // true, the password or note were modified since.
+  private transient byte[] sealed;
+  private transient boolean sealedDeflated;
+  private transient SecretKey sealKey;
+  private transient int sealSuite;
+  private transient boolean sealStale;
+
+  // True if password and note hold the values of the secret.
+  private transient boolean opened = true;
+
+  // The most recent access log entry and the last changed time, which are
+  // known even when the access log is not loaded.  The record holds
+  // recordedAccess instead of recentAccess: the most recent entry that
+  // changed the secret, so that views and exports leave it as is.
+  private transient LogEntry recentAccess;
+  private transient LogEntry recordedAccess;
+  private transient long lastChanged;
+
+  // Access log entries not yet in the access log file, oldest first.  If
+  // resetLog is true, the entries in the file for this secret are obsolete
+  // and unloggedEntries holds the whole log.
+  private transient ArrayList<LogEntry> unloggedEntries;
+  private transient boolean resetLog;
+
   /**
    * An immutable class that represents one entry in the access log.  Each
    * time the password is viewed or modified, the access log is updated with
@@ -132,6 +253,13 @@ public class Secret implements Comparable<Secret>, Serializable {
       return jsonValues;
     }
 
+    private void writeJSON(JSONStreamWriter writer) throws IOException {
+      writer.object();
+      writer.put(LOG_TYPE, getType());
+      writer.put(LOG_TIME, getTime());
+      writer.endObject();
+    }
+
     /**
      * Generate LogEntry from json object
      * @param jsonValues
@@ -143,6 +271,35 @@ public class Secret implements Comparable<Secret>, Serializable {
       return new LogEntry(jsonValues.getInt(LOG_TYPE),
                            jsonValues.getLong(LOG_TIME));
     }
+
+    /**
+     * Generate LogEntry from a streaming json reader positioned at the start
+     * of the entry's object.
+     * @param reader
+     * @return LogEntry
+     * @throws IOException
+     */
+    public static LogEntry fromJSON(JsonReader reader) throws IOException {
+      Integer type = null;
+      Long time = null;
+      reader.beginObject();
+      while (reader.hasNext()) {
+        String name = reader.nextName();
+        if (LOG_TYPE.equals(name)) {
+          type = reader.nextInt();
+        } else if (LOG_TIME.equals(name)) {
+          time = reader.nextLong();
+        } else {
+          reader.skipValue();
+        }
+      }
+      reader.endObject();
+
+      if (null == type || null == time)
+        throw new IOException("Incomplete log entry");
+
+      return new LogEntry(type, time);
+    }
   }
 
   /**
@@ -150,8 +307,43 @@ public class Secret implements Comparable<Secret>, Serializable {
    * only one CREATED entry, with the current time.
    */
   public Secret() {
-    access_log = new ArrayList<LogEntry>();
-    access_log.add(new LogEntry());
+    setInlineLog(null);
+    id = random.nextLong();
+  }
+
+  /** Creates a copy of a secret, see snapshot(). */
+  private Secret(Secret from) {
+    description = from.description;
+    username = from.username;
+    password = from.password;
+    email = from.email;
+    note = from.note;
+    if (null != from.access_log)
+      access_log = new ArrayList<LogEntry>(from.access_log);
+    deleted = from.deleted;
+    revision = from.revision;
+    id = from.id;
+    sealed = from.sealed;
+    sealedDeflated = from.sealedDeflated;
+    sealKey = from.sealKey;
+    sealSuite = from.sealSuite;
+    sealStale = from.sealStale;
+    opened = from.opened;
+    recentAccess = from.recentAccess;
+    recordedAccess = from.recordedAccess;
+    lastChanged = from.lastChanged;
+    unloggedEntries = new ArrayList<LogEntry>(from.unloggedEntries);
+    resetLog = from.resetLog;
+  }
+
+  /**
+   * Returns a copy of this secret that later edits of this one do not
+   * affect, for a job that reads it on another thread.  A sealed secret is
+   * copied without being decrypted: the sealed bytes are shared, since they
+   * are replaced rather than modified.
+   */
+  synchronized Secret snapshot() {
+    return new Secret(this);
   }
 
   /**
@@ -171,10 +363,29 @@ public class Secret implements Comparable<Secret>, Serializable {
   private void readObject(ObjectInputStream stream)
       throws IOException, ClassNotFoundException {
     stream.defaultReadObject();
+    id = random.nextLong();
+    opened = true;
+    setInlineLog(access_log);
+  }
+
+  /**
+   * Opens the secret and loads its access log before it is serialized, so
+   * that the password, note and access log are written.
+   *
+   * @param stream
+   * @throws IOException
+   */
+  private void writeObject(ObjectOutputStream stream) throws IOException {
+    loadAccessLog();
+    synchronized (this) {
+      unseal();
+      stream.defaultWriteObject();
+    }
   }
 
   public void setDescription(String description) {
     this.description = description;
+    markChanged();
   }
   public String getDescription() {
     return description;
@@ -182,6 +393,7 @@ public class Secret implements Comparable<Secret>, Serializable {
 
   public void setUsername(String username) {
     this.username = username;
+    markChanged();
   }
 
   public String getUsername() {
@@ -197,11 +409,17 @@ public class Secret implements Comparable<Secret>, Serializable {
    *                              do nothing
    */
   public void setPassword(String password, boolean createDefaultLogEntry) {
-    if (createDefaultLogEntry) {
-      createLogEntry(LogEntry.CHANGED);
-    }
+    synchronized (this) {
+      unseal();
+      if (createDefaultLogEntry) {
+        createLogEntry(LogEntry.CHANGED);
+      }
 
-    this.password = password;
+      this.password = password;
+      sealStale = true;
+      markChanged();
+    }
+    touch();
   }
 
   /**
@@ -217,7 +435,14 @@ public class Secret implements Comparable<Secret>, Serializable {
    *
    * Any other type is ignored.
    *
-   * The first two conditons are to prevent too many log entries.
+   * The first two conditons are to prevent too many log entries.  The same
+   * rules are applied again when the log is rebuilt from the access log
+   * file, see buildAccessLog().
+   *
+   * VIEWED and EXPORTED entries do not modify the secret: they are only
+   * written to the access log file, see ChangeTracker.accessed().
+   *
+   * The caller must hold the lock on this secret.
    *
    * @param type VIEWED, CHANGED, EXPORTED, SYNCED
    */
@@ -232,17 +457,33 @@ public class Secret implements Comparable<Secret>, Serializable {
 
     long now = System.currentTimeMillis();
     if (type == LogEntry.VIEWED || type == LogEntry.CHANGED) {
-      LogEntry lastEntry = access_log.get(0);
+      LogEntry lastEntry = recentAccess;
       if (now - lastEntry.getTime() < THRESHOLD_MS) {
         if (type == LogEntry.VIEWED) return;
         if (lastEntry.getType() == LogEntry.VIEWED) {
-          access_log.remove(0);
+          if (null != access_log)
+            access_log.remove(0);
+          int last = unloggedEntries.size() - 1;
+          if (last >= 0 && unloggedEntries.get(last) == lastEntry)
+            unloggedEntries.remove(last);
         }
       }
     }
 
-    access_log.add(0, new LogEntry(type, now));
-    pruneAccessLog();
+    LogEntry entry = new LogEntry(type, now);
+    if (null != access_log) {
+      access_log.add(0, entry);
+      pruneAccessLog(access_log);
+    }
+    unloggedEntries.add(entry);
+    recentAccess = entry;
+    if (isChange(type)) {
+      recordedAccess = entry;
+      lastChanged = now;
+      markChanged();
+    } else {
+      ChangeTracker.accessed();
+    }
   }
 
   /**
@@ -252,13 +493,27 @@ public class Secret implements Comparable<Secret>, Serializable {
    * @return password
    */
   public String getPassword(boolean forExport) {
-     createLogEntry(forExport ? LogEntry.EXPORTED : LogEntry.VIEWED);
+    String value;
+    synchronized (this) {
+      unseal();
+      createLogEntry(forExport ? LogEntry.EXPORTED : LogEntry.VIEWED);
+      value = password;
+    }
+    touch();
+    return value;
+  }
 
-    return password;
+  /**
+   * Records an EXPORTED entry in the access log, for a secret exported
+   * through a snapshot of it.
+   */
+  public synchronized void setExported() {
+    createLogEntry(LogEntry.EXPORTED);
   }
 
   public void setEmail(String email) {
     this.email = email;
+    markChanged();
   }
 
   public String getEmail() {
@@ -266,11 +521,23 @@ public class Secret implements Comparable<Secret>, Serializable {
   }
 
   public void setNote(String note) {
-    this.note = note;
+    synchronized (this) {
+      unseal();
+      this.note = note;
+      sealStale = true;
+      markChanged();
+    }
+    touch();
   }
 
   public String getNote() {
-    return note;
+    String value;
+    synchronized (this) {
+      unseal();
+      value = note;
+    }
+    touch();
+    return value;
   }
 
 	/**
@@ -284,8 +551,11 @@ public class Secret implements Comparable<Secret>, Serializable {
    * Set the secret as deleted
    */
   public void setDeleted() {
-    deleted = true;
-    createLogEntry(LogEntry.DELETED);
+    synchronized (this) {
+      deleted = true;
+      markChanged();
+      createLogEntry(LogEntry.DELETED);
+    }
   }
 
   /**
@@ -297,11 +567,28 @@ public class Secret implements Comparable<Secret>, Serializable {
 	  if (!(reason == LogEntry.CHANGED || reason == LogEntry.SYNCED || equals(from)))
 	    return;
 
-		setPassword(from.password, false);
-		username = from.getUsername();
-		email = from.getEmail();
-		note = from.getNote();
-		createLogEntry(reason);
+    // Read from the other secret first, without creating a log entry in it,
+    // so that the locks of both secrets are never held together.
+    String fromPassword;
+    String fromNote;
+    synchronized (from) {
+      from.unseal();
+      fromPassword = from.password;
+      fromNote = from.note;
+    }
+    from.touch();
+
+    synchronized (this) {
+      unseal();
+      password = fromPassword;
+      username = from.getUsername();
+      email = from.getEmail();
+      note = fromNote;
+      sealStale = true;
+      markChanged();
+      createLogEntry(reason);
+    }
+    touch();
 	}
 
   /**
@@ -310,22 +597,55 @@ public class Secret implements Comparable<Secret>, Serializable {
    * @throws JSONException
    */
   public JSONObject toJSON() throws JSONException {
-    JSONObject jsonSecret = new JSONObject();
-    jsonSecret.put(SECRET_DESCRIPTION, description);
-    jsonSecret.put(SECRET_USERNAME, username);
-    jsonSecret.put(SECRET_PASSWORD, password);
-    jsonSecret.put(SECRET_EMAIL, email);
-    jsonSecret.put(SECRET_NOTE, note);
-    jsonSecret.put(SECRET_TIMESTAMP, getLastChangedTime());
-    jsonSecret.put(SECRET_DELETED, deleted);
-
-    JSONArray jsonLog = new JSONArray();
-    for (LogEntry logEntry : access_log) {
-      jsonLog.put(logEntry.toJSON());
+    loadAccessLog();
+    synchronized (this) {
+      unseal();
+      JSONObject jsonSecret = new JSONObject();
+      jsonSecret.put(SECRET_DESCRIPTION, description);
+      jsonSecret.put(SECRET_USERNAME, username);
+      jsonSecret.put(SECRET_PASSWORD, password);
+      jsonSecret.put(SECRET_EMAIL, email);
+      jsonSecret.put(SECRET_NOTE, note);
+      jsonSecret.put(SECRET_TIMESTAMP, lastChanged);
+      jsonSecret.put(SECRET_DELETED, deleted);
+
+      JSONArray jsonLog = new JSONArray();
+      for (LogEntry logEntry : access_log) {
+        jsonLog.put(logEntry.toJSON());
+      }
+      jsonSecret.put(SECRET_ACCESS_LOG, jsonLog);
+
+      return jsonSecret;
     }
-    jsonSecret.put(SECRET_ACCESS_LOG, jsonLog);
+  }
+
+  /**
+   * Write secret to a streaming JSON writer.  The output is the same as
+   * toJSON().toString(), without building the intermediate JSON objects.
+   * @param writer JSON stream writer
+   * @throws IOException
+   */
+  public void writeJSON(JSONStreamWriter writer) throws IOException {
+    loadAccessLog();
+    synchronized (this) {
+      unseal();
+      writer.object();
+      writer.put(SECRET_DESCRIPTION, description);
+      writer.put(SECRET_USERNAME, username);
+      writer.put(SECRET_PASSWORD, password);
+      writer.put(SECRET_EMAIL, email);
+      writer.put(SECRET_NOTE, note);
+      writer.put(SECRET_TIMESTAMP, lastChanged);
+      writer.put(SECRET_DELETED, deleted);
+
+      writer.key(SECRET_ACCESS_LOG).array();
+      for (LogEntry logEntry : access_log) {
+        logEntry.writeJSON(writer);
+      }
+      writer.endArray();
 
-    return jsonSecret;
+      writer.endObject();
+    }
   }
 
   /**
@@ -351,26 +671,442 @@ public class Secret implements Comparable<Secret>, Serializable {
       for (int i = 0; i < jsonLog.length(); i++) {
         log.add(LogEntry.fromJSON((JSONObject)jsonLog.get(i)));
       }
-      secret.access_log = log;
+      secret.setInlineLog(log);
       if (!(log.size() > 0)) {
          Log.w(LOG_TAG, "Empty access log for secret '" + secret.description
                      + "'");
       }
     }
-    
-    // at this point we still may have no log, or an empty log.
-    // we must have a log with at least a CREATED entry
-    if (secret.access_log == null) {
-      secret.access_log = new ArrayList<LogEntry>();
+
+    return secret;
+  }
+
+  /**
+   * Read a Secret from a streaming json reader positioned at the start of the
+   * secret's object.  This accepts exactly what fromJSON(JSONObject) accepts,
+   * without first building the JSON object in memory.
+   * @param reader JSON stream reader
+   * @return instance of a Secret
+   * @throws IOException
+   */
+  public static Secret fromJSON(JsonReader reader) throws IOException {
+    Secret secret = new Secret();
+    reader.beginObject();
+    while (reader.hasNext()) {
+      String name = reader.nextName();
+      if (SECRET_DESCRIPTION.equals(name)) {
+        secret.description = reader.nextString();
+      } else if (SECRET_USERNAME.equals(name)) {
+        secret.username = reader.nextString();
+      } else if (SECRET_PASSWORD.equals(name)) {
+        secret.password = reader.nextString();
+      } else if (SECRET_EMAIL.equals(name)) {
+        secret.email = reader.nextString();
+      } else if (SECRET_NOTE.equals(name)) {
+        secret.note = reader.nextString();
+      } else if (SECRET_DELETED.equals(name)) {
+        secret.deleted = reader.nextBoolean();
+      } else if (SECRET_ACCESS_LOG.equals(name)) {
+        ArrayList<LogEntry> log = new ArrayList<LogEntry>();
+        reader.beginArray();
+        while (reader.hasNext()) {
+          log.add(LogEntry.fromJSON(reader));
+        }
+        reader.endArray();
+        secret.setInlineLog(log);
+        if (!(log.size() > 0)) {
+          Log.w(LOG_TAG, "Empty access log for secret '" + secret.description
+                     + "'");
+        }
+      } else {
+        reader.skipValue();
+      }
+    }
+    reader.endObject();
+
+    if (null == secret.description || null == secret.username ||
+        null == secret.password || null == secret.email ||
+        null == secret.note) {
+      throw new IOException("Incomplete secret");
+    }
+
+    return secret;
+  }
+
+  /**
+   * Write secret as a record of the binary vault format.  Null fields are not
+   * written.
+   *
+   * If a key is given, the password and note are sealed: they are written as
+   * a single field holding a random IV followed by those fields encrypted
+   * with the key and cipher suite of the file, so that they need not be
+   * decrypted when the vault is loaded.  The suite is written in the record
+   * unless it is AES-CBC, which records written before suites existed use.  The most recent access log entry and the last changed time are
+   * also written in the record itself.  An existing sealed value is reused
+   * as is if the password and note were not modified since, so recording an
+   * access does not encrypt anything again.
+   *
+   * If no key is given, the fields are written in the record itself.
+   *
+   * The access log itself is only written if inlineLog is true or no key is
+   * given, otherwise it belongs in the access log file.  It is written as a
+   * single nested field holding, for each entry, its type followed by the
+   * difference between its time and the time of the previous entry.  Since
+   * entries are close together in time, this takes one or two bytes per
+   * timestamp instead of eight.
+   * @param writer Record writer; the caller resets it between secrets
+   * @param key Key to seal the secret with, or null
+   * @param suite Cipher suite to seal the secret with, see
+   *     SecurityUtils.SUITE_AES_CBC
+   * @param inlineLog Write the access log in the record
+   * @throws IOException if the secret cannot be encrypted or decrypted, or
+   *     if the access log is needed but not loaded
+   */
+  public synchronized void writeRecord(RecordWriter writer, SecretKey key,
+                                       int suite, boolean inlineLog)
+      throws IOException {
+    inlineLog |= null == key;
+    if (inlineLog && null == access_log)
+      throw new IOException("Access log not loaded");
+
+    writer.writeString(FIELD_DESCRIPTION, description);
+    writer.writeString(FIELD_USERNAME, username);
+    writer.writeString(FIELD_EMAIL, email);
+    writer.writeBoolean(FIELD_DELETED, deleted);
+    writer.writeVarint(FIELD_ID, id);
+
+    boolean reuse = null != key && null != sealed && key.equals(sealKey) &&
+        suite == sealSuite && !sealStale;
+    if (!reuse) {
+      boolean wasOpened = opened;
+      unseal();
+      if (null == key) {
+        writeSealedFields(writer);
+      } else {
+        seal(key, suite);
+      }
+
+      // Don't keep plaintext around that nobody asked for.
+      if (!wasOpened || (null != key && !isTracked()))
+        drop();
+    }
+
+    if (null != key) {
+      RecordWriter recent = new RecordWriter(16);
+      recent.writeRawVarint(recordedAccess.getType());
+      recent.writeRawVarint(recordedAccess.getTime());
+      writer.writeBytes(FIELD_RECENT_ACCESS, recent);
+      writer.writeVarint(FIELD_LAST_CHANGED, lastChanged);
+      if (SecurityUtils.SUITE_AES_CBC != sealSuite)
+        writer.writeVarint(FIELD_SEAL_SUITE, sealSuite);
+      writer.writeBytes(sealedDeflated ? FIELD_SEALED_DEFLATED : FIELD_SEALED,
+                        sealed, 0, sealed.length);
+    }
+
+    if (inlineLog)
+      writeAccessLog(writer);
+  }
+
+  /** Writes the fields that are sealed in the binary format. */
+  private void writeSealedFields(RecordWriter writer) {
+    writer.writeString(FIELD_PASSWORD, password);
+    writer.writeString(FIELD_NOTE, note);
+  }
+
+  /** Writes the access log as a field.  The log must be loaded. */
+  private void writeAccessLog(RecordWriter writer) {
+    RecordWriter log = new RecordWriter(access_log.size() * 4);
+    long previous = 0;
+    for (LogEntry logEntry : access_log) {
+      log.writeRawVarint(logEntry.getType());
+      log.writeSignedRawVarint(logEntry.getTime() - previous);
+      previous = logEntry.getTime();
+    }
+    writer.writeBytes(FIELD_ACCESS_LOG, log);
+  }
+
+  /**
+   * Read a field that is sealed in the binary format, or the access log
+   * which was sealed by older versions.
+   * @return False if the tag is not one of those fields
+   */
+  private boolean readSealedField(int tag, RecordReader reader)
+      throws IOException {
+    switch (tag) {
+      case TAG_PASSWORD:
+        password = reader.readString();
+        return true;
+      case TAG_NOTE:
+        note = reader.readString();
+        return true;
+      case TAG_ACCESS_LOG: {
+        RecordReader logReader = reader.readRecord();
+        ArrayList<LogEntry> log = new ArrayList<LogEntry>();
+        long time = 0;
+        while (logReader.hasMore()) {
+          int type = (int) logReader.readRawVarint();
+          time += logReader.readSignedRawVarint();
+          log.add(new LogEntry(type, time));
+        }
+        setInlineLog(log);
+        return true;
+      }
+      default:
+        return false;
+    }
+  }
+
+  /**
+   * Read a Secret from a record of the binary vault format.  Unknown fields
+   * are skipped.  A sealed secret is not decrypted, but keeps a reference to
+   * the key so that it can be later.  Its access log is not loaded either,
+   * unless the record holds it.
+   *
+   * Records written by older versions sealed the access log along with the
+   * password and note.  Those are decrypted right away and sealed again
+   * without the log, which then goes to the access log file on the next
+   * save.
+   * @param reader Record reader over exactly one record
+   * @param key Key the secret was sealed with
+   * @return instance of a Secret
+   * @throws IOException if the record is malformed
+   */
+  public static Secret fromRecord(RecordReader reader, SecretKey key)
+      throws IOException {
+    Secret secret = new Secret();
+    secret.access_log = null;
+    secret.unloggedEntries = new ArrayList<LogEntry>();
+    secret.resetLog = false;
+    secret.recentAccess = null;
+    secret.recordedAccess = null;
+    secret.lastChanged = 0;
+    boolean sealedWithLog = false;
+    while (reader.hasMore()) {
+      int tag = reader.readTag();
+      switch (tag) {
+        case TAG_DESCRIPTION:
+          secret.description = reader.readString();
+          break;
+        case TAG_USERNAME:
+          secret.username = reader.readString();
+          break;
+        case TAG_EMAIL:
+          secret.email = reader.readString();
+          break;
+        case TAG_DELETED:
+          secret.deleted = reader.readBoolean();
+          break;
+        case TAG_ID:
+          secret.id = reader.readRawVarint();
+          break;
+        case TAG_RECENT_ACCESS: {
+          RecordReader recent = reader.readRecord();
+          int type = (int) recent.readRawVarint();
+          secret.recentAccess = new LogEntry(type, recent.readRawVarint());
+          secret.recordedAccess = secret.recentAccess;
+          break;
+        }
+        case TAG_LAST_CHANGED:
+          secret.lastChanged = reader.readRawVarint();
+          break;
+        case TAG_SEAL_SUITE:
+          secret.sealSuite = (int) reader.readRawVarint();
+          break;
+        case TAG_SEALED:
+        case TAG_SEALED_WITH_LOG:
+          secret.sealed = reader.readBytes();
+          secret.sealedDeflated = false;
+          sealedWithLog = TAG_SEALED_WITH_LOG == tag;
+          break;
+        case TAG_SEALED_DEFLATED:
+        case TAG_SEALED_WITH_LOG_DEFLATED:
+          secret.sealed = reader.readBytes();
+          secret.sealedDeflated = true;
+          sealedWithLog = TAG_SEALED_WITH_LOG_DEFLATED == tag;
+          break;
+        default:
+          if (!secret.readSealedField(tag, reader))
+            reader.skip(tag);
+          break;
+      }
     }
-    if (secret.access_log.size() == 0) {
-      secret.access_log.add(0, new LogEntry());
+
+    if (null == secret.description)
+      throw new IOException("Secret record without description");
+
+    if (null != secret.sealed) {
+      if (null == key || null == secret.recentAccess)
+        throw new IOException("Incomplete sealed secret");
+      secret.sealKey = key;
+      secret.opened = false;
+      if (sealedWithLog) {
+        try {
+          secret.unseal();
+        } catch (IllegalStateException ex) {
+          throw new IOException("Cannot unseal secret: " + ex.getMessage());
+        }
+        secret.seal(key, secret.sealSuite);
+        secret.markChanged();
+      }
+      secret.drop();
+      return secret;
     }
 
+    // we must have a log with at least a CREATED entry
+    if (null == secret.access_log)
+      secret.setInlineLog(null);
+
     return secret;
   }
 
-  public String toString() {
+  /**
+   * Makes sure that password and note hold the values of this secret,
+   * decrypting them if needed.  The caller must hold the lock on this secret.
+   */
+  private void unseal() {
+    if (opened)
+      return;
+
+    try {
+      int ivLength = SecurityUtils.getIvLength(sealSuite);
+      byte[] iv = Arrays.copyOf(sealed, ivLength);
+      Cipher cipher = SecurityUtils.createCipher(sealSuite, Cipher.DECRYPT_MODE,
+                                                 sealKey, iv);
+      if (null == cipher)
+        throw new IOException("Cannot create cipher");
+
+      byte[] plain = cipher.doFinal(sealed, ivLength, sealed.length - ivLength);
+      if (sealedDeflated)
+        plain = FrameCodec.inflate(plain, 0, plain.length);
+
+      RecordReader reader = new RecordReader(plain);
+      while (reader.hasMore()) {
+        int tag = reader.readTag();
+        if (!readSealedField(tag, reader))
+          reader.skip(tag);
+      }
+    } catch (Exception ex) {
+      // The key was good enough to read the vault, so this should never
+      // happen.  Don't let the secret be saved without its fields.
+      throw new IllegalStateException("Cannot unseal secret", ex);
+    }
+
+    opened = true;
+    sealStale = false;
+  }
+
+  /**
+   * Encrypts the password and note with the given key and cipher suite.
+   * They are compressed first if enabled and if this makes them smaller,
+   * which is usually the case for long notes.  The caller must hold the lock
+   * on this secret and have called unseal().
+   */
+  private void seal(SecretKey key, int suite) throws IOException {
+    RecordWriter writer = new RecordWriter();
+    writeSealedFields(writer);
+    byte[] plain = writer.toByteArray();
+    boolean deflated = false;
+    int level = FileUtils.getCompressionLevel();
+    if (Deflater.NO_COMPRESSION != level) {
+      byte[] compressed = FrameCodec.deflate(plain, 0, plain.length, level);
+      if (compressed.length < plain.length) {
+        plain = compressed;
+        deflated = true;
+      }
+    }
+
+    byte[] iv = SecurityUtils.createIv(suite);
+    Cipher cipher = SecurityUtils.createCipher(suite, Cipher.ENCRYPT_MODE, key,
+                                               iv);
+    if (null == cipher)
+      throw new IOException("Cannot create cipher");
+
+    byte[] encrypted;
+    try {
+      encrypted = cipher.doFinal(plain);
+    } catch (GeneralSecurityException ex) {
+      throw new IOException("Cannot seal secret: " + ex.getMessage());
+    }
+
+    sealed = new byte[iv.length + encrypted.length];
+    System.arraycopy(iv, 0, sealed, 0, iv.length);
+    System.arraycopy(encrypted, 0, sealed, iv.length, encrypted.length);
+    sealedDeflated = deflated;
+    sealKey = key;
+    sealSuite = suite;
+    sealStale = false;
+  }
+
+  /**
+   * Forgets the plaintext of the sealed fields.  The caller must hold the
+   * lock on this secret, and the sealed value must be up to date.
+   */
+  private void drop() {
+    password = null;
+    note = null;
+    opened = false;
+  }
+
+  /**
+   * Closes this secret if it is open, sealing it again first if it was
+   * modified since it was opened.
+   */
+  private synchronized void close() {
+    if (!opened || null == sealKey)
+      return;
+
+    if (sealStale) {
+      try {
+        seal(sealKey, sealSuite);
+      } catch (IOException ex) {
+        Log.e(LOG_TAG, "Cannot seal secret, leaving it open", ex);
+        return;
+      }
+    }
+    drop();
+  }
+
+  /**
+   * Marks this secret as the most recently used one, closing the least
+   * recently used open secret if there are too many.  The caller must not
+   * hold the lock on any secret.
+   */
+  private void touch() {
+    synchronized (this) {
+      if (null == sealKey)
+        return;
+    }
+
+    Secret evicted = null;
+    synchronized (openSecrets) {
+      for (int i = openSecrets.size() - 1; i >= 0; --i) {
+        if (openSecrets.get(i) == this) {
+          openSecrets.remove(i);
+          break;
+        }
+      }
+      openSecrets.add(this);
+      if (openSecrets.size() > MAX_OPEN_SECRETS)
+        evicted = openSecrets.remove(0);
+    }
+
+    if (null != evicted)
+      evicted.close();
+  }
+
+  /** Is this secret one of the recently used open secrets? */
+  private boolean isTracked() {
+    synchronized (openSecrets) {
+      for (Secret secret : openSecrets) {
+        if (secret == this)
+          return true;
+      }
+      return false;
+    }
+  }
+
+  public synchronized String toString() {
+    unseal();
     StringBuilder sb = new StringBuilder();
     sb.append("d=").append(description);
     sb.append(",u=").append(username);
@@ -397,44 +1133,208 @@ public class Secret implements Comparable<Secret>, Serializable {
     return description.compareToIgnoreCase(anotherSecret.description);
   }
 
+  /**
+   * Records that this secret was modified, so that it gets saved.
+   */
+  private void markChanged() {
+    ++revision;
+    ChangeTracker.changed();
+  }
+
+  /**
+   * Returns a number that changes every time this secret is modified.
+   */
+  int getRevision() {
+    return revision;
+  }
+
+  /**
+   * Returns the identifier of this secret, which does not change when the
+   * secret is modified.
+   */
+  long getId() {
+    return id;
+  }
+
   /**
    * Get an unmodifiable list of access logs, in reverse chronological order,
    * for this secret.
    */
   public List<LogEntry> getAccessLog() {
-    return Collections.unmodifiableList(access_log);
+    loadAccessLog();
+    synchronized (this) {
+      return Collections.unmodifiableList(access_log);
+    }
   }
 
   /**
    * A helper function to return the most recent access log entry of this
    * secret.
    */
-  public LogEntry getMostRecentAccess() {
-    return access_log.get(0);
+  public synchronized LogEntry getMostRecentAccess() {
+    return recentAccess;
   }
  
   /**
    * Get last changed time
    * @return long time
    */
-  public long getLastChangedTime() {
+  public synchronized long getLastChangedTime() {
+    return lastChanged;
+  }
+
+  /**
+   * Get the most recent entry of an access log that changed the secret, or
+   * null if there is none.
+   */
+  private static LogEntry getRecentChange(List<LogEntry> access_log) {
     for (int i = 0; i < access_log.size(); i++) {
       LogEntry entry = access_log.get(i);
-      if (entry.getType() == LogEntry.CHANGED ||
-          entry.getType() == LogEntry.SYNCED ||
-          entry.getType() == LogEntry.CREATED ||
-          entry.getType() == LogEntry.DELETED) {
-        return entry.getTime();
+      if (isChange(entry.getType()))
+        return entry;
+    }
+    return null;
+  }
+
+  /** Does a log entry of the given type count as a change of the secret? */
+  private static boolean isChange(int type) {
+    return type == LogEntry.CHANGED || type == LogEntry.SYNCED ||
+        type == LogEntry.CREATED || type == LogEntry.DELETED;
+  }
+
+  /**
+   * Replaces the access log with the given one, in reverse chronological
+   * order, for a secret whose log does not come from the access log file.
+   * The whole log replaces whatever the file holds for this secret on the
+   * next flush.  The caller must hold the lock on this secret, if needed.
+   */
+  private void setInlineLog(List<LogEntry> log) {
+    access_log = new ArrayList<LogEntry>();
+    if (null != log)
+      access_log.addAll(log);
+
+    // we must have a log with at least a CREATED entry
+    if (access_log.size() == 0)
+      access_log.add(new LogEntry());
+
+    recentAccess = access_log.get(0);
+    LogEntry change = getRecentChange(access_log);
+    recordedAccess = null != change ? change : recentAccess;
+    lastChanged = null != change ? change.getTime() : 0;
+    unloggedEntries = new ArrayList<LogEntry>(access_log);
+    Collections.reverse(unloggedEntries);
+    resetLog = true;
+  }
+
+  /**
+   * Makes sure the access log is loaded, reading it from the access log file
+   * if needed.  The caller must not hold the lock on any secret.
+   */
+  private void loadAccessLog() {
+    synchronized (this) {
+      if (null != access_log)
+        return;
+    }
+
+    AccessLogStore.load(this);
+    attachAccessLog(null);
+  }
+
+  /**
+   * Sets the access log of this secret from the entries found in the access
+   * log file, merged with the entries not yet written there.  Does nothing if
+   * the log is already loaded.
+   *
+   * @param history Entries of the access log file for this secret, oldest
+   *     first, or null if there are none.
+   */
+  synchronized void attachAccessLog(List<LogEntry> history) {
+    if (null != access_log)
+      return;
+
+    ArrayList<LogEntry> entries = new ArrayList<LogEntry>();
+    if (!resetLog && null != history)
+      entries.addAll(history);
+    entries.addAll(unloggedEntries);
+
+    // The file may have lost entries that made it into the secrets file, for
+    // example if it could not be written.  Keep at least the most recent one.
+    if (entries.isEmpty() ||
+        entries.get(entries.size() - 1).getTime() < recentAccess.getTime()) {
+      entries.add(recentAccess);
+    }
+
+    access_log = buildAccessLog(entries);
+    recentAccess = access_log.get(0);
+  }
+
+  /**
+   * Builds an access log from entries in chronological order, as read from
+   * the access log file.  Entries were filtered by createLogEntry() when they
+   * were made, except that a CHANGED entry may have followed a recent VIEWED
+   * entry that was already written to the file, so the VIEWED entry is
+   * removed here instead.  The log is pruned to its maximum size.
+   *
+   * @param entries Log entries, oldest first.
+   * @return The access log, in reverse chronological order.
+   */
+  static ArrayList<LogEntry> buildAccessLog(List<LogEntry> entries) {
+    ArrayList<LogEntry> log = new ArrayList<LogEntry>(entries.size());
+    for (LogEntry entry : entries) {
+      if (entry.getType() == LogEntry.CHANGED && !log.isEmpty()) {
+        LogEntry lastEntry = log.get(0);
+        if (lastEntry.getType() == LogEntry.VIEWED &&
+            entry.getTime() - lastEntry.getTime() < THRESHOLD_MS) {
+          log.remove(0);
+        }
+      }
+      log.add(0, entry);
+    }
+    pruneAccessLog(log);
+    return log;
+  }
+
+  /**
+   * Returns the access log entries not yet written to the access log file,
+   * oldest first.
+   */
+  synchronized List<LogEntry> getUnloggedEntries() {
+    return new ArrayList<LogEntry>(unloggedEntries);
+  }
+
+  /**
+   * Should the entries of the access log file for this secret be discarded
+   * when the unlogged entries are written?
+   */
+  synchronized boolean isLogReset() {
+    return resetLog;
+  }
+
+  /**
+   * Records that the given entries, returned by getUnloggedEntries(), are now
+   * in the access log file.
+   *
+   * @param entries The entries written.
+   * @param reset True if the entries replaced those already in the file.
+   */
+  synchronized void setLogged(List<LogEntry> entries, boolean reset) {
+    for (LogEntry entry : entries) {
+      for (int i = 0; i < unloggedEntries.size(); ++i) {
+        if (unloggedEntries.get(i) == entry) {
+          unloggedEntries.remove(i);
+          break;
+        }
       }
     }
-    return 0;
+    if (reset)
+      resetLog = false;
   }
 
   /**
    * Prune the size of the access log to the maximum size by getting rid of
    * the oldest entries.  The "created" log entry is never pruned away.
    */
-  private void pruneAccessLog() {
+  private static void pruneAccessLog(List<LogEntry> access_log) {
     // TODO(rogerta): may want to give lower priority to VIEWED entries.  Could
     // maybe implement this by doing a first pass that removes VIEWED entries
     // first to see if we can reach the limit.  If not, then do a paas to delete
@@ -17,6 +17,7 @@ package net.tawacentral.roger.secrets;
 import android.app.AlertDialog;
 import android.app.Dialog;
 import android.app.ListActivity;
+import android.app.ProgressDialog;
 import android.app.SearchManager;
 import android.content.DialogInterface;
 import android.content.Intent;
@@ -47,6 +48,7 @@ import android.widget.AdapterView.OnItemClickListener;
 import android.widget.AutoCompleteTextView;
 import android.widget.EditText;
 import android.widget.ListView;
+import android.widget.RadioGroup;
 import android.widget.ScrollView;
 import android.widget.SeekBar;
 import android.widget.TextView;
@@ -61,8 +63,6 @@ import java.util.Collection;
 import java.util.Date;
 import java.util.List;
 
-import javax.crypto.Cipher;
-
 import static net.tawacentral.roger.secrets.FileUtils.DISABLE_DEPRECATION_WARNING;
 
 /**
@@ -95,7 +95,11 @@ public class SecretsListActivity extends ListActivity {
   private static final int RC_STORAGE_BACKUP = 4;
   private static final int RC_STORAGE_RESTORE = 5;
 
-  private static final int PROGRESS_ROUNDS_OFFSET = 4;
+  private static final int PROGRESS_ROUNDS_OFFSET = Kdf.MIN_COST;
+
+  // Radio buttons of the change password dialog, indexed by Kdf id.
+  private static final int[] KDF_BUTTONS =
+      {R.id.kdf_bcrypt, R.id.kdf_pbkdf2, R.id.kdf_scrypt};
 
   private static final String EMPTY_STRING = "";
 
@@ -134,6 +138,46 @@ public class SecretsListActivity extends ListActivity {
   private boolean isConfigChange; // being destroyed for config change?
   private String restorePoint; // That file that should be restored from
   private OnlineSyncAgent selectedOSA; // currently selected agent
+  private ProgressDialog progressDialog; // progress of the backup job
+
+  // The backup or export running in the background, or finished but not yet
+  // reported to the user.  Kept across activities so that a recreated
+  // activity shows its progress.
+  private static BackupJob backupJob;
+
+  private final BackupJob.Listener backupListener = new BackupJob.Listener() {
+    @Override
+    public void onProgress(BackupJob job, int records, long bytes) {
+      if (null != progressDialog) {
+        progressDialog.setProgress(records);
+        String template = getText(R.string.progress_bytes).toString();
+        progressDialog.setMessage(MessageFormat.format(template,
+                                                       bytes / 1024));
+      }
+    }
+
+    @Override
+    public void onFinished(BackupJob job, boolean success) {
+      if (null != progressDialog) {
+        progressDialog.dismiss();
+        progressDialog = null;
+      }
+      if (job == backupJob)
+        backupJob = null;
+
+      boolean backup = BackupJob.BACKUP == job.getKind();
+      if (success) {
+        showToast(backup ? R.string.backup_succeeded
+                         : R.string.export_succeeded);
+      } else if (job.isCancelled()) {
+        showToast(backup ? R.string.backup_cancelled
+                         : R.string.export_cancelled);
+      } else {
+        showToast(backup ? R.string.error_save_secrets
+                         : R.string.export_failed);
+      }
+    }
+  };
 
   // This activity will only allow it self to be resumed in specific
   // circumstances, so that leaving the application will force the user to
@@ -202,6 +246,14 @@ public class SecretsListActivity extends ListActivity {
       }
     }
 
+    // A backup or export started by a previous instance of this activity
+    // reports to this one.
+    if (null != backupJob) {
+      if (!backupJob.isFinished())
+        showBackupProgress();
+      backupJob.setListener(backupListener);
+    }
+
     // This listener handles click using the scroll wheel.
     if (OS.supportsScrollWheel()) {
       getListView().setOnItemClickListener(new OnItemClickListener() {
@@ -667,13 +719,9 @@ public class SecretsListActivity extends ListActivity {
       return;
     }
 
-    // Export everything to the SD card.
+    // Export everything to the SD card, in the background.
     // Export does not include deleted secrets
-    if (FileUtils.exportSecrets(this, secretsList.getAllSecrets())) {
-      showToast(R.string.export_succeeded);
-    } else {
-      showToast(R.string.export_failed);
-    }
+    startBackupJob(BackupJob.EXPORT, secretsList.getAllSecrets());
   }
 
   /**
@@ -681,6 +729,9 @@ public class SecretsListActivity extends ListActivity {
    *
    * @param rp
    *          The name of the restore point to restore from.
+   * @param vault
+   *          The restore point, if already opened with FileUtils.openVault(),
+   *          or null.
    * @param info
    *          A CipherInfo structure describing the decryption cipher to use.
    * @param askForPassword
@@ -689,10 +740,12 @@ public class SecretsListActivity extends ListActivity {
    *
    * @return True if the restore succeeded, false otherwise.
    */
-  private boolean restoreSecrets(String rp, SecurityUtils.CipherInfo info,
-      boolean askForPassword) {
+  private boolean restoreSecrets(String rp, VaultFile vault,
+      SecurityUtils.CipherInfo info, boolean askForPassword) {
     // Restore everything from the SD card.
-    ArrayList<Secret> secrets = FileUtils.loadSecrets(this, rp, info);
+    ArrayList<Secret> secrets = null == vault
+        ? FileUtils.loadSecrets(this, rp, info)
+        : FileUtils.loadSecrets(this, vault, info);
     if (null == secrets) {
       if (askForPassword) {
         restorePoint = rp;
@@ -714,16 +767,47 @@ public class SecretsListActivity extends ListActivity {
       return;
     }
 
-    // Backup everything to the SD card.
-    Cipher cipher = SecurityUtils.getEncryptionCipher();
-    byte[] salt = SecurityUtils.getSalt();
-    int rounds = SecurityUtils.getRounds();
-    if (FileUtils.backupSecrets(this, cipher, salt, rounds,
-        secretsList.getAllAndDeletedSecrets())) {
-      showToast(R.string.backup_succeeded);
-    } else {
-      showToast(R.string.error_save_secrets);
-    }
+    // Backup everything to the SD card, in the background.
+    startBackupJob(BackupJob.BACKUP, secretsList.getAllAndDeletedSecrets());
+  }
+
+  /**
+   * Starts a backup or export of the given secrets in the background, and
+   * shows its progress.  Only one runs at a time.
+   *
+   * @param kind BackupJob.BACKUP or BackupJob.EXPORT.
+   * @param secrets The secrets to write.
+   */
+  private void startBackupJob(int kind, ArrayList<Secret> secrets) {
+    if (null != backupJob && !backupJob.isFinished())
+      return;
+
+    backupJob = BackupJob.start(this, kind, secrets,
+                                SecurityUtils.getCipherInfo(), backupListener);
+    showBackupProgress();
+  }
+
+  /** Shows the progress of the backup job, which can be cancelled. */
+  private void showBackupProgress() {
+    final BackupJob job = backupJob;
+    progressDialog = new ProgressDialog(this);
+    progressDialog.setProgressStyle(ProgressDialog.STYLE_HORIZONTAL);
+    progressDialog.setTitle(BackupJob.BACKUP == job.getKind()
+        ? R.string.backup_in_progress : R.string.export_in_progress);
+    progressDialog.setMessage(MessageFormat.format(
+        getText(R.string.progress_bytes).toString(), job.getBytes() / 1024));
+    progressDialog.setMax(job.getTotal());
+    progressDialog.setProgress(job.getRecords());
+    progressDialog.setCancelable(false);
+    progressDialog.setButton(DialogInterface.BUTTON_NEGATIVE,
+        getText(android.R.string.cancel),
+        new DialogInterface.OnClickListener() {
+          @Override
+          public void onClick(DialogInterface dialog, int which) {
+            job.cancel();
+          }
+        });
+    progressDialog.show();
   }
 
   /** Holds the currently chosen item in the restore dialog. */
@@ -732,10 +816,22 @@ public class SecretsListActivity extends ListActivity {
 
     private List<String> restorePoints;
 
-    /** Get an array of choices for the restore dialog. */
+    /**
+     * Get an array of choices for the restore dialog.  Restore points
+     * described by the manifest show their number of secrets.
+     */
     public CharSequence[] getRestoreChoices() {
       restorePoints = FileUtils.getRestorePoints(SecretsListActivity.this);
-      return restorePoints.toArray(new CharSequence[restorePoints.size()]);
+      CharSequence[] choices = new CharSequence[restorePoints.size()];
+      for (int i = 0; i < choices.length; ++i) {
+        String name = restorePoints.get(i);
+        RestorePoint point = FileUtils.getRestorePoint(
+            SecretsListActivity.this, name);
+        choices[i] = null == point || point.getCount() < 0 ? name
+            : getString(R.string.restore_point_summary, name,
+                        point.getCount());
+      }
+      return choices;
     }
 
     public String getSelectedRestorePoint() {
@@ -932,7 +1028,8 @@ public class SecretsListActivity extends ListActivity {
           state.selected = which;
           dialog.dismiss();
           SecurityUtils.CipherInfo info = SecurityUtils.getCipherInfo();
-          if (restoreSecrets(state.getSelectedRestorePoint(), info, true))
+          if (restoreSecrets(state.getSelectedRestorePoint(), null, info,
+                             true))
             showToast(R.string.restore_succeeded);
         }
       };
@@ -989,10 +1086,19 @@ public class SecretsListActivity extends ListActivity {
           SeekBar bar = (SeekBar) dialog.findViewById(R.id.cipher_strength);
           byte[] salt = SecurityUtils.getSalt();
           int rounds = bar.getProgress() + PROGRESS_ROUNDS_OFFSET;
+          Kdf kdf = getCheckedKdf(dialog);
 
+          // A new password is a good time to switch to the fastest cipher
+          // suite.  If the key does not change, keep its suite, since the
+          // journal and access log written with the key use it too.
           SecurityUtils.CipherInfo info = SecurityUtils.createCiphers(password,
-              salt, rounds);
+              salt, rounds, SecurityUtils.selectCipherSuite(), kdf);
+          SecurityUtils.CipherInfo current = SecurityUtils.getCipherInfo();
+          if (null != info && null != current && current.key.equals(info.key))
+            info.suite = current.suite;
           if (null != info) {
+            if (null != current && !current.key.equals(info.key))
+              SaveService.changeKey(SecretsListActivity.this, current, info);
             SecurityUtils.saveCiphers(info);
             showToast(R.string.password_changed);
           } else {
@@ -1012,6 +1118,22 @@ public class SecretsListActivity extends ListActivity {
           .create();
       final Dialog dialogFinal = dialog;
 
+      // Each function has its own range of costs.  Switching back to the
+      // function of the current key shows its cost, switching to another
+      // one shows the cost calibrated for this device.
+      RadioGroup group = (RadioGroup) view.findViewById(R.id.kdf);
+      group.setOnCheckedChangeListener(
+          new RadioGroup.OnCheckedChangeListener() {
+        @Override
+        public void onCheckedChanged(RadioGroup radioGroup, int checkedId) {
+          Kdf kdf = getCheckedKdf(dialogFinal);
+          int rounds = kdf.equals(SecurityUtils.getKdf())
+              ? SecurityUtils.getRounds()
+              : KdfCalibration.getCost(SecretsListActivity.this, kdf);
+          setCipherStrength(dialogFinal, kdf, rounds);
+        }
+      });
+
       SeekBar bar = (SeekBar) view.findViewById(R.id.cipher_strength);
       bar.setOnSeekBarChangeListener(new SeekBar.OnSeekBarChangeListener() {
         @Override
@@ -1040,14 +1162,23 @@ public class SecretsListActivity extends ListActivity {
           TextView password1 = (TextView) dialog.findViewById(R.id.password);
 
           String password = password1.getText().toString();
-          FileUtils.SaltAndRounds saltAndRounds = FileUtils.getSaltAndRounds(
-              null, restorePoint);
+          // The restore point stays open so that its body is read from the
+          // same handle once the key is derived.
+          VaultFile vault = FileUtils.openVault(SecretsListActivity.this,
+                                                restorePoint);
+          FileUtils.SaltAndRounds saltAndRounds = null == vault
+              ? new FileUtils.SaltAndRounds(null, 0)
+              : vault.getSaltAndRounds();
 
           String message = null;
 
           SecurityUtils.CipherInfo info = SecurityUtils.createCiphers(password,
-              saltAndRounds.salt, saltAndRounds.rounds);
-          if (restoreSecrets(restorePoint, info, false)) {
+              saltAndRounds.salt, saltAndRounds.rounds, saltAndRounds.suite,
+              saltAndRounds.kdf);
+          boolean restored = restoreSecrets(restorePoint, vault, info, false);
+          if (null != vault)
+            vault.close();
+          if (restored) {
             SecurityUtils.clearCiphers();
             SecurityUtils.saveCiphers(info);
             message = getText(R.string.password_changed).toString();
@@ -1055,29 +1186,11 @@ public class SecretsListActivity extends ListActivity {
             message += getText(R.string.restore_succeeded).toString();
           } else {
             // Try old encryption mechanisms - this may be a restore point
-            // created by an older version of Secrets. See FileUtils load
-            // methods for details.
-
-            // Try V3.
-            ArrayList<Secret> secrets =
-                FileUtils.loadSecretsV3(SecretsListActivity.this, info,
-                                        restorePoint);
-
-            if (secrets == null) {
-              // Try V2.
-              Cipher cipher2 = SecurityUtils.createDecryptionCipherV2(password,
-                  saltAndRounds.salt, saltAndRounds.rounds);
-              secrets = FileUtils.loadSecretsV2(
-                  SecretsListActivity.this, restorePoint, cipher2,
-                  saltAndRounds.salt, saltAndRounds.rounds);
-            }
-
-            if (secrets == null) {
-              // Try V1.
-              Cipher cipher1 = SecurityUtils.createDecryptionCipherV1(password);
-              secrets = FileUtils.loadSecretsV1(SecretsListActivity.this,
-                  cipher1, restorePoint);
-            }
+            // created by an older version of Secrets.  The header of the
+            // file tells which one applies, see FileUtils.loadLegacySecrets().
+            ArrayList<Secret> secrets = FileUtils.loadLegacySecrets(
+                SecretsListActivity.this, restorePoint, saltAndRounds, info,
+                password);
 
             if (secrets != null) {
               LoginActivity.replaceSecrets(secrets);
@@ -1102,6 +1215,8 @@ public class SecretsListActivity extends ListActivity {
       // confirmation password field.
       view.findViewById(R.id.cipher_strength).setVisibility(View.GONE);
       view.findViewById(R.id.cipher_strength_label).setVisibility(View.GONE);
+      view.findViewById(R.id.kdf).setVisibility(View.GONE);
+      view.findViewById(R.id.kdf_label).setVisibility(View.GONE);
       view.findViewById(R.id.password_validation).setVisibility(View.GONE);
       view.findViewById(R.id.password_validation_label)
           .setVisibility(View.GONE);
@@ -1148,6 +1263,35 @@ public class SecretsListActivity extends ListActivity {
     return dialog;
   }
 
+  /**
+   * Returns the key derivation function checked in the change password
+   * dialog.  If it is the function of the current key, its parameters are
+   * kept.
+   */
+  private static Kdf getCheckedKdf(Dialog dialog) {
+    RadioGroup group = (RadioGroup) dialog.findViewById(R.id.kdf);
+    int checked = group.getCheckedRadioButtonId();
+    int id = Kdf.BCRYPT;
+    for (int i = 0; i < KDF_BUTTONS.length; ++i) {
+      if (KDF_BUTTONS[i] == checked)
+        id = i;
+    }
+
+    Kdf current = SecurityUtils.getKdf();
+    return current.getId() == id ? current : Kdf.create(id);
+  }
+
+  /**
+   * Sets the range of the seek bar of the change password dialog to the
+   * costs of the given function, and its position to the given cost.
+   */
+  private void setCipherStrength(Dialog dialog, Kdf kdf, int rounds) {
+    SeekBar bar = (SeekBar) dialog.findViewById(R.id.cipher_strength);
+    bar.setMax(kdf.getMaxCost() - PROGRESS_ROUNDS_OFFSET);
+    bar.setProgress(rounds - PROGRESS_ROUNDS_OFFSET);
+    setCipherStrengthLabel(dialog, rounds);
+  }
+
   private void setCipherStrengthLabel(Dialog dialog, int rounds) {
     String template = getText(R.string.cipher_strength_label).toString();
     String msg = MessageFormat.format(template, rounds);
@@ -1178,10 +1322,10 @@ public class SecretsListActivity extends ListActivity {
       break;
     }
     case DIALOG_CHANGE_PASSWORD: {
-      SeekBar bar = (SeekBar) dialog.findViewById(R.id.cipher_strength);
-      int rounds = SecurityUtils.getRounds();
-      bar.setProgress(rounds - PROGRESS_ROUNDS_OFFSET);
-      setCipherStrengthLabel(dialog, rounds);
+      Kdf kdf = SecurityUtils.getKdf();
+      RadioGroup group = (RadioGroup) dialog.findViewById(R.id.kdf);
+      group.check(KDF_BUTTONS[kdf.getId()]);
+      setCipherStrength(dialog, kdf, SecurityUtils.getRounds());
       TextView password1 = (TextView) dialog.findViewById(R.id.password);
       password1.setText("");
       TextView password2 = (TextView) dialog
@@ -1267,10 +1411,7 @@ public class SecretsListActivity extends ListActivity {
     // completion even if the user switches to another task/application.
     ArrayList<Secret> secrets = secretsList.getAllAndDeletedSecrets();
 
-    Cipher cipher = SecurityUtils.getEncryptionCipher();
-    byte[] salt = SecurityUtils.getSalt();
-    int rounds = SecurityUtils.getRounds();
-    SaveService.execute(this, secrets, cipher, salt, rounds);
+    SaveService.execute(this, secrets, SecurityUtils.getCipherInfo());
     super.onPause();
   }
 
@@ -1302,6 +1443,15 @@ public class SecretsListActivity extends ListActivity {
       LoginActivity.clearSecrets();
     }
 
+    // A backup or export keeps running on its own snapshot of the secrets,
+    // and reports to the next instance of this activity.
+    if (null != progressDialog) {
+      progressDialog.dismiss();
+      progressDialog = null;
+    }
+    if (null != backupJob)
+      backupJob.setListener(null);
+
     super.onDestroy();
   }
 
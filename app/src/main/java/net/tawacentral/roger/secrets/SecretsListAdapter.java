@@ -328,18 +328,12 @@ public class SecretsListAdapter extends BaseAdapter implements Filterable {
   
   /**
    * Return a collection of all secrets including deleted ones.
-   * This is a merge of the two collections (all secrets and deleted secrets)
-   * unless either is empty, then just the non-empty collection is returned.
-   * The caller should not modify the returned collection.
+   * This is a merge of the two collections (all secrets and deleted secrets).
+   * The returned collection is a new list, so it can be kept and used from
+   * other threads, for example by a save, while the secrets are edited.
    * @return secrets collection
    */
    public ArrayList<Secret> getAllAndDeletedSecrets() {
-      if (deletedSecrets.size() == 0) {
-         return allSecrets;
-      }
-      if (allSecrets.size() == 0) {
-         return deletedSecrets;
-      }
       ArrayList<Secret> allAndDeletedSecrets = new ArrayList<Secret>();
       synchronized (allSecrets) {
          // merge the two collections. Both collections are assumed sorted and
@@ -383,6 +377,7 @@ public class SecretsListAdapter extends BaseAdapter implements Filterable {
       }
     }
 
+    ChangeTracker.changed();
     return secret;
   }
   
@@ -445,6 +440,7 @@ public class SecretsListAdapter extends BaseAdapter implements Filterable {
       // in case a secret of the same name has been previously removed
       deletedSecrets.remove(secret);
     }
+    ChangeTracker.changed();
 
     // Add the username and email to the auto complete adapters.
     if (!usernames.contains(secret.getUsername())) {
@@ -473,6 +469,7 @@ public class SecretsListAdapter extends BaseAdapter implements Filterable {
         OnlineAgentManager.syncSecrets(allSecrets, changedSecrets);
         deletedSecrets.clear();
       }
+      ChangeTracker.changed();
       notifyDataSetChanged();
     }
   }
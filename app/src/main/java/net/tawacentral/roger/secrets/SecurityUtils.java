@@ -15,12 +15,15 @@
 package net.tawacentral.roger.secrets;
 
 import java.nio.charset.StandardCharsets;
+import java.security.MessageDigest;
 import java.security.SecureRandom;
 import java.security.spec.AlgorithmParameterSpec;
 
 import javax.crypto.Cipher;
+import javax.crypto.Mac;
 import javax.crypto.SecretKey;
 import javax.crypto.SecretKeyFactory;
+import javax.crypto.spec.GCMParameterSpec;
 import javax.crypto.spec.IvParameterSpec;
 import javax.crypto.spec.PBEKeySpec;
 import javax.crypto.spec.PBEParameterSpec;
@@ -39,14 +42,95 @@ public class SecurityUtils {
   /** Tag for logging purposes. */
   public static final String LOG_TAG = "Secrets";
 
-  /** Return value of createCiphers call. */
+  /**
+   * Return value of createCiphers call: the key derived from the password,
+   * with the parameters it was derived with.
+   *
+   * Cipher objects are not thread safe, so a CipherInfo does not hold any.
+   * Each operation creates its own ciphers from the key instead, which is
+   * cheap since the key is already derived.  This lets saves, backups and
+   * restores run on different threads with the same CipherInfo.
+   */
   public static class CipherInfo {
-    public Cipher encryptCipher;
-    public Cipher decryptCipher;
+    public SecretKeySpec key;
     public byte[] salt;
     public int rounds;
+    /** Cipher suite used with key by createCipher(), see SUITE_AES_CBC. */
+    public int suite;
+    /** Function the key was derived with, rounds being its cost. */
+    public Kdf kdf = Kdf.DEFAULT;
+
+    /**
+     * Creates a new cipher to encrypt with the key in the V4 format, which
+     * uses AES-CBC with an all zero IV.
+     *
+     * @return The cipher, or null if it could not be created.
+     */
+    public Cipher createEncryptCipher() {
+      return createZeroIvCipher(Cipher.ENCRYPT_MODE, key);
+    }
+
+    /**
+     * Creates a new cipher to decrypt with the key in the V2 to V4 formats,
+     * which use AES-CBC with an all zero IV.
+     *
+     * @return The cipher, or null if it could not be created.
+     */
+    public Cipher createDecryptCipher() {
+      return createZeroIvCipher(Cipher.DECRYPT_MODE, key);
+    }
+
+    /**
+     * Creates a new cipher of the suite of this key for the binary format.
+     *
+     * @return The cipher, or null if it could not be created.
+     */
+    public Cipher createCipher(int mode, byte[] iv) {
+      return SecurityUtils.createCipher(suite, mode, key, iv);
+    }
   }
 
+  /** Length of the initialization vectors used by the vault cipher. */
+  public static final int IV_LENGTH = 16;
+
+  // Cipher suites of the binary file format, whose id is stored in the file
+  // header.  SUITE_AES_CBC is what all files used before suites existed.
+  // The other suites are authenticated, so a wrong key or damaged data is
+  // detected by the cipher itself.
+  public static final int SUITE_AES_CBC = 0;
+  public static final int SUITE_AES_GCM = 1;
+  public static final int SUITE_CHACHA20_POLY1305 = 2;
+
+  // Suites that selectCipherSuite() chooses from.  Files, backups and restore
+  // points are read on other devices, so only suites that every supported
+  // API level provides are used for new keys.  ChaCha20-Poly1305 needs API
+  // level 28, so it is only read.
+  private static final int[] SUITES = {SUITE_AES_CBC, SUITE_AES_GCM};
+
+  private static final String CIPHER_FACTORY_GCM = "AES/GCM/NoPadding";
+  private static final String CIPHER_FACTORY_CHACHA20 =
+      "ChaCha20/Poly1305/NoPadding";
+  private static final String KEY_FACTORY_CHACHA20 = "ChaCha20";
+  private static final int NONCE_LENGTH = 12;
+  private static final int TAG_BITS = 128;
+
+  // selectCipherSuite() times each suite on a buffer of this size, keeping
+  // the best of a few runs after a warm up run.
+  private static final int SUITE_BENCHMARK_SIZE = 64 * 1024;
+  private static final int SUITE_BENCHMARK_RUNS = 4;
+
+  /**
+   * Longest time to derive the key on this device, in millisecs, for which
+   * the cost of a new key is chosen.
+   */
+  public static final long UNLOCK_TARGET_MS = 900;
+
+  /** Length of the key check values returned by createKeyCheck(). */
+  public static final int KEY_CHECK_LENGTH = 16;
+  private static final String KEY_CHECK_MAC = "HmacSHA256";
+  private static final byte[] KEY_CHECK_LABEL =
+      "Secrets key check".getBytes(StandardCharsets.UTF_8);
+
   // The following three constants were used with the initial implementation of
   // secrets.  Secrets now uses a more secure algorithm, but for backwards
   // compatibility, the program needs to be able to load the secrets with the
@@ -99,25 +183,26 @@ public class SecurityUtils {
     }
   }
 
-  private static Cipher encryptCipher;
-  private static Cipher decryptCipher;
-  private static byte[] salt;
-  private static int rounds;
+  // The key saved by saveCiphers(), read from any thread.  The object is
+  // never modified once saved, only replaced.
+  private static volatile CipherInfo saved;
 
   /**
-   * Get the cipher used to encrypt data using the password given to the
-   * createCiphers() function.
+   * Creates a new cipher to encrypt data using the password given to the
+   * createCiphers() function, or returns null if there is none.
    */
   public static Cipher getEncryptionCipher() {
-    return encryptCipher;
+    CipherInfo info = saved;
+    return null == info ? null : info.createEncryptCipher();
   }
 
   /**
-   * Get the cipher used to decrypt data using the password given to the
-   * createCiphers() function.
+   * Creates a new cipher to decrypt data using the password given to the
+   * createCiphers() function, or returns null if there is none.
    */
   public static Cipher getDecryptionCipher() {
-    return decryptCipher;
+    CipherInfo info = saved;
+    return null == info ? null : info.createDecryptCipher();
   }
 
   /**
@@ -125,25 +210,46 @@ public class SecurityUtils {
    * @return A byte array representing the salt for this specific device.
    */
   public static byte[] getSalt() {
-    return salt;
+    CipherInfo info = saved;
+    return null == info ? null : info.salt.clone();
   }
 
   /**
    * Gets the rounds for this device.
-   * @return an integer representing the number of bcrypt rounds.
+   * @return an integer representing the cost of the key derivation function.
    */
   public static int getRounds() {
-    return rounds;
+    CipherInfo info = saved;
+    return null == info ? 0 : info.rounds;
+  }
+
+  /**
+   * Gets the key derivation function for this device.
+   * @return the function of the current key, Kdf.DEFAULT if there is none.
+   */
+  public static Kdf getKdf() {
+    CipherInfo info = saved;
+    return null == info ? Kdf.DEFAULT : info.kdf;
   }
   
-  /** Gets information about current ciphers. */
+  /**
+   * Gets information about current ciphers, or null if no ciphers have been
+   * created.  The caller gets its own copy.
+   */
   public static CipherInfo getCipherInfo() {
-    CipherInfo info = new CipherInfo();
-    info.encryptCipher = encryptCipher;
-    info.decryptCipher = decryptCipher;
-    info.salt = salt.clone();
-    info.rounds = rounds;
-    return info;
+    CipherInfo info = saved;
+    return null == info ? null : copyCipherInfo(info);
+  }
+
+  /** Returns a copy of info, with its own copy of the salt. */
+  private static CipherInfo copyCipherInfo(CipherInfo info) {
+    CipherInfo copy = new CipherInfo();
+    copy.key = info.key;
+    copy.salt = info.salt.clone();
+    copy.rounds = info.rounds;
+    copy.suite = info.suite;
+    copy.kdf = info.kdf;
+    return copy;
   }
 
   /**
@@ -157,6 +263,205 @@ public class SecurityUtils {
     return bytes;
   }
   
+  /**
+   * Creates a new random initialization vector.
+   * @return A new IV, IV_LENGTH bytes long.
+   */
+  public static byte[] createIv() {
+    return createIv(SUITE_AES_CBC);
+  }
+
+  /**
+   * Creates a new random initialization vector, or nonce, for the given
+   * cipher suite.
+   * @return A new IV, getIvLength(suite) bytes long.
+   */
+  public static byte[] createIv(int suite) {
+    byte[] bytes = new byte[getIvLength(suite)];
+    SecureRandom random = new SecureRandom();
+    random.nextBytes(bytes);
+    return bytes;
+  }
+
+  /** Returns the length of the IVs of the given cipher suite. */
+  public static int getIvLength(int suite) {
+    return SUITE_AES_CBC == suite ? IV_LENGTH : NONCE_LENGTH;
+  }
+
+  /**
+   * Creates an AES-CBC cipher with an all zero IV, as used by the V2 to V4
+   * formats for backwards compatibility with secrets created on Android M
+   * and earlier.
+   *
+   * @return The initialized cipher, or null if it could not be created.
+   */
+  private static Cipher createZeroIvCipher(int mode, SecretKey key) {
+    if (null == key)
+      return null;
+    return createCipher(mode, key, new byte[IV_LENGTH]);
+  }
+
+  /**
+   * Create a cipher for the given key and initialization vector.  Unlike the
+   * ciphers returned by getEncryptionCipher() and getDecryptionCipher(), which
+   * always use an all zero IV, this is used by the binary file format where
+   * every encrypted block of data gets its own random IV.
+   *
+   * @param mode Cipher.ENCRYPT_MODE or Cipher.DECRYPT_MODE.
+   * @param key The key returned in CipherInfo by createCiphers().
+   * @param iv The initialization vector.
+   * @return The initialized cipher, or null if it could not be created.
+   */
+  public static Cipher createCipher(int mode, SecretKey key, byte[] iv) {
+    return createCipher(SUITE_AES_CBC, mode, key, iv);
+  }
+
+  /**
+   * Create a cipher of the given suite for the given key and initialization
+   * vector.  With the authenticated suites, an IV must never be used twice
+   * for encryption with the same key, so it should come from createIv().
+   *
+   * @param suite The cipher suite, for example SUITE_AES_GCM.
+   * @param mode Cipher.ENCRYPT_MODE or Cipher.DECRYPT_MODE.
+   * @param key The key returned in CipherInfo by createCiphers().
+   * @param iv The initialization vector, getIvLength(suite) bytes long.
+   * @return The initialized cipher, or null if it could not be created,
+   *     for example because no installed provider supports the suite.
+   */
+  public static Cipher createCipher(int suite, int mode, SecretKey key,
+                                    byte[] iv) {
+    Cipher cipher = null;
+
+    try {
+      switch (suite) {
+        case SUITE_AES_CBC:
+          cipher = Cipher.getInstance(CIPHER_FACTORY);
+          cipher.init(mode, key, new IvParameterSpec(iv));
+          break;
+        case SUITE_AES_GCM:
+          cipher = Cipher.getInstance(CIPHER_FACTORY_GCM);
+          cipher.init(mode, key, new GCMParameterSpec(TAG_BITS, iv));
+          break;
+        case SUITE_CHACHA20_POLY1305:
+          cipher = Cipher.getInstance(CIPHER_FACTORY_CHACHA20);
+          cipher.init(mode, new SecretKeySpec(key.getEncoded(),
+                                              KEY_FACTORY_CHACHA20),
+                      new IvParameterSpec(iv));
+          break;
+        default:
+          Log.d(LOG_TAG, "createCipher: unknown suite " + suite);
+          break;
+      }
+    } catch (Exception ex) {
+      Log.d(LOG_TAG, "createCipher", ex);
+      cipher = null;
+    }
+
+    return cipher;
+  }
+
+  /**
+   * Picks the fastest cipher suite on this device, by timing each suite
+   * the installed providers support on the same data.  AES-GCM implemented
+   * with hardware AES instructions is usually much faster than AES-CBC,
+   * whose decryption also needs a separate pass to detect a wrong key.
+   * Suites that cannot be created or do not decrypt what they encrypted are
+   * skipped.
+   *
+   * This takes a few tens of milliseconds, so it is only done when a new key
+   * is created, see createCiphers().
+   *
+   * @return The id of the fastest suite, SUITE_AES_CBC if none works.
+   */
+  public static int selectCipherSuite() {
+    byte[] data = new byte[SUITE_BENCHMARK_SIZE];
+    new SecureRandom().nextBytes(data);
+    byte[] raw = new byte[32];
+    new SecureRandom().nextBytes(raw);
+    SecretKeySpec spec = new SecretKeySpec(raw, KEY_FACTORY);
+
+    int best = SUITE_AES_CBC;
+    long bestTime = Long.MAX_VALUE;
+    for (int candidate : SUITES) {
+      long time = timeCipherSuite(candidate, spec, data);
+      Log.d(LOG_TAG, "Cipher suite " + candidate + " time (ns): " + time);
+      if (time >= 0 && time < bestTime) {
+        best = candidate;
+        bestTime = time;
+      }
+    }
+    return best;
+  }
+
+  /**
+   * Returns the best time in nanosecs to encrypt and decrypt the data with
+   * the given suite, or -1 if the suite does not work on this device.
+   */
+  private static long timeCipherSuite(int suite, SecretKey key, byte[] data) {
+    long best = -1;
+    try {
+      for (int run = 0; run <= SUITE_BENCHMARK_RUNS; ++run) {
+        long start = System.nanoTime();
+        byte[] iv = createIv(suite);
+        Cipher cipher = createCipher(suite, Cipher.ENCRYPT_MODE, key, iv);
+        if (null == cipher)
+          return -1;
+        byte[] encrypted = cipher.doFinal(data);
+        cipher = createCipher(suite, Cipher.DECRYPT_MODE, key, iv);
+        if (null == cipher)
+          return -1;
+        byte[] decrypted = cipher.doFinal(encrypted);
+        long time = System.nanoTime() - start;
+        if (!MessageDigest.isEqual(data, decrypted))
+          return -1;
+
+        // The first run is a warm up, and is not timed.
+        if (run > 0 && (best < 0 || time < best))
+          best = time;
+      }
+    } catch (Exception ex) {
+      Log.d(LOG_TAG, "timeCipherSuite " + suite, ex);
+      return -1;
+    }
+    return best;
+  }
+
+  /**
+   * Computes the key check value of a key: an HMAC-SHA256 of a fixed label
+   * and the salt, keyed with the key, truncated to KEY_CHECK_LENGTH bytes.
+   * Stored in the header of a file, it tells right after the key is derived
+   * whether the password is right, without decrypting anything, and without
+   * revealing anything about the key.
+   *
+   * @param key The key returned in CipherInfo by createCiphers().
+   * @param salt The salt the key was derived with.
+   * @return The key check value, or null if it could not be computed.
+   */
+  public static byte[] createKeyCheck(SecretKey key, byte[] salt) {
+    try {
+      Mac mac = Mac.getInstance(KEY_CHECK_MAC);
+      mac.init(new SecretKeySpec(key.getEncoded(), KEY_CHECK_MAC));
+      mac.update(KEY_CHECK_LABEL);
+      mac.update(salt);
+      byte[] value = new byte[KEY_CHECK_LENGTH];
+      System.arraycopy(mac.doFinal(), 0, value, 0, KEY_CHECK_LENGTH);
+      return value;
+    } catch (Exception ex) {
+      Log.d(LOG_TAG, "createKeyCheck", ex);
+      return null;
+    }
+  }
+
+  /**
+   * Does the given key match a key check value returned by createKeyCheck()?
+   * The comparison takes the same time whatever the value.
+   */
+  public static boolean isKeyCheckValid(SecretKey key, byte[] salt,
+                                        byte[] keyCheck) {
+    byte[] expected = createKeyCheck(key, salt);
+    return null != expected && MessageDigest.isEqual(expected, keyCheck);
+  }
+
   /**
    * Create a decryption cipher using an old algorithm based on the given
    * password string.  The string is not stored internally.
@@ -233,9 +538,9 @@ public class SecurityUtils {
   }
 
   /**
-   * Create a pair of encryption and decryption ciphers based on the given
-   * password string.  The string is not stored internally.  This function
-   * needs to be called before calling getEncryptionCipher() or
+   * Create the key for encryption and decryption ciphers based on the given
+   * password string.  The string is not stored internally.  The result needs
+   * to be passed to saveCiphers() before calling getEncryptionCipher() or
    * getDecryptionCipher().
    *
    * @param password String to use for creating the ciphers.
@@ -246,128 +551,97 @@ public class SecurityUtils {
   public static CipherInfo createCiphers(String password,
                                          byte[] salt,
                                          int rounds) {
+    return createCiphers(password, salt, rounds, SUITE_AES_CBC);
+  }
+
+  /**
+   * Create the key for encryption and decryption ciphers based on the given
+   * password string, for the given cipher suite.  If salt is
+   * null, a new salt, number of rounds and cipher suite are chosen for this
+   * device.
+   *
+   * @param password String to use for creating the ciphers.
+   * @param salt The salt to use when creating the encryption key.
+   * @param rounds The number of rounds for bcrypt.
+   * @param suite The cipher suite of the binary file format.
+   * @return CipherInfo structure with information about the created ciphers.
+   */
+  public static CipherInfo createCiphers(String password,
+                                         byte[] salt,
+                                         int rounds,
+                                         int suite) {
+    return createCiphers(password, salt, rounds, suite, Kdf.DEFAULT);
+  }
+
+  /**
+   * Create the key for encryption and decryption ciphers based on the given
+   * password string, with the given key derivation function, for the given
+   * cipher suite.  If salt is null, a new salt and cipher suite are chosen
+   * for this device, and unless rounds is given, a new cost, the highest
+   * that derives the key within UNLOCK_TARGET_MS.  Calibrating the cost takes
+   * time, so callers should rather pass the cost from KdfCalibration.
+   *
+   * @param password String to use for creating the ciphers.
+   * @param salt The salt to use when creating the encryption key.
+   * @param rounds The cost of the key derivation function, see Kdf, or 0.
+   * @param suite The cipher suite of the binary file format.
+   * @param kdf The key derivation function.
+   * @return CipherInfo structure with information about the created ciphers.
+   */
+  public static CipherInfo createCiphers(String password,
+                                         byte[] salt,
+                                         int rounds,
+                                         int suite,
+                                         Kdf kdf) {
     CipherInfo info = new CipherInfo();
 
     ExecutionTimer timer = new ExecutionTimer();
     
     try {
-      // Append a null at the end of the password string to prevent multiple
-      // repetitions of the password from being valid.
-      password += '\000';
-
       if (salt == null || rounds == 0) {
         salt = createNewSalt();
-        rounds = determineBestRounds();
+        if (rounds < Kdf.MIN_COST)
+          rounds = kdf.calibrate(UNLOCK_TARGET_MS);
+        suite = selectCipherSuite();
       }
 
-      int plaintext[] = {0x155cbf8e, 0x57f57513, 0x3da787b9, 0x71679d82,
-                         0x7cf72e93, 0x1ae25274, 0x64b54adc, 0x335cbd0b};
-      BCrypt bcrypt = new BCrypt();
-      byte[] rawBytes = bcrypt.crypt_raw(password.getBytes(
-          StandardCharsets.UTF_8),
-                                         salt, rounds, plaintext);
+      byte[] rawBytes = kdf.deriveKey(password, salt, rounds);
       SecretKeySpec spec = new SecretKeySpec(rawBytes, KEY_FACTORY);
 
-      // For backwards compatibility with secrets create on Android M and
-      // earlier, create an initial vector of all zeros.
-      IvParameterSpec params = new IvParameterSpec(new byte[16]);
-
-      info.encryptCipher = Cipher.getInstance(CIPHER_FACTORY);
-      info.encryptCipher.init(Cipher.ENCRYPT_MODE, spec, params);
-
-      info.decryptCipher = Cipher.getInstance(CIPHER_FACTORY);
-      info.decryptCipher.init(Cipher.DECRYPT_MODE, spec, params);
+      // Make sure the key can be used before handing it out.
+      if (null == createZeroIvCipher(Cipher.ENCRYPT_MODE, spec))
+        throw new IllegalStateException("Cannot create cipher");
 
+      info.key = spec;
       info.salt = salt;
       info.rounds = rounds;
+      info.suite = suite;
+      info.kdf = kdf;
     } catch (Exception ex) {
       Log.d(LOG_TAG, "createCiphers", ex);
       info = null;
     }
 
-    timer.logElapsed("Time to create ciphers rounds=" + rounds + ": ");
+    timer.logElapsed("Time to create ciphers " + kdf + " rounds=" + rounds +
+                     ": ");
     return info;
   }
 
   /**
-   * Create a pair of encryption and decryption ciphers based on the given
-   * password string.  The string is not stored internally.  This function
-   * needs to be called before calling getEncryptionCipher() or
-   * getDecryptionCipher().
+   * Saves the key returned by createCiphers() as the current one.  This
+   * function needs to be called before calling getEncryptionCipher() or
+   * getDecryptionCipher().  Threads already using the previous key keep
+   * their own copy of it.
    *
    * @param info Information about ciphers to save in global variables.
-   *
-   * @return True if the ciphers were successfully created.
    */
   public static void saveCiphers(CipherInfo info) {
-    encryptCipher = info.encryptCipher;
-    decryptCipher = info.decryptCipher;
-    salt = info.salt.clone();
-    rounds = info.rounds;
+    saved = copyCipherInfo(info);
   }
 
   /** Clear the ciphers from memory. */
   public static void clearCiphers() {
-    decryptCipher = null;
-    encryptCipher = null;
-    salt = null;
-    rounds = 0;
-  }
-
-  /**
-   * Determines the ideal number of rounds to use for the bcrypt algorithm.
-   * More rounds are more secure, but require more time to log into Secrets.
-   * This function tries to balance security and convenience.
-   *
-   * Each round increment doubles the amount of work required by bcrypt to
-   * generate a key.  This function assumes that time is proportional to work.
-   * So for example, if 4 rounds takes 0.1 seconds to generate a key, 5 rounds
-   * will take 0.2 seconds, 6 rounds 0.4 seconds, and so on.  The assumption
-   * will be that the key must be generated in less than 0.9 seconds to remain
-   * convenient for the user.
-   *
-   * This function calculate how long it takes to generate a key using 4 rounds
-   * on the current device, then determines the maximum number of rounds such
-   * that the time to generate will remain below the convenience threshold. 
-   */
-  public static int determineBestRounds() {
-      byte[] salt = createNewSalt();
-      int plaintext[] = {0x155cbf8e, 0x57f57513, 0x3da787b9, 0x71679d82,
-                         0x7cf72e93, 0x1ae25274, 0x64b54adc, 0x335cbd0b};
-      final byte[] password = {1, 2, 3, 4, 5, 6, 7, 8};
-      BCrypt bcrypt = new BCrypt();
-
-      // Calculate the time to create a cipher key with 4 rounds, in msecs.
-      // Do it twice and take the average.
-      final long start = System.currentTimeMillis();
-      bcrypt.crypt_raw(password, salt, 4, plaintext);
-      bcrypt.crypt_raw(password, salt, 4, plaintext);
-      final long T4 = (System.currentTimeMillis() - start) / 2;
-
-      // If T4 is the time in msecs to create the key with 4 rounds, then
-      // the time Tn to calculate the key using n rounds (n > 4) is:
-      //
-      //   Tn = 2^(n - 4) * T4
-      //
-      // where we want Tn to be less than 900 msecs.  Solving for n gives:
-      //
-      //   Tn = 2^(n - 4) * T4 < 900
-      //   n - 4 + log2(T4) < log2(900)
-      //   n < 4 + log2(900) - log2(T4)          -- solve for n
-      //   n < 4 + ln(900)/ln(2) - ln(T4)/ln(2)  -- convert to natural logs 
-      //
-      // The best number of rounds is the floor of n.
-      final double n = 4 + (Math.log(900) - Math.log(T4)) / Math.log(2);
-      int rounds = (int) n;
-
-      // Make sure rounds does not exceed its valid range.
-      if (rounds < 4) {
-        rounds = 4;
-      } else if (rounds > 31) {
-        rounds = 31;
-      }
-
-      return rounds;
+    saved = null;
   }
 
   /*public static void test_behaviour() {
@@ -0,0 +1,171 @@
+// Copyright (c) 2009, Google Inc.
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//      http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+
+package net.tawacentral.roger.secrets;
+
+import java.io.File;
+import java.util.ArrayList;
+import java.util.IdentityHashMap;
+import java.util.List;
+
+import javax.crypto.SecretKey;
+
+/**
+ * In memory description of the segments of a segmented vault file, as it was
+ * last read or written.
+ *
+ * Each segment remembers which Secret objects it holds and their revisions at
+ * the time they were encrypted, as well as where its frame lives in the file.
+ * When saving, a segment that holds exactly the same unmodified secrets can
+ * be copied from the existing file as is, instead of being serialized and
+ * encrypted again.
+ *
+ * The index is only valid for the file it was built from, and only as long as
+ * that file has not been touched by anyone else, so the length and modification
+ * time of the file are checked before it is used.
+ */
+class SegmentIndex {
+  /** One encrypted segment of the vault file. */
+  static class Segment {
+    /** The secrets in the segment, in file order. */
+    final Secret[] secrets;
+    /** The revision of each secret when the segment was encrypted. */
+    final int[] revisions;
+    /** Offset of the segment's frame from the start of the file. */
+    final long offset;
+    /** Length of the whole frame, including its kind and length prefix. */
+    final int length;
+    /** Digest of the frame payload, as stored in the index frame. */
+    final byte[] digest;
+    /**
+     * Digest of the decrypted frame data, which unlike the payload does not
+     * depend on the IV.  Only kept in memory.
+     */
+    final byte[] contentDigest;
+
+    Segment(List<Secret> secrets, int[] revisions, long offset, int length,
+            byte[] digest, byte[] contentDigest) {
+      this.secrets = secrets.toArray(new Secret[secrets.size()]);
+      this.revisions = revisions;
+      this.offset = offset;
+      this.length = length;
+      this.digest = digest;
+      this.contentDigest = contentDigest;
+    }
+
+    /**
+     * Does this segment hold exactly the given secrets, none of which have
+     * been modified since the segment was encrypted?
+     */
+    boolean isUnchanged(List<Secret> list) {
+      if (list.size() != secrets.length)
+        return false;
+
+      for (int i = 0; i < secrets.length; ++i) {
+        Secret secret = list.get(i);
+        if (secret != secrets[i] || secret.getRevision() != revisions[i])
+          return false;
+      }
+
+      return true;
+    }
+  }
+
+  private final String path;
+  private final SecretKey key;
+  private final ArrayList<Segment> segments = new ArrayList<Segment>();
+  private final IdentityHashMap<Secret, Segment> byFirstSecret =
+      new IdentityHashMap<Secret, Segment>();
+  private long fileLength = -1;
+  private long lastModified = -1;
+  private long baseId;
+  private int flags;
+
+  /**
+   * Creates an empty index.
+   *
+   * @param file The vault file described by this index.
+   * @param key The key used to encrypt the segments.
+   */
+  SegmentIndex(File file, SecretKey key) {
+    this.path = file.getAbsolutePath();
+    this.key = key;
+  }
+
+  /** Adds a segment to the end of the index. */
+  void add(Segment segment) {
+    segments.add(segment);
+    if (segment.secrets.length > 0)
+      byFirstSecret.put(segment.secrets[0], segment);
+  }
+
+  /**
+   * Returns the random identifier written in the file's index frame, which
+   * changes every time the file is written.  Zero if the file has none.
+   */
+  long getBaseId() {
+    return baseId;
+  }
+
+  /** Sets the identifier read from or written to the index frame. */
+  void setBaseId(long baseId) {
+    this.baseId = baseId;
+  }
+
+  /** Returns the header flags of the file, which apply to all frames. */
+  int getFlags() {
+    return flags;
+  }
+
+  /** Sets the header flags of the file. */
+  void setFlags(int flags) {
+    this.flags = flags;
+  }
+
+  /** Returns the key used to encrypt the segments. */
+  SecretKey getKey() {
+    return key;
+  }
+
+  /** Returns the segments, in file order. */
+  List<Segment> getSegments() {
+    return segments;
+  }
+
+  /**
+   * Records the length and modification time of the file once it has been
+   * completely written or read.
+   */
+  void setFileState(File file) {
+    fileLength = file.length();
+    lastModified = file.lastModified();
+  }
+
+  /**
+   * Can this index be used to copy segments out of the given file, when
+   * saving with the given key?
+   */
+  boolean isValidFor(File file, SecretKey key) {
+    return path.equals(file.getAbsolutePath()) && this.key.equals(key) &&
+        file.length() == fileLength && file.lastModified() == lastModified;
+  }
+
+  /**
+   * Finds the segment that starts with the given secret, if any.  The caller
+   * still needs to check whether it is unchanged.
+   */
+  Segment findSegment(Secret first) {
+    return byFirstSecret.get(first);
+  }
+}
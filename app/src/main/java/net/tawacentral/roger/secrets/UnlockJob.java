@@ -0,0 +1,238 @@
+// Copyright (c) 2009, Google Inc.
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//      http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+
+package net.tawacentral.roger.secrets;
+
+import java.io.File;
+import java.util.ArrayList;
+import java.util.Collections;
+import java.util.concurrent.ExecutorService;
+import java.util.concurrent.Executors;
+
+import android.content.Context;
+import android.os.SystemClock;
+import android.util.Log;
+
+/**
+ * Derives the key from the password and loads the secrets with it, or on
+ * first run saves an empty secrets file, on a worker thread.  Deriving the
+ * key takes about a second by design, and decrypting a large file takes
+ * more, so doing this on the main thread would freeze the login screen.
+ *
+ * The key is saved with SecurityUtils.saveCiphers() as soon as it is known
+ * to be right, since loading the secrets file needs it.  The secrets are
+ * only handed out through the listener, on the main thread, see
+ * BackgroundJob, so that the activity current when the job finishes gets
+ * them even if the one that started the job was destroyed.
+ *
+ * A cancelled job finishes without secrets and leaves no key saved.
+ * Deriving the key cannot be interrupted, so the job only stops once the
+ * key is derived.  Once the first secrets file is saved, the file stays.
+ *
+ * All the methods must be called on the main thread.
+ */
+public class UnlockJob extends BackgroundJob<UnlockJob.Listener> {
+  /** Stage of a job deriving the key from the password. */
+  public static final int STAGE_DERIVING_KEY = 0;
+  /** Stage of a job loading or creating the secrets file. */
+  public static final int STAGE_LOADING = 1;
+
+  /** Tag for logging purposes. */
+  public static final String LOG_TAG = "UnlockJob";
+
+  /** Receives the progress and the result of a job, on the main thread. */
+  public interface Listener {
+    /** Reports that the job reached the given stage. */
+    void onProgress(UnlockJob job, int stage);
+
+    /**
+     * Reports that the job is done.  Called once per job.  If getSecrets()
+     * is null, the job failed or was cancelled.
+     */
+    void onFinished(UnlockJob job);
+  }
+
+  private static final ExecutorService worker =
+      Executors.newSingleThreadExecutor();
+
+  private final Context context;
+  private final boolean isFirstRun;
+  private String password;  // Only used on the worker thread.
+
+  // Set by run() before finish().
+  private ArrayList<Secret> secrets;
+  private boolean current;
+  private int error;
+
+  // Only used on the main thread.
+  private int stage = STAGE_DERIVING_KEY;
+
+  private UnlockJob(Context context, String password, boolean isFirstRun,
+                    Listener listener) {
+    super(listener);
+    this.context = context;
+    this.password = password;
+    this.isFirstRun = isFirstRun;
+  }
+
+  /**
+   * Starts unlocking the secrets with the given password.
+   *
+   * @param context The activity starting the job.
+   * @param password The password entered by the user.
+   * @param isFirstRun True to create a new secrets file with the password,
+   *     false to load the existing one.
+   * @param listener Receives the progress and the result, or null.
+   * @return The job, which can be cancelled.
+   */
+  public static UnlockJob start(Context context, String password,
+                                boolean isFirstRun, Listener listener) {
+    UnlockJob job = new UnlockJob(context.getApplicationContext(), password,
+                                  isFirstRun, listener);
+    job.execute(worker);
+    return job;
+  }
+
+  /** Unlocks the secrets, on the worker thread. */
+  @Override
+  protected void run() {
+    long start = SystemClock.uptimeMillis();
+    ArrayList<Secret> loaded = null;
+    boolean loadedCurrent = false;
+    int message = R.string.invalid_password;
+    boolean keySaved = false;
+
+    // The secrets file stays open so that its body is read from the same
+    // handle once the key is derived.
+    VaultFile vault = isFirstRun
+        ? null : FileUtils.openVault(context, FileUtils.SECRETS_FILE_NAME);
+    try {
+      FileUtils.SaltAndRounds pair = null == vault
+          ? new FileUtils.SaltAndRounds(null, 0) : vault.getSaltAndRounds();
+      // A new key gets the cost calibrated for this device, which is usually
+      // done by the time the user entered their password twice.
+      int rounds = null == pair.salt
+          ? KdfCalibration.getCost(context, pair.kdf) : pair.rounds;
+      SecurityUtils.CipherInfo info = isCancelled() ? null
+          : SecurityUtils.createCiphers(password, pair.salt, rounds,
+                                        pair.suite, pair.kdf);
+
+      // A key whose cost was chosen on a device with more memory may not be
+      // derivable here, which is not a wrong password.
+      if (null == info && pair.kdf.exceedsMemory(rounds))
+        message = R.string.error_kdf_memory;
+
+      // Files with a key check value in their header tell right away whether
+      // the password is wrong, without decrypting anything.
+      if (null == info || isCancelled() || !FileUtils.checkKey(pair, info))
+        return;
+      SecurityUtils.saveCiphers(info);
+      keySaved = true;
+      postStage(STAGE_LOADING);
+
+      long generation = ChangeTracker.getGeneration();
+      if (isFirstRun) {
+        // Immediately save an empty file to hold the secrets.
+        File file = context.getFileStreamPath(FileUtils.SECRETS_FILE_NAME);
+        ArrayList<Secret> empty = new ArrayList<Secret>();
+        int err = FileUtils.saveSecrets(context, file, info, empty);
+        if (0 != err) {
+          message = err;
+          return;
+        }
+        loaded = empty;
+        loadedCurrent = true;
+      } else {
+        loaded = FileUtils.loadSecrets(context, vault);
+        // Secrets from older formats, or upgraded while loading, need a save.
+        loadedCurrent = null != loaded &&
+            generation == ChangeTracker.getGeneration();
+        if (null == loaded && !isCancelled()) {
+          // Loading failed.  The file may be in an older format, which its
+          // header tells, otherwise the password is wrong.
+          loaded = FileUtils.loadLegacySecrets(context,
+              FileUtils.SECRETS_FILE_NAME, pair, info, password);
+
+          // previous versions were case-sensitive and may need to be sorted
+          if (null != loaded)
+            Collections.sort(loaded);
+        }
+      }
+      message = 0;
+    } finally {
+      if (null != vault)
+        vault.close();
+      password = null;
+
+      if (isCancelled() || null == loaded) {
+        loaded = null;
+        if (keySaved)
+          SecurityUtils.clearCiphers();
+      }
+      Log.d(LOG_TAG, "UnlockJob.run: success=" + (null != loaded) +
+            " cancelled=" + isCancelled() +
+            " time=" + (SystemClock.uptimeMillis() - start));
+
+      secrets = loaded;
+      current = loadedCurrent;
+      error = null != loaded ? 0
+          : 0 == message ? R.string.invalid_password : message;
+      finish();
+    }
+  }
+
+  /** Tells the listener the job reached the given stage. */
+  private void postStage(final int stage) {
+    postProgress(new Runnable() {
+      @Override
+      public void run() {
+        UnlockJob.this.stage = stage;
+        Listener listener = getListener();
+        if (null != listener)
+          listener.onProgress(UnlockJob.this, stage);
+      }
+    });
+  }
+
+  @Override
+  protected void onFinished(Listener listener) {
+    listener.onFinished(this);
+  }
+
+  /** Returns the current stage of the job, for example STAGE_LOADING. */
+  public int getStage() {
+    return stage;
+  }
+
+  /** Returns the secrets unlocked, or null if the job failed. */
+  public ArrayList<Secret> getSecrets() {
+    return secrets;
+  }
+
+  /**
+   * Are the secrets returned by getSecrets() the same as in the secrets
+   * file, so that they do not need to be saved?
+   */
+  public boolean isCurrent() {
+    return current;
+  }
+
+  /**
+   * Returns the resource id of the message explaining why the job failed,
+   * or 0 if it succeeded or was cancelled.
+   */
+  public int getError() {
+    return isCancelled() ? 0 : error;
+  }
+}
@@ -0,0 +1,199 @@
+// Copyright (c) 2009, Google Inc.
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//      http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+
+package net.tawacentral.roger.secrets;
+
+import java.io.BufferedInputStream;
+import java.io.Closeable;
+import java.io.EOFException;
+import java.io.File;
+import java.io.FileInputStream;
+import java.io.IOException;
+import java.io.InputStream;
+import java.nio.MappedByteBuffer;
+import java.nio.channels.FileChannel;
+import java.util.HashMap;
+
+import net.tawacentral.roger.secrets.FileUtils.SaltAndRounds;
+
+/**
+ * A secrets file or restore point opened for reading, whose header has been
+ * parsed.
+ *
+ * Unlocking needs the salt and rounds from the header before the key can be
+ * derived, and then the body of the same file.  A VaultFile reads the header
+ * once and keeps the stream positioned after it for the decoder, so the file
+ * is only opened once.  Headers are also cached by path, length and
+ * modification time, so that trying another password neither opens nor
+ * parses the file again until its body is needed.
+ *
+ * Use FileUtils.openVault() to get one, and close it when done.
+ */
+public class VaultFile implements Closeable {
+  /** Number of headers kept in the cache. */
+  private static final int MAX_CACHED_HEADERS = 16;
+
+  /** Header of a file, as of the given length and modification time. */
+  private static class Header {
+    final long length;
+    final long lastModified;
+    final SaltAndRounds pair;
+
+    Header(long length, long lastModified, SaltAndRounds pair) {
+      this.length = length;
+      this.lastModified = lastModified;
+      this.pair = pair;
+    }
+  }
+
+  /** Cached headers, keyed by absolute path.  Guarded by itself. */
+  private static final HashMap<String, Header> headers =
+      new HashMap<String, Header>();
+
+  private final File file;
+  private final Header header;
+  private FileInputStream input;
+  private InputStream body;
+  private boolean bodyTaken;
+
+  private VaultFile(File file, Header header, FileInputStream input,
+                    InputStream body) {
+    this.file = file;
+    this.header = header;
+    this.input = input;
+    this.body = body;
+  }
+
+  /**
+   * Opens the given file and parses its header, unless the header of the
+   * file as it is now is already cached, in which case the file is only
+   * opened when its body is needed.
+   *
+   * @throws IOException if the file does not exist or cannot be read.
+   */
+  static VaultFile open(File file) throws IOException {
+    String path = file.getAbsolutePath();
+    long length = file.length();
+    long lastModified = file.lastModified();
+    synchronized (headers) {
+      Header header = headers.get(path);
+      if (null != header && header.length == length &&
+          header.lastModified == lastModified) {
+        return new VaultFile(file, header, null, null);
+      }
+    }
+
+    FileInputStream input = new FileInputStream(file);
+    try {
+      InputStream body = new BufferedInputStream(input);
+      Header header = new Header(length, lastModified,
+                                 FileUtils.getSaltAndRounds(body));
+      synchronized (headers) {
+        if (headers.size() >= MAX_CACHED_HEADERS)
+          headers.clear();
+        headers.put(path, header);
+      }
+      VaultFile vault = new VaultFile(file, header, input, body);
+      input = null;
+      return vault;
+    } finally {
+      try {if (null != input) input.close();} catch (IOException ex) {}
+    }
+  }
+
+  /** Forgets all cached headers, after files were rewritten or replaced. */
+  static void clearCache() {
+    synchronized (headers) {
+      headers.clear();
+    }
+  }
+
+  /**
+   * Is the file still the one whose header was parsed, according to its
+   * length and modification time?
+   */
+  boolean isCurrent() {
+    return file.length() == header.length &&
+        file.lastModified() == header.lastModified;
+  }
+
+  /** Returns the file. */
+  public File getFile() {
+    return file;
+  }
+
+  /**
+   * Returns the salt, rounds, version and flags from the header.  The
+   * returned object must not be modified.
+   */
+  public SaltAndRounds getSaltAndRounds() {
+    return header.pair;
+  }
+
+  /**
+   * Returns a stream positioned right after the header, opening the file if
+   * needed.  The body can only be read once.  The stream is closed by
+   * close(), if the decoder did not close it already.
+   *
+   * @throws IOException if the file cannot be read, or the body was already
+   *     read.
+   */
+  InputStream openBody() throws IOException {
+    if (bodyTaken)
+      throw new IOException("Body already read");
+    bodyTaken = true;
+
+    if (null == body) {
+      input = new FileInputStream(file);
+      body = new BufferedInputStream(input);
+      long remaining = header.pair.headerLength;
+      while (remaining > 0) {
+        long skipped = body.skip(remaining);
+        if (skipped <= 0)
+          throw new EOFException("Truncated header");
+        remaining -= skipped;
+      }
+    }
+    return body;
+  }
+
+  /**
+   * Maps the whole file in memory, header included, through the same file
+   * handle the header was read from, if any.  This takes the place of
+   * openBody().  The mapping stays valid after close().
+   *
+   * @throws IOException if the file cannot be mapped, or the body was
+   *     already read.
+   */
+  MappedByteBuffer map() throws IOException {
+    if (bodyTaken)
+      throw new IOException("Body already read");
+    bodyTaken = true;
+
+    if (null == input) {
+      input = new FileInputStream(file);
+      body = input;
+    }
+    FileChannel channel = input.getChannel();
+    return channel.map(FileChannel.MapMode.READ_ONLY, 0, channel.size());
+  }
+
+  @Override
+  public void close() {
+    try {if (null != body) body.close();} catch (IOException ex) {}
+    try {if (null != input) input.close();} catch (IOException ex) {}
+    body = null;
+    input = null;
+  }
+}
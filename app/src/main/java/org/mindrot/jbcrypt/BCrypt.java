@@ -68,17 +68,18 @@ public class BCrypt {
   public static final int BCRYPT_SALT_LEN = 16;
 
   // Blowfish parameters
-  private static final int BLOWFISH_NUM_ROUNDS = 16;
+  static final int BLOWFISH_NUM_ROUNDS = 16;
 
-  // Initial contents of key schedule
-  private static final int P_orig[] = {
+  // Initial contents of key schedule.  Package-private, like the bcrypt
+  // IV below, for the reference implementation in the tests.
+  static final int P_orig[] = {
     0x243f6a88, 0x85a308d3, 0x13198a2e, 0x03707344,
     0xa4093822, 0x299f31d0, 0x082efa98, 0xec4e6c89,
     0x452821e6, 0x38d01377, 0xbe5466cf, 0x34e90c6c,
     0xc0ac29b7, 0xc97c50dd, 0x3f84d5b5, 0xb5470917,
     0x9216d5d9, 0x8979fb1b
   };
-  private static final int S_orig[] = {
+  static final int S_orig[] = {
     0xd1310ba6, 0x98dfb5ac, 0x2ffd72db, 0xd01adfb7,
     0xb8e1afed, 0x6a267e96, 0xba7c9045, 0xf12c7f99,
     0x24a19947, 0xb3916cf7, 0x0801f2e2, 0x858efc16,
@@ -340,7 +341,7 @@ public class BCrypt {
   // bcrypt IV: "OrpheanBeholderScryDoubt". The C implementation calls
   // this "ciphertext", but it is really plaintext or an IV. We keep
   // the name to make code comparison easier.
-  static private final int bf_crypt_ciphertext[] = {
+  static final int bf_crypt_ciphertext[] = {
     0x4f727068, 0x65616e42, 0x65686f6c,
     0x64657253, 0x63727944, 0x6f756274
   };
@@ -372,10 +373,6 @@ public class BCrypt {
     51, 52, 53, -1, -1, -1, -1, -1
   };
 
-  // Expanded Blowfish key
-  private int P[];
-  private int S[];
-
   /**
    * Encode a byte array using bcrypt's slightly-modified base64
    * encoding scheme. Note that this is *not* compatible with
@@ -481,35 +478,6 @@ public class BCrypt {
     return ret;
   }
 
-  /**
-   * Blowfish encipher a single 64-bit block encoded as
-   * two 32-bit halves
-   * @param lr  an array containing the two 32-bit half blocks
-   * @param off the position in the array of the blocks
-   */
-  private void encipher(int lr[], int off) {
-    int i, n, l = lr[off], r = lr[off + 1];
-
-    l ^= P[0];
-    for (i = 0; i <= BLOWFISH_NUM_ROUNDS - 2;) {
-      // Feistel substitution on left word
-      n = S[(l >> 24) & 0xff];
-      n += S[0x100 | ((l >> 16) & 0xff)];
-      n ^= S[0x200 | ((l >> 8) & 0xff)];
-      n += S[0x300 | (l & 0xff)];
-      r ^= n ^ P[++i];
-
-      // Feistel substitution on right word
-      n = S[(r >> 24) & 0xff];
-      n += S[0x100 | ((r >> 16) & 0xff)];
-      n ^= S[0x200 | ((r >> 8) & 0xff)];
-      n += S[0x300 | (r & 0xff)];
-      l ^= n ^ P[++i];
-    }
-    lr[off] = r ^ P[BLOWFISH_NUM_ROUNDS + 1];
-    lr[off + 1] = l;
-  }
-
   /**
    * Cycically extract a word of key material
    * @param data  the string to extract the data from
@@ -517,7 +485,7 @@ public class BCrypt {
    * current offset into data
    * @return  the next word of material from data
    */
-  private static int streamtoword(byte data[], int offp[]) {
+  static int streamtoword(byte data[], int offp[]) {
     int i;
     int word = 0;
     int off = offp[0];
@@ -532,75 +500,138 @@ public class BCrypt {
   }
 
   /**
-   * Initialise the Blowfish key schedule
+   * Blowfish encipher a single 64-bit block with the given key
+   * schedule, with the 16 rounds unrolled and everything in locals
+   * @param P the P-array of the key schedule
+   * @param S the four S-boxes of the key schedule, one after the other
+   * @param l the left half of the block
+   * @param r the right half of the block
+   * @return  the enciphered block, left half in the high 32 bits
    */
-  private void init_key() {
-    P = (int[])P_orig.clone();
-    S = (int[])S_orig.clone();
+  private static long encipher(int P[], int S[], int l, int r) {
+    l ^= P[0];
+    r ^= F(S, l) ^ P[1];
+    l ^= F(S, r) ^ P[2];
+    r ^= F(S, l) ^ P[3];
+    l ^= F(S, r) ^ P[4];
+    r ^= F(S, l) ^ P[5];
+    l ^= F(S, r) ^ P[6];
+    r ^= F(S, l) ^ P[7];
+    l ^= F(S, r) ^ P[8];
+    r ^= F(S, l) ^ P[9];
+    l ^= F(S, r) ^ P[10];
+    r ^= F(S, l) ^ P[11];
+    l ^= F(S, r) ^ P[12];
+    r ^= F(S, l) ^ P[13];
+    l ^= F(S, r) ^ P[14];
+    r ^= F(S, l) ^ P[15];
+    l ^= F(S, r) ^ P[16];
+    r ^= P[BLOWFISH_NUM_ROUNDS + 1];
+    return ((long)r << 32) | (l & 0xffffffffL);
   }
 
   /**
-   * Key the Blowfish cipher
-   * @param key an array containing the key
+   * The Blowfish Feistel function
+   * @param S the four S-boxes of the key schedule
+   * @param x the word to substitute
+   * @return  the substituted word
    */
-  private void key(byte key[]) {
-    int i;
-    int koffp[] = { 0 };
-    int lr[] = { 0, 0 };
+  private static int F(int S[], int x) {
+    return ((S[x >>> 24] + S[0x100 | ((x >>> 16) & 0xff)]) ^
+        S[0x200 | ((x >>> 8) & 0xff)]) + S[0x300 | (x & 0xff)];
+  }
+
+  /**
+   * Cyclically extract words of key material once, so that the key
+   * schedule does not have to stream the bytes again
+   * @param data  the bytes to extract the words from
+   * @param count the number of words to extract
+   * @return  the words, as streamtoword would return them one by one
+   */
+  private static int[] streamtowords(byte data[], int count) {
+    int words[] = new int[count];
+    int offp[] = { 0 };
+
+    for (int i = 0; i < count; i++)
+      words[i] = streamtoword(data, offp);
+    return words;
+  }
+
+  /**
+   * Key the Blowfish cipher with pre-extracted key material, as key()
+   * does with the bytes of the key.  Allocates nothing.
+   * @param P the P-array of the key schedule
+   * @param S the S-boxes of the key schedule
+   * @param key the key material, one word per entry of P
+   */
+  private static void key(int P[], int S[], int key[]) {
     int plen = P.length, slen = S.length;
+    int l = 0, r = 0;
+    long lr;
 
-    for (i = 0; i < plen; i++)
-      P[i] = P[i] ^ streamtoword(key, koffp);
+    for (int i = 0; i < plen; i++)
+      P[i] ^= key[i];
 
-    for (i = 0; i < plen; i += 2) {
-      encipher(lr, 0);
-      P[i] = lr[0];
-      P[i + 1] = lr[1];
+    for (int i = 0; i < plen; i += 2) {
+      lr = encipher(P, S, l, r);
+      P[i] = l = (int)(lr >>> 32);
+      P[i + 1] = r = (int)lr;
     }
 
-    for (i = 0; i < slen; i += 2) {
-      encipher(lr, 0);
-      S[i] = lr[0];
-      S[i + 1] = lr[1];
+    for (int i = 0; i < slen; i += 2) {
+      lr = encipher(P, S, l, r);
+      S[i] = l = (int)(lr >>> 32);
+      S[i + 1] = r = (int)lr;
     }
   }
 
   /**
-   * Perform the "enhanced key schedule" step described by
-   * Provos and Mazieres in "A Future-Adaptable Password Scheme"
-   * http://www.openbsd.org/papers/bcrypt-paper.ps
-   * @param data  salt information
-   * @param key password information
+   * Perform the "enhanced key schedule" step with pre-extracted key
+   * material, as ekskey() does with the bytes of the salt and key
+   * @param P the P-array of the key schedule
+   * @param S the S-boxes of the key schedule
+   * @param data  salt material, one word per entry of P
+   * @param key password material, one word per entry of P
    */
-  private void ekskey(byte data[], byte key[]) {
-    int i;
-    int koffp[] = { 0 }, doffp[] = { 0 };
-    int lr[] = { 0, 0 };
+  private static void ekskey(int P[], int S[], int data[], int key[]) {
     int plen = P.length, slen = S.length;
-
-    for (i = 0; i < plen; i++)
-      P[i] = P[i] ^ streamtoword(key, koffp);
-
-    for (i = 0; i < plen; i += 2) {
-      lr[0] ^= streamtoword(data, doffp);
-      lr[1] ^= streamtoword(data, doffp);
-      encipher(lr, 0);
-      P[i] = lr[0];
-      P[i + 1] = lr[1];
+    int l = 0, r = 0, d = 0;
+    int dlen = BCRYPT_SALT_LEN / 4;
+    long lr;
+
+    for (int i = 0; i < plen; i++)
+      P[i] ^= key[i];
+
+    // The salt is four words long, so its material repeats every four
+    // words.
+    for (int i = 0; i < plen; i += 2) {
+      l ^= data[d];
+      r ^= data[d + 1];
+      d = (d + 2) % dlen;
+      lr = encipher(P, S, l, r);
+      P[i] = l = (int)(lr >>> 32);
+      P[i + 1] = r = (int)lr;
     }
 
-    for (i = 0; i < slen; i += 2) {
-      lr[0] ^= streamtoword(data, doffp);
-      lr[1] ^= streamtoword(data, doffp);
-      encipher(lr, 0);
-      S[i] = lr[0];
-      S[i + 1] = lr[1];
+    for (int i = 0; i < slen; i += 2) {
+      l ^= data[d];
+      r ^= data[d + 1];
+      d = (d + 2) % dlen;
+      lr = encipher(P, S, l, r);
+      S[i] = l = (int)(lr >>> 32);
+      S[i + 1] = r = (int)lr;
     }
   }
 
   /**
    * Perform the central password hashing step in the
    * bcrypt scheme
+   * <p>
+   * The key schedule is kept in local arrays, the password and salt
+   * are extracted into words once rather than in every round, and
+   * nothing is allocated inside the expensive loop.  BCryptTest
+   * checks that the result is the same as with the original key
+   * schedule.
    * @param password  the password to hash
    * @param salt  the binary salt to hash with the password
    * @param log_rounds  the binary logarithm of the number
@@ -612,6 +643,7 @@ public class BCrypt {
     int rounds, i, j;
     int clen = cdata.length;
     byte ret[];
+    long lr;
 
     if (log_rounds < 4 || log_rounds > 31)
       throw new IllegalArgumentException ("Bad number of rounds");
@@ -619,16 +651,23 @@ public class BCrypt {
     if (salt.length != BCRYPT_SALT_LEN)
       throw new IllegalArgumentException ("Bad salt length");
 
-    init_key();
-    ekskey(salt, password);
+    int P[] = (int[])P_orig.clone();
+    int S[] = (int[])S_orig.clone();
+    int passwordw[] = streamtowords(password, P.length);
+    int saltw[] = streamtowords(salt, P.length);
+
+    ekskey(P, S, saltw, passwordw);
     for (i = 0; i < rounds; i++) {
-      key(password);
-      key(salt);
+      key(P, S, passwordw);
+      key(P, S, saltw);
     }
 
     for (i = 0; i < 64; i++) {
-      for (j = 0; j < (clen >> 1); j++)
-        encipher(cdata, j << 1);
+      for (j = 0; j < clen - 1; j += 2) {
+        lr = encipher(P, S, cdata[j], cdata[j + 1]);
+        cdata[j] = (int)(lr >>> 32);
+        cdata[j + 1] = (int)lr;
+      }
     }
 
     ret = new byte[clen * 4];
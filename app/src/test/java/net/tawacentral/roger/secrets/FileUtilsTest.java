@@ -0,0 +1,310 @@
+// Copyright (c) 2009, Google Inc.
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//      http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+
+package net.tawacentral.roger.secrets;
+
+import static org.junit.Assert.assertArrayEquals;
+import static org.junit.Assert.assertEquals;
+import static org.junit.Assert.assertFalse;
+import static org.junit.Assert.assertNotNull;
+import static org.junit.Assert.assertNull;
+import static org.junit.Assert.assertTrue;
+
+import java.io.ByteArrayInputStream;
+import java.io.ByteArrayOutputStream;
+import java.io.DataInputStream;
+import java.io.File;
+import java.io.FileInputStream;
+import java.io.FileOutputStream;
+import java.io.IOException;
+import java.io.RandomAccessFile;
+import java.util.ArrayList;
+import java.util.Arrays;
+import java.util.zip.Deflater;
+
+import org.junit.After;
+import org.junit.Before;
+import org.junit.Test;
+import org.junit.runner.RunWith;
+import org.robolectric.RobolectricTestRunner;
+import org.robolectric.RuntimeEnvironment;
+import org.robolectric.annotation.Config;
+
+import android.content.Context;
+
+import net.tawacentral.roger.secrets.SecurityUtils.CipherInfo;
+
+/**
+ * Round trips through the file formats: the segmented V5 file, the reuse of
+ * its segments by the next save, the journal, delta restore points, and
+ * reading the older V4 format.
+ */
+@RunWith(RobolectricTestRunner.class)
+@Config(sdk = 28)
+public class FileUtilsTest {
+  // Enough secrets for several segments.
+  private static final int VAULT_SIZE = 300;
+
+  private Context context;
+  private File file;
+  private CipherInfo info;
+
+  @Before
+  public void setUp() {
+    context = RuntimeEnvironment.application;
+    FileUtils.deleteSecrets(context);
+    file = context.getFileStreamPath(FileUtils.SECRETS_FILE_NAME);
+    info = createCiphers(SecurityUtils.SUITE_AES_CBC);
+    SecurityUtils.saveCiphers(info);
+  }
+
+  @After
+  public void tearDown() {
+    SecurityUtils.clearCiphers();
+    FileUtils.deleteSecrets(context);
+  }
+
+  /** Returns a key for the given suite, cheap to derive. */
+  private static CipherInfo createCiphers(int suite) {
+    byte[] salt = new byte[16];
+    Arrays.fill(salt, (byte) 7);
+    return SecurityUtils.createCiphers("password", salt, Kdf.MIN_COST, suite);
+  }
+
+  private static ArrayList<Secret> createSecrets(int count) {
+    ArrayList<Secret> secrets = new ArrayList<Secret>(count);
+    for (int i = 0; i < count; ++i) {
+      Secret secret = new Secret();
+      secret.setDescription("secret " + i);
+      secret.setUsername("user" + i);
+      secret.setPassword("password" + i, false);
+      secret.setEmail("user" + i + "@example.com");
+      secret.setNote("note " + i);
+      secrets.add(secret);
+    }
+    return secrets;
+  }
+
+  private static void assertSameSecrets(ArrayList<Secret> expected,
+                                        ArrayList<Secret> actual) {
+    assertNotNull(actual);
+    assertEquals(expected.size(), actual.size());
+    for (int i = 0; i < expected.size(); ++i) {
+      Secret a = expected.get(i);
+      Secret b = actual.get(i);
+      assertEquals(a.getDescription(), b.getDescription());
+      assertEquals(a.getUsername(), b.getUsername());
+      assertEquals(a.getPassword(false), b.getPassword(false));
+      assertEquals(a.getEmail(), b.getEmail());
+      assertEquals(a.getNote(), b.getNote());
+    }
+  }
+
+  private static byte[] readFile(File file) throws IOException {
+    byte[] data = new byte[(int) file.length()];
+    DataInputStream input = new DataInputStream(new FileInputStream(file));
+    try {
+      input.readFully(data);
+    } finally {
+      input.close();
+    }
+    return data;
+  }
+
+  /** Returns the first frame after the header of a V5 file. */
+  private static byte[] firstFrame(byte[] data) throws IOException {
+    FileUtils.SaltAndRounds pair =
+        FileUtils.getSaltAndRounds(new ByteArrayInputStream(data));
+    int offset = pair.headerLength + 1;
+    int length = 0;
+    for (int shift = 0; ; shift += 7) {
+      int b = data[offset++] & 0xff;
+      length |= (b & 0x7f) << shift;
+      if (0 == (b & 0x80))
+        break;
+    }
+    return Arrays.copyOfRange(data, pair.headerLength, offset + length);
+  }
+
+  private int save(ArrayList<Secret> secrets) {
+    return FileUtils.saveSecrets(context, file, info, secrets);
+  }
+
+  @Test
+  public void testWriteReadV5() throws IOException {
+    int[] suites = {SecurityUtils.SUITE_AES_CBC, SecurityUtils.SUITE_AES_GCM};
+    for (int suite : suites) {
+      CipherInfo suiteInfo = createCiphers(suite);
+      ArrayList<Secret> secrets = createSecrets(VAULT_SIZE);
+      ByteArrayOutputStream output = new ByteArrayOutputStream();
+      FileUtils.writeSecrets(output, suiteInfo, secrets);
+
+      byte[] data = output.toByteArray();
+      assertSameSecrets(secrets, FileUtils.readSecrets(
+          new ByteArrayInputStream(data), suiteInfo));
+
+      FileOutputStream fos = new FileOutputStream(file);
+      fos.write(data);
+      fos.close();
+      assertSameSecrets(secrets, FileUtils.readMappedSecrets(file, suiteInfo));
+    }
+  }
+
+  @Test
+  public void testWriteReadUncompressed() throws IOException {
+    ArrayList<Secret> secrets = createSecrets(VAULT_SIZE);
+    ByteArrayOutputStream output = new ByteArrayOutputStream();
+    FileUtils.setCompressionLevel(Deflater.NO_COMPRESSION);
+    try {
+      FileUtils.writeSecrets(output, info, secrets);
+    } finally {
+      FileUtils.setCompressionLevel(Deflater.DEFAULT_COMPRESSION);
+    }
+
+    assertSameSecrets(secrets, FileUtils.readSecrets(
+        new ByteArrayInputStream(output.toByteArray()), info));
+  }
+
+  @Test
+  public void testReadWithOtherSalt() throws IOException {
+    ByteArrayOutputStream output = new ByteArrayOutputStream();
+    FileUtils.writeSecrets(output, info, createSecrets(10));
+
+    CipherInfo other = SecurityUtils.createCiphers("password", new byte[16],
+                                                   Kdf.MIN_COST);
+    assertNull(FileUtils.readSecrets(
+        new ByteArrayInputStream(output.toByteArray()), other));
+  }
+
+  @Test
+  public void testSaveLoad() {
+    ArrayList<Secret> secrets = createSecrets(VAULT_SIZE);
+    assertEquals(0, save(secrets));
+    assertTrue(JournalStore.isEmpty(context));
+    assertSameSecrets(secrets, FileUtils.loadSecrets(context));
+  }
+
+  @Test
+  public void testSegmentReuse() throws IOException {
+    ArrayList<Secret> secrets = createSecrets(VAULT_SIZE);
+    assertEquals(0, save(secrets));
+    byte[] before = readFile(file);
+
+    // The last secret is not in the first segment, which is copied as is,
+    // random IV included.
+    secrets.get(VAULT_SIZE - 1).setNote("changed");
+    assertEquals(0, save(secrets));
+    byte[] after = readFile(file);
+    assertArrayEquals(firstFrame(before), firstFrame(after));
+    assertFalse(Arrays.equals(before, after));
+
+    assertSameSecrets(secrets, FileUtils.loadSecrets(context));
+  }
+
+  @Test
+  public void testJournalReplay() {
+    ArrayList<Secret> secrets = createSecrets(VAULT_SIZE);
+    assertEquals(0, save(secrets));
+    long length = file.length();
+
+    secrets.get(5).setNote("changed");
+    secrets.remove(7);
+    secrets.add(createSecrets(VAULT_SIZE + 1).get(VAULT_SIZE));
+    assertTrue(JournalStore.append(context, info, secrets));
+    assertFalse(JournalStore.isEmpty(context));
+    assertEquals(length, file.length());
+
+    assertSameSecrets(secrets, FileUtils.loadSecrets(context));
+  }
+
+  @Test
+  public void testJournalTruncated() throws IOException {
+    ArrayList<Secret> secrets = createSecrets(VAULT_SIZE);
+    assertEquals(0, save(secrets));
+
+    File journal = context.getFileStreamPath(FileUtils.JOURNAL_FILE_NAME);
+    secrets.get(1).setNote("first");
+    assertTrue(JournalStore.append(context, info, secrets));
+    long length = journal.length();
+    secrets.get(2).setNote("second");
+    assertTrue(JournalStore.append(context, info, secrets));
+
+    // A record cut short, as left by a crash, is dropped with what follows.
+    RandomAccessFile output = new RandomAccessFile(journal, "rw");
+    output.setLength(length + 5);
+    output.close();
+
+    ArrayList<Secret> loaded = FileUtils.loadSecrets(context);
+    assertNotNull(loaded);
+    assertEquals(VAULT_SIZE, loaded.size());
+    assertEquals("first", loaded.get(1).getNote());
+    assertEquals("note 2", loaded.get(2).getNote());
+    assertEquals(length, journal.length());
+  }
+
+  @Test
+  public void testDeltaRestorePoint() {
+    ArrayList<Secret> secrets = createSecrets(VAULT_SIZE);
+    Secret last = secrets.get(VAULT_SIZE - 1);
+    assertEquals(0, save(secrets));
+    last.setNote("two");
+    assertEquals(0, save(secrets));
+    last.setNote("three");
+    assertEquals(0, save(secrets));
+
+    // The first file became a full restore point, the second a delta of it.
+    String full = null;
+    String delta = null;
+    for (String name : FileUtils.getRestorePoints(context)) {
+      RestorePoint point = FileUtils.getRestorePoint(context, name);
+      if (null == point)
+        continue;
+      if (null == point.getBase())
+        full = name;
+      else
+        delta = name;
+    }
+    assertNotNull(full);
+    assertNotNull(delta);
+    assertEquals(full, FileUtils.getRestorePoint(context, delta).getBase());
+
+    ArrayList<Secret> loaded = FileUtils.loadSecrets(context, delta, info);
+    assertNotNull(loaded);
+    assertEquals(VAULT_SIZE, loaded.size());
+    assertEquals("two", loaded.get(VAULT_SIZE - 1).getNote());
+    assertEquals("note 0", loaded.get(0).getNote());
+
+    loaded = FileUtils.loadSecrets(context, full, info);
+    assertNotNull(loaded);
+    assertEquals("note " + (VAULT_SIZE - 1),
+                 loaded.get(VAULT_SIZE - 1).getNote());
+  }
+
+  @Test
+  public void testReadV4() throws IOException {
+    ArrayList<Secret> secrets = createSecrets(50);
+    FileOutputStream output = new FileOutputStream(file);
+    FileUtils.writeSecretsV4(output, info.createEncryptCipher(), info.salt,
+                             info.rounds, secrets);
+    output.close();
+
+    assertSameSecrets(secrets, FileUtils.loadSecrets(context));
+    // A V4 file has no journal, so the first save rewrites it as V5.
+    assertTrue(JournalStore.isFull(context));
+    assertFalse(JournalStore.append(context, info, secrets));
+    assertEquals(0, save(secrets));
+    assertEquals(5, FileUtils.getSaltAndRounds(context,
+        FileUtils.SECRETS_FILE_NAME).version);
+  }
+}
@@ -0,0 +1,124 @@
+// Copyright (c) 2009, Google Inc.
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//      http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+
+package net.tawacentral.roger.secrets;
+
+import static org.junit.Assert.assertArrayEquals;
+import static org.junit.Assert.assertEquals;
+import static org.junit.Assert.assertNull;
+import static org.junit.Assert.fail;
+
+import java.nio.charset.StandardCharsets;
+import java.security.GeneralSecurityException;
+
+import org.junit.Test;
+
+/**
+ * Checks the key derivation functions against published test vectors.  Keys
+ * are KEY_LENGTH bytes long, so longer vectors are compared on their first
+ * KEY_LENGTH bytes, which is the same since both scrypt and PBKDF2 compute
+ * the output in order.
+ */
+public class KdfTest {
+  /** Returns the bytes of a string, as deriveKey() encodes passwords. */
+  private static byte[] bytes(String s) {
+    return s.getBytes(StandardCharsets.UTF_8);
+  }
+
+  /** Decodes a hexadecimal string. */
+  private static byte[] hex(String s) {
+    byte[] b = new byte[s.length() / 2];
+    for (int i = 0; i < b.length; ++i)
+      b[i] = (byte) Integer.parseInt(s.substring(2 * i, 2 * i + 2), 16);
+    return b;
+  }
+
+  /** Returns scrypt with the given r and p. */
+  private static Kdf scrypt(int r, int p) {
+    return Kdf.decode(Kdf.SCRYPT, new byte[] {(byte) r, (byte) p});
+  }
+
+  @Test
+  public void testScryptRfc7914() throws GeneralSecurityException {
+    // RFC 7914, section 12.
+    assertArrayEquals(
+        hex("77d6576238657b203b19ca42c18a0497f16b4844e3074ae8dfdffa3fede21442"),
+        scrypt(1, 1).deriveKey("", new byte[0], 4));
+    assertArrayEquals(
+        hex("fdbabe1c9d3472007856e7190d01e9fe7c6ad7cbc8237830e77376634b373162"),
+        scrypt(8, 16).deriveKey("password", bytes("NaCl"), 10));
+    assertArrayEquals(
+        hex("7023bdcb3afd7348461c06cd81fd38ebfda8fbba904f8e3ea9b543f6545da1f2"),
+        scrypt(8, 1).deriveKey("pleaseletmein", bytes("SodiumChloride"), 14));
+  }
+
+  @Test
+  public void testPbkdf2Sha256() throws GeneralSecurityException {
+    Kdf kdf = Kdf.create(Kdf.PBKDF2_SHA256);
+    // 4096 iterations, the usual PBKDF2-HMAC-SHA256 vectors.
+    assertArrayEquals(
+        hex("c5e478d59288c841aa530db6845c4c8d962893a001ce4e11a4963873aa98134a"),
+        kdf.deriveKey("password", bytes("salt"), 12));
+    assertArrayEquals(
+        hex("348c89dbcbd32b2f32d814b8116e84cf2b17347ebc1800181c4e2a1fb8dd53e1"),
+        kdf.deriveKey("passwordPASSWORDpassword",
+                      bytes("saltSALTsaltSALTsaltSALTsaltSALTsalt"), 12));
+    assertArrayEquals(
+        hex("89b69d0516f829893c696226650a86878c029ac13ee276509d5ae58b6466a724"),
+        kdf.deriveKey("pass\000word", bytes("sa\000lt"), 12));
+    // An empty password, which the Mac does not take as a key.
+    assertArrayEquals(
+        hex("69218c6ff85818c2b08d0acf7a4008a462499977cd989182555201892c72449f"),
+        kdf.deriveKey("", bytes("salt"), 4));
+  }
+
+  @Test
+  public void testBcrypt() throws GeneralSecurityException {
+    byte[] salt = new byte[16];
+    for (int i = 0; i < salt.length; ++i)
+      salt[i] = (byte) i;
+    // Keys of existing files must not change.
+    assertArrayEquals(
+        hex("ca5ad60eb6180ff00baeedd28b6b8b37b3e3fd7d3a7742029ade816b4731c744"),
+        Kdf.DEFAULT.deriveKey("password", salt, 4));
+  }
+
+  @Test
+  public void testDecode() {
+    assertEquals(Kdf.DEFAULT, Kdf.decode(Kdf.BCRYPT, new byte[0]));
+    assertEquals(Kdf.create(Kdf.PBKDF2_SHA256),
+                 Kdf.decode(Kdf.PBKDF2_SHA256, new byte[0]));
+    assertArrayEquals(new byte[] {8, 1},
+                      Kdf.create(Kdf.SCRYPT).getParams());
+    assertNull(Kdf.decode(Kdf.BCRYPT, new byte[1]));
+    assertNull(Kdf.decode(Kdf.SCRYPT, new byte[] {0, 1}));
+    assertNull(Kdf.decode(Kdf.SCRYPT, new byte[] {33, 1}));
+    assertNull(Kdf.decode(Kdf.SCRYPT, new byte[] {8, 17}));
+    assertNull(Kdf.decode(Kdf.SCRYPT, new byte[] {8}));
+    assertNull(Kdf.decode(3, new byte[0]));
+  }
+
+  @Test
+  public void testInvalidCost() {
+    Kdf[] kdfs = {Kdf.DEFAULT, Kdf.create(Kdf.PBKDF2_SHA256),
+                  Kdf.create(Kdf.SCRYPT)};
+    for (Kdf kdf : kdfs) {
+      try {
+        kdf.deriveKey("password", new byte[16], Kdf.MIN_COST - 1);
+        fail("Cost below MIN_COST accepted by " + kdf);
+      } catch (GeneralSecurityException ex) {
+      }
+    }
+  }
+}
@@ -0,0 +1,166 @@
+// Copyright (c) 2006 Damien Miller <djm@mindrot.org>
+//
+// Permission to use, copy, modify, and distribute this software for any
+// purpose with or without fee is hereby granted, provided that the above
+// copyright notice and this permission notice appear in all copies.
+//
+// THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+// WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+// MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+// ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+// WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+// ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+// OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+package org.mindrot.jbcrypt;
+
+/**
+ * The original jBCrypt key schedule, kept in the tests to check the
+ * unrolled one in {@link BCrypt#crypt_raw} against.
+ */
+class BCryptReference {
+  // Expanded Blowfish key
+  private int P[];
+  private int S[];
+
+  /**
+   * Blowfish encipher a single 64-bit block encoded as
+   * two 32-bit halves
+   * @param lr  an array containing the two 32-bit half blocks
+   * @param off the position in the array of the blocks
+   */
+  private void encipher(int lr[], int off) {
+    int i, n, l = lr[off], r = lr[off + 1];
+
+    l ^= P[0];
+    for (i = 0; i <= BCrypt.BLOWFISH_NUM_ROUNDS - 2;) {
+      // Feistel substitution on left word
+      n = S[(l >> 24) & 0xff];
+      n += S[0x100 | ((l >> 16) & 0xff)];
+      n ^= S[0x200 | ((l >> 8) & 0xff)];
+      n += S[0x300 | (l & 0xff)];
+      r ^= n ^ P[++i];
+
+      // Feistel substitution on right word
+      n = S[(r >> 24) & 0xff];
+      n += S[0x100 | ((r >> 16) & 0xff)];
+      n ^= S[0x200 | ((r >> 8) & 0xff)];
+      n += S[0x300 | (r & 0xff)];
+      l ^= n ^ P[++i];
+    }
+    lr[off] = r ^ P[BCrypt.BLOWFISH_NUM_ROUNDS + 1];
+    lr[off + 1] = l;
+  }
+
+  /**
+   * Initialise the Blowfish key schedule
+   */
+  private void init_key() {
+    P = (int[])BCrypt.P_orig.clone();
+    S = (int[])BCrypt.S_orig.clone();
+  }
+
+  /**
+   * Key the Blowfish cipher
+   * @param key an array containing the key
+   */
+  private void key(byte key[]) {
+    int i;
+    int koffp[] = { 0 };
+    int lr[] = { 0, 0 };
+    int plen = P.length, slen = S.length;
+
+    for (i = 0; i < plen; i++)
+      P[i] = P[i] ^ BCrypt.streamtoword(key, koffp);
+
+    for (i = 0; i < plen; i += 2) {
+      encipher(lr, 0);
+      P[i] = lr[0];
+      P[i + 1] = lr[1];
+    }
+
+    for (i = 0; i < slen; i += 2) {
+      encipher(lr, 0);
+      S[i] = lr[0];
+      S[i + 1] = lr[1];
+    }
+  }
+
+  /**
+   * Perform the "enhanced key schedule" step described by
+   * Provos and Mazieres in "A Future-Adaptable Password Scheme"
+   * http://www.openbsd.org/papers/bcrypt-paper.ps
+   * @param data  salt information
+   * @param key password information
+   */
+  private void ekskey(byte data[], byte key[]) {
+    int i;
+    int koffp[] = { 0 }, doffp[] = { 0 };
+    int lr[] = { 0, 0 };
+    int plen = P.length, slen = S.length;
+
+    for (i = 0; i < plen; i++)
+      P[i] = P[i] ^ BCrypt.streamtoword(key, koffp);
+
+    for (i = 0; i < plen; i += 2) {
+      lr[0] ^= BCrypt.streamtoword(data, doffp);
+      lr[1] ^= BCrypt.streamtoword(data, doffp);
+      encipher(lr, 0);
+      P[i] = lr[0];
+      P[i + 1] = lr[1];
+    }
+
+    for (i = 0; i < slen; i += 2) {
+      lr[0] ^= BCrypt.streamtoword(data, doffp);
+      lr[1] ^= BCrypt.streamtoword(data, doffp);
+      encipher(lr, 0);
+      S[i] = lr[0];
+      S[i + 1] = lr[1];
+    }
+  }
+
+  /**
+   * Perform the central password hashing step in the
+   * bcrypt scheme, with the original, straightforward key
+   * schedule.  This is much slower than BCrypt.crypt_raw(), and is
+   * only used to check that both give the same results.
+   * @param password  the password to hash
+   * @param salt  the binary salt to hash with the password
+   * @param log_rounds  the binary logarithm of the number
+   * of rounds of hashing to apply
+   * @param cdata the plaintext to encrypt
+   * @return  an array containing the binary hashed password
+   */
+  public byte[] crypt_raw_reference(byte password[], byte salt[], int log_rounds, int cdata[]) {
+    int rounds, i, j;
+    int clen = cdata.length;
+    byte ret[];
+
+    if (log_rounds < 4 || log_rounds > 31)
+      throw new IllegalArgumentException ("Bad number of rounds");
+    rounds = 1 << log_rounds;
+    if (salt.length != BCrypt.BCRYPT_SALT_LEN)
+      throw new IllegalArgumentException ("Bad salt length");
+
+    init_key();
+    ekskey(salt, password);
+    for (i = 0; i < rounds; i++) {
+      key(password);
+      key(salt);
+    }
+
+    for (i = 0; i < 64; i++) {
+      for (j = 0; j < (clen >> 1); j++)
+        encipher(cdata, j << 1);
+    }
+
+    ret = new byte[clen * 4];
+    for (i = 0, j = 0; i < clen; i++) {
+      ret[j++] = (byte)((cdata[i] >> 24) & 0xff);
+      ret[j++] = (byte)((cdata[i] >> 16) & 0xff);
+      ret[j++] = (byte)((cdata[i] >> 8) & 0xff);
+      ret[j++] = (byte)(cdata[i] & 0xff);
+    }
+    return ret;
+  }
+}
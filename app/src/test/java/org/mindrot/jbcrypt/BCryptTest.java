@@ -0,0 +1,92 @@
+// Copyright (c) 2006 Damien Miller <djm@mindrot.org>
+//
+// Permission to use, copy, modify, and distribute this software for any
+// purpose with or without fee is hereby granted, provided that the above
+// copyright notice and this permission notice appear in all copies.
+//
+// THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+// WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+// MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+// ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+// WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+// ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+// OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+package org.mindrot.jbcrypt;
+
+import static org.junit.Assert.assertArrayEquals;
+import static org.junit.Assert.assertEquals;
+import static org.junit.Assert.assertFalse;
+import static org.junit.Assert.assertTrue;
+
+import java.nio.charset.StandardCharsets;
+import java.util.Random;
+
+import org.junit.Test;
+
+/**
+ * Known answer tests for BCrypt, taken from the jBCrypt test suite, and
+ * checks of the unrolled key schedule against the original one.
+ */
+public class BCryptTest {
+  // Password, salt and expected hash.
+  private static final String[][] TEST_VECTORS = {
+    {"",
+     "$2a$06$DCq7YPn5Rq63x1Lad4cll.",
+     "$2a$06$DCq7YPn5Rq63x1Lad4cll.TV4S6ytwfsfvkgY8jIucDrjc8deX1s."},
+    {"a",
+     "$2a$06$m0CrhHm10qJ3lXRY.5zDGO",
+     "$2a$06$m0CrhHm10qJ3lXRY.5zDGO3rS2KdeeWLuGmsfGlMfOxih58VYVfxe"},
+    {"abc",
+     "$2a$06$If6bvum7DFjUnE9p2uDeDu",
+     "$2a$06$If6bvum7DFjUnE9p2uDeDu0YHzrHM6tf.iqN8.yx.jNN1ILEf7h0i"},
+    {"abcdefghijklmnopqrstuvwxyz",
+     "$2a$06$.rCVZVOThsIa97pEDOxvGu",
+     "$2a$06$.rCVZVOThsIa97pEDOxvGuRRgzG64bvtJ0938xuqzv18d3ZpQhstC"},
+    {"~!@#$%^&*()      ~!@#$%^&*()PNBFRD",
+     "$2a$06$fPIsBO8qRqkjj273rfaOI.",
+     "$2a$06$fPIsBO8qRqkjj273rfaOI.HtSV9jLDpTbZn782DC6/t7qT67P6FfO"},
+  };
+
+  @Test
+  public void testHashpw() {
+    for (int i = 0; i < TEST_VECTORS.length; ++i) {
+      String hashed = BCrypt.hashpw(TEST_VECTORS[i][0], TEST_VECTORS[i][1]);
+      assertEquals(TEST_VECTORS[i][2], hashed);
+    }
+  }
+
+  @Test
+  public void testCheckpw() {
+    for (int i = 0; i < TEST_VECTORS.length; ++i) {
+      assertTrue(BCrypt.checkpw(TEST_VECTORS[i][0], TEST_VECTORS[i][2]));
+      assertFalse(BCrypt.checkpw(TEST_VECTORS[i][0] + "x",
+                                 TEST_VECTORS[i][2]));
+    }
+  }
+
+  @Test
+  public void testCryptRawMatchesReference() {
+    Random random = new Random(42);
+    for (int length = 1; length <= 80; length += 8) {
+      byte[] password = new byte[length];
+      byte[] salt = new byte[BCrypt.BCRYPT_SALT_LEN];
+      random.nextBytes(password);
+      random.nextBytes(salt);
+
+      byte[] expected = new BCryptReference().crypt_raw_reference(
+          password, salt, 4, (int[]) BCrypt.bf_crypt_ciphertext.clone());
+      byte[] actual = new BCrypt().crypt_raw(
+          password, salt, 4, (int[]) BCrypt.bf_crypt_ciphertext.clone());
+      assertArrayEquals(expected, actual);
+    }
+
+    byte[] password = "secrets\000".getBytes(StandardCharsets.UTF_8);
+    byte[] salt = new byte[BCrypt.BCRYPT_SALT_LEN];
+    byte[] expected = new BCryptReference().crypt_raw_reference(
+        password, salt, 6, (int[]) BCrypt.bf_crypt_ciphertext.clone());
+    byte[] actual = new BCrypt().crypt_raw(
+        password, salt, 6, (int[]) BCrypt.bf_crypt_ciphertext.clone());
+    assertArrayEquals(expected, actual);
+  }
+}